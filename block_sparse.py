@@ -0,0 +1,131 @@
+"""Block sparse storage of the slice Fisher vectors. Short slices have a
+zero count for most of the visual words, and so a zero Fisher vector block;
+only the blocks of the active visual words are stored, and the per visual
+word reductions (scores and L2 norms) are computed on them only.
+
+"""
+import numpy as np
+from scipy import sparse
+
+
+BLOCK_SIZE = 65536
+
+
+def visual_word_dims(D, K):
+    """Indices of the `2D` Fisher vector dimensions of each visual word, in
+    the layout of `build_visual_word_mask`; an array of shape `(K, 2D)`.
+
+    """
+    dims = np.arange(K * D).reshape(K, D)
+    return np.hstack((dims, dims + K * D))
+
+
+class BlockSparseFisherVectors(object):
+    """Slice Fisher vectors in compressed sparse row order of visual word
+    blocks: the active visual words of slice `n` are
+    `visual_words[indptr[n]: indptr[n + 1]]` and their blocks, counts and L2
+    terms (the sums of squares of the blocks) are the corresponding rows of
+    `blocks`, `counts` and `l2_terms`.
+
+    The per visual word reductions return sparse matrices of shape `(N, K)`,
+    with the same sparsity as the slices.
+
+    """
+    def __init__(self, indptr, visual_words, blocks, counts, l2_terms, K):
+        self.indptr = indptr
+        self.visual_words = visual_words
+        self.blocks = blocks
+        self.counts = counts
+        self.l2_terms = l2_terms
+        self.K = K
+
+    @property
+    def D(self):
+        return self.blocks.shape[1] / 2
+
+    @property
+    def shape(self):
+        return len(self), 2 * self.K * self.D
+
+    @property
+    def nbytes(self):
+        return sum(
+            array.nbytes for array in (
+                self.indptr, self.visual_words, self.blocks, self.counts,
+                self.l2_terms))
+
+    @property
+    def rows(self):
+        """The slice of each stored block."""
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __mul__(self, coef):
+        """Multiplies the rows by `coef`, of shape `(N, 1)`, as for an array;
+        the counts are not changed.
+
+        """
+        coef = np.asarray(coef)
+        assert coef.shape == (len(self), 1), coef.shape
+        coef = coef[self.rows]
+        return BlockSparseFisherVectors(
+            self.indptr, self.visual_words,
+            (self.blocks * coef).astype(self.blocks.dtype), self.counts,
+            self.l2_terms * coef[:, 0] ** 2, self.K)
+
+    @classmethod
+    def from_dense(cls, fisher_vectors, counts, dtype=np.float32):
+        """Keeps the blocks of the visual words with non-zero counts."""
+        N, K = counts.shape
+        D = fisher_vectors.shape[1] / 2 / K
+
+        rows, visual_words = np.nonzero(counts)
+        blocks = np.asarray(fisher_vectors).reshape(N, 2, K, D)[rows, :, visual_words]
+        blocks = blocks.reshape(len(rows), 2 * D).astype(dtype)
+
+        indptr = np.hstack((0, np.cumsum(np.bincount(rows, minlength=N))))
+        l2_terms = np.sum(blocks.astype(np.float64) ** 2, axis=1)
+
+        return cls(
+            indptr, visual_words, blocks, counts[rows, visual_words], l2_terms,
+            K)
+
+    def to_dense(self):
+        N, K, D = len(self), self.K, self.D
+        fisher_vectors = np.zeros((N, 2, K, D), dtype=self.blocks.dtype)
+        fisher_vectors[self.rows, :, self.visual_words] = self.blocks.reshape(-1, 2, D)
+        return fisher_vectors.reshape(N, -1)
+
+    def dense_counts(self):
+        return self.per_visual_word(self.counts).toarray()
+
+    def per_visual_word(self, values):
+        """Sparse `(N, K)` matrix of per block values."""
+        return sparse.csr_matrix(
+            (values, self.visual_words, self.indptr), shape=(len(self), self.K))
+
+    def weighted_sums(self, dim_weights, power=1, block_size=BLOCK_SIZE):
+        """Sums over each block of the `power` of its entries, weighted by
+        the per dimension `dim_weights` (in the Fisher vector layout).
+
+        """
+        dim_weights = np.asarray(dim_weights).ravel()[visual_word_dims(self.D, self.K)]
+        values = np.empty(len(self.blocks))
+        for ii in xrange(0, len(self.blocks), block_size):
+            blocks = self.blocks[ii: ii + block_size]
+            values[ii: ii + block_size] = np.einsum(
+                'ij,ij->i', blocks ** power if power != 1 else blocks,
+                dim_weights[self.visual_words[ii: ii + block_size]])
+        return values
+
+    def visual_word_l2_norm(self, visual_word_mask):
+        # A folded mask (see `fold_visual_word_mask`) weights the dimensions.
+        dim_weights = np.asarray(visual_word_mask.sum(axis=1)).ravel()
+        if np.all(dim_weights == 1):
+            return self.per_visual_word(self.l2_terms)
+        return self.per_visual_word(self.weighted_sums(dim_weights, power=2))
+
+    def visual_word_scores(self, weights, visual_word_mask):
+        return self.per_visual_word(- self.weighted_sums(weights))
@@ -6,7 +6,6 @@ import os
 import pdb
 import socket
 
-from sklearn.preprocessing import StandardScaler
 
 from dataset import Dataset
 
@@ -19,6 +18,7 @@ from evaluate import print_scores
 
 from load_data import CACHE_PATH
 from load_data import CFG
+from load_data import DiagonalScaler
 from load_data import approximate_signed_sqrt
 from load_data import load_video_data
 
@@ -197,7 +197,7 @@ def load_kernels_all(
     }
 
     def get_scaler(bool):
-        return StandardScaler(with_mean=False) if bool else DummyScaler()
+        return DiagonalScaler() if bool else DummyScaler()
 
     normalizations = {
         'scaler_1'        : get_scaler(e_std_1),
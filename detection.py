@@ -3,6 +3,8 @@ from collections import namedtuple
 import cPickle
 from fractions import gcd
 from itertools import groupby
+from itertools import izip
+from multiprocessing import Pool
 import numpy as np
 import os
 import socket
@@ -18,12 +20,30 @@ else:
 from sklearn.preprocessing import Scaler
 
 from dataset import Dataset
-from dataset import SampID
 
 from fisher_vectors.evaluation import Evaluation
 from fisher_vectors.model.utils import power_normalize
 from fisher_vectors.model.utils import compute_L2_normalization
 
+from detection_evaluation import check_get_det_ap
+from detection_evaluation import evaluate_detections
+from detection_evaluation import load_ground_truth
+from detection_evaluation import parse_overlap
+
+from detection_results import ResultBuffer
+from detection_results import as_results
+from detection_results import concatenate_results
+from detection_results import rescore_by_length
+from detection_results import select_top
+from detection_results import to_samp_ids
+from detection_results import to_tuples
+
+from block_sparse import BlockSparseFisherVectors
+from fv_quantization import QuantizedFisherVectors
+from integral_image import IntegralImage
+
+from load_data import DiagonalScaler
+from load_data import apply_scalers
 from load_data import approximate_signed_sqrt
 from load_data import load_kernels
 from load_data import load_sample_data
@@ -32,17 +52,25 @@ from result_file_functions import get_det_ap
 from result_file_functions import get_det_pr
 
 from load_data import CFG
+from ssqrt_l2_approx import COMPACT_FISHER_VECTORS
 from ssqrt_l2_approx import LOAD_SAMPLE_DATA_PARAMS
+from ssqrt_l2_approx import PRIMAL_CLASSIFIERS
 
 from ssqrt_l2_approx import approximate_video_scores
 from ssqrt_l2_approx import build_slice_agg_mask
 from ssqrt_l2_approx import build_visual_word_mask
 from ssqrt_l2_approx import compute_weights
+from ssqrt_l2_approx import fit_primal_classifiers
+from ssqrt_l2_approx import fold_classifier
 from ssqrt_l2_approx import load_normalized_tr_data
 from ssqrt_l2_approx import my_cacher
+from ssqrt_l2_approx import normalization_recipe_file
 from ssqrt_l2_approx import predict
+from ssqrt_l2_approx import primal_C
+from ssqrt_l2_approx import recipe_hash
 from ssqrt_l2_approx import scale_and_sum_by
 from ssqrt_l2_approx import scale_by
+from ssqrt_l2_approx import scale_factors
 from ssqrt_l2_approx import sum_and_scale_by
 from ssqrt_l2_approx import sum_by
 from ssqrt_l2_approx import visual_word_l2_norm
@@ -52,13 +80,15 @@ from ssqrt_l2_approx import visual_word_scores
 #from nms.nms import non_maxima_supression
 #from nms.nms_kdtree import non_maxima_supression
 from nms.nms_2 import non_maxima_supression_0
+from nms.nms_iou import non_maxima_supression
+from nms.nms_iou import soft_non_maxima_supression
 
 
 # TODO Things to improve
 # [x] Check if frames are contiguous. If not treat them specifically.
 # [x] Mask with 1, -1 and integral quantities.
 # [x] Write fast ESS for approximate norms in Cython.
-# [ ] Remove duplicate code from `approx_ess` and `cy_approx_ess`.
+# [x] Remove duplicate code from `approx_ess` and `cy_approx_ess`.
 
 CVPR_XPS = True
 
@@ -66,16 +96,12 @@ TRACK_LEN = 15
 NULL_CLASS_IDX = 0
 
 MOVIE = 'cac.mpg'
-SAMPID = '%s-frames-%d-%d'
 RESULT_PATH = '/home/lear/oneata/tmp/%s_%s_%d_%d_%s.dat'
 
 SliceData = namedtuple(
     'SliceData', ['fisher_vectors', 'counts', 'nr_descriptors', 'begin_frames',
                   'end_frames'])
 
-ITERATION_TIMINGS = []
-
-
 def timer(func):
     def timed_func(*args, **kwargs):
         start = time.time()
@@ -85,6 +111,16 @@ def timer(func):
     return timed_func
 
 
+def write_search_stats(filename, search_stats):
+    """Dumps the per-detection statistics of the branch-and-bound search."""
+    keys = sorted(set(key for _, stats in search_stats for key in stats))
+    with open(filename, 'w') as ff:
+        ff.write("# %4s %s\n" % ('ii', ' '.join(keys)))
+        for ii, stats in search_stats:
+            ff.write("%6d %s\n" % (
+                ii, ' '.join(str(stats.get(key, '-')) for key in keys)))
+
+
 def mgcd(*args):
     """Greatest common divisor that accepts multiple arguments."""
     return mgcd(args[0], mgcd(*args[1:])) if len(args) > 2 else gcd(*args)
@@ -147,6 +183,108 @@ def load_data_delta_0(
     return fisher_vectors[:ii], counts[:ii], nr_descs[:ii], begin_frames[:ii], end_frames[:ii]
 
 
+@my_cacher('np', 'np', 'np', 'np', 'np', 'np')
+def load_quantized_data_delta_0(
+    dataset, movie, part, class_idx, analytical_fim, outfile=None, delta_0=30,
+    raw_outfile=None, verbose=0):
+    """Compressed version of `load_data_delta_0`, which stores the codes and
+    the scales of the quantized Fisher vectors (see `QuantizedFisherVectors`)
+    instead of the Fisher vectors. The uncompressed data is read from
+    `raw_outfile`, if it exists, or computed and not kept.
+
+    """
+    keep_raw = raw_outfile is not None and os.path.exists(raw_outfile)
+    if not keep_raw:
+        raw_outfile = outfile + '.raw'
+
+    fisher_vectors, counts, nr_descs, begin_frames, end_frames = load_data_delta_0(
+        dataset, movie, part, class_idx, analytical_fim, outfile=raw_outfile,
+        delta_0=delta_0, verbose=verbose)
+
+    if not keep_raw:
+        os.remove(raw_outfile)
+
+    quantized = QuantizedFisherVectors.quantize(fisher_vectors, dataset.VOC_SIZE)
+    return quantized.codes, quantized.scales, counts, nr_descs, begin_frames, end_frames
+
+
+def spatial_nr_bins(src_cfg):
+    """Number of horizontal bins of the spatial pyramid, an entry `(1, H, 1)`
+    of the `spms` in the config of `src_cfg`, with which the slices were
+    described; None if there is no such pyramid.
+
+    """
+    nr_bins = [hh for tt, hh, vv in CFG[src_cfg].get('spms', []) if tt == vv == 1 and hh > 1]
+    return nr_bins[0] if nr_bins else None
+
+
+@my_cacher('np', 'np', 'np', 'np', 'np')
+def load_binned_data_delta_0(
+    dataset, movie, part, class_idx, analytical_fim, nr_bins, outfile=None,
+    delta_0=30, verbose=0):
+    """Loads the Fisher vectors of the test data for each of the `nr_bins`
+    horizontal spatial bins (the `spm` 1x3x1 statistics). The Fisher vectors
+    and the counts have shape N x nr_bins x dim, the number of descriptors
+    N x nr_bins.
+
+    """
+
+    D, K = dataset.D, dataset.VOC_SIZE
+    class_name = dataset.IDX2CLS[class_idx]
+    class_limits = dataset.CLASS_LIMITS[movie][class_name][part]
+
+    nr_frames = class_limits[1] - class_limits[0] + 1
+    N = nr_frames / delta_0 + 1
+    FV_LEN = 2 * D * K
+
+    fisher_vectors = np.zeros((N, nr_bins, FV_LEN), dtype=np.float32)
+    counts = np.zeros((N, nr_bins, K), dtype=np.float32)
+
+    nr_descs = np.zeros((N, nr_bins))
+    begin_frames = np.zeros(N)
+    end_frames = np.zeros(N)
+
+    # Filter samples by movie name.
+    samples, _ = dataset.get_data('test')
+    samples = [sample for sample in samples if str(sample).startswith(movie)]
+
+    ii = 0  # Slices count.
+    for jj, sample in enumerate(samples):
+
+        if verbose: sys.stdout.write("%5d %30s\r" % (jj, str(sample)))
+
+        if sample.bf < class_limits[0] or class_limits[1] < sample.ef:
+            continue
+
+        sample_fisher_vectors, _, sample_counts, sample_info = load_sample_data(
+            dataset, sample, analytical_fim=analytical_fim,
+            **LOAD_SAMPLE_DATA_PARAMS)
+
+        # The spatial pyramid statistics are stored for all the slices, in
+        # slice-major order; the number of descriptors is nr_bins x nr_slices.
+        sample_nr_descs = sample_info['nr_descs'].T
+        nn = len(sample_nr_descs)
+
+        assert (sample_nr_descs.ndim == 2 and
+                sample_nr_descs.shape[1] == nr_bins and
+                len(sample_fisher_vectors) == nn * nr_bins), (
+            "The slices of %s are not split in %d spatial bins." % (sample, nr_bins))
+
+        fisher_vectors[ii: ii + nn] = sample_fisher_vectors.reshape(nn, nr_bins, FV_LEN)
+        counts[ii: ii + nn] = sample_counts.reshape(nn, nr_bins, K)
+        nr_descs[ii: ii + nn] = sample_nr_descs
+        begin_frames[ii: ii + nn] = sample_info['begin_frames']
+        end_frames[ii: ii + nn] = sample_info['end_frames']
+
+        # Update the slices count.
+        ii += nn
+
+    fisher_vectors[np.isnan(fisher_vectors)] = 0
+    counts[np.isnan(counts)] = 0
+
+    return fisher_vectors[:ii], counts[:ii], nr_descs[:ii], begin_frames[:ii], end_frames[:ii]
+
+
 def build_sliding_window_mask(N, nn, dd=1):
     """Builds mask to aggregate a vectors [x_1, x_2, ..., x_N] into
     [x_1 + ... + x_n, x_2 + ... + x_{n+1}, ...].
@@ -186,15 +324,30 @@ def build_integral_sliding_window_mask(N, nn, dd=1):
 
 
 class OverlappingSelector:
-    def __init__(self, chunk, stride, containing, integral):
+    def __init__(
+        self, chunk, stride, containing, integral, integral_block_size=1,
+        integral_dtype=np.float64):
         self.chunk = chunk
         self.stride = stride
         self.integral = integral
+        self.integral_block_size = integral_block_size
+        self.integral_dtype = integral_dtype
         self.containing = containing
         self.mask_builder = (
             build_integral_sliding_window_mask if integral
             else build_sliding_window_mask)
 
+    def integral_image(self, X, overwrite=False):
+        """The integral image of `X`, which can be overwritten if it is a
+        temporary; see `IntegralImage`.
+
+        """
+        if sparse.issparse(X):
+            X, overwrite = X.toarray(), True
+        return IntegralImage(
+            X, block_size=self.integral_block_size, dtype=self.integral_dtype,
+            overwrite=overwrite)
+
     def get_mask(self, N, window_size):
         track_len = 15 if self.containing else 0
         return self.mask_builder(
@@ -260,13 +413,36 @@ def aggregate(slice_data, sparse_mask, frame_idxs):
         agg_end_frames)
 
 
-def integral(X):
-    if X.ndim == 1:
-        return np.hstack((0, np.cumsum(X)))
-    elif X.ndim == 2:
-        return np.vstack((np.zeros((1, X.shape[1])), np.cumsum(X, axis=0)))
-    else:
-        assert False
+def aggregate_quantized(slice_data, sparse_mask, frame_idxs):
+    """Applies `aggregate` to quantized slices, which are quantized again
+    after being aggregated.
+
+    """
+    fisher_vectors = slice_data.fisher_vectors
+    agg_slice_data = aggregate(
+        slice_data._replace(fisher_vectors=fisher_vectors.dequantize()),
+        sparse_mask, frame_idxs)
+    return agg_slice_data._replace(
+        fisher_vectors=QuantizedFisherVectors.quantize(
+            agg_slice_data.fisher_vectors, fisher_vectors.K))
+
+
+def aggregate_binned(slice_data, sparse_mask, frame_idxs):
+    """Applies `aggregate` to each spatial bin of the slices."""
+    nr_bins = slice_data.nr_descriptors.shape[1]
+    agg_bins = [
+        aggregate(SliceData(
+            slice_data.fisher_vectors[:, bb], slice_data.counts[:, bb],
+            slice_data.nr_descriptors[:, bb], slice_data.begin_frames,
+            slice_data.end_frames), sparse_mask, frame_idxs)
+        for bb in xrange(nr_bins)]
+    stack = lambda arrays: np.concatenate(
+        [array[:, np.newaxis] for array in arrays], axis=1)
+    return SliceData(
+        stack([agg.fisher_vectors for agg in agg_bins]),
+        stack([agg.counts for agg in agg_bins]),
+        stack([agg.nr_descriptors for agg in agg_bins]),
+        agg_bins[0].begin_frames, agg_bins[0].end_frames)
 
 
 def only_positive(X):
@@ -277,19 +453,39 @@ def only_negative(X):
     return np.ma.masked_greater(X, 0).filled(0)
 
 
+def scale_or_fold(
+    fisher_vectors, weights, scalers, visual_word_mask, fold_scalers=True,
+    folded=None):
+    """Applies the scalers either to the slice Fisher vectors or, if
+    `fold_scalers`, to the weights and to the visual word mask used for the
+    L2 norms (see `fold_classifier`), which avoids a scaled copy of the
+    slices; `folded` are these, if already computed at train time. Returns
+    the Fisher vectors, the weights and the L2 visual word mask.
+
+    """
+    if fold_scalers:
+        if folded is None:
+            folded = fold_classifier(weights, scalers, visual_word_mask)
+        return fisher_vectors, folded.weights, folded.l2_visual_word_mask
+    else:
+        assert not isinstance(fisher_vectors, COMPACT_FISHER_VECTORS), (
+            "The scalers cannot be applied directly to compact Fisher "
+            "vectors; they must be folded.")
+        return apply_scalers(fisher_vectors, scalers), weights, visual_word_mask
+
+
 @timer
 def exact_sliding_window_no_sqrt_no_l2(
-    slice_data, clf, deltas, selector, scalers, visual_word_mask):
+    slice_data, clf, deltas, selector, scalers, visual_word_mask, top_k=None,
+    score_threshold=None, fold_scalers=True, folded=None):
 
-    results = []
+    results = ResultBuffer(top_k=top_k, score_threshold=score_threshold)
     weights, bias = clf
 
     # Prepare sliced data.
-    fisher_vectors = slice_data.fisher_vectors
-    for scaler in scalers:
-        if scaler is None:
-            continue
-        fisher_vectors = scaler.transform(fisher_vectors)
+    fisher_vectors, weights, _ = scale_or_fold(
+        slice_data.fisher_vectors, weights, scalers, visual_word_mask,
+        fold_scalers, folded)
     nr_descriptors_T = slice_data.nr_descriptors[:, np.newaxis]
 
     # Multiply by the number of descriptors.
@@ -297,8 +493,8 @@ def exact_sliding_window_no_sqrt_no_l2(
     slice_scores = np.sum(- fisher_vectors * weights, axis=1)[:, np.newaxis]
 
     if selector.integral:
-        slice_scores = integral(slice_scores)
-        nr_descriptors_T = integral(nr_descriptors_T)
+        slice_scores = selector.integral_image(slice_scores, overwrite=True)
+        nr_descriptors_T = selector.integral_image(nr_descriptors_T)
 
     N = fisher_vectors.shape[0]
 
@@ -317,19 +513,26 @@ def exact_sliding_window_no_sqrt_no_l2(
         assert len(scores) == len(agg_begin_frames) == len(agg_end_frames)
 
         nan_idxs = np.isnan(scores)
-        results += zip(
+        results.append(
             agg_begin_frames[~nan_idxs],
             agg_end_frames[~nan_idxs],
-            scores[~nan_idxs])
+            scores[~nan_idxs],
+            delta=delta)
 
-    return results
+    return results.to_array()
 
 
 @timer
 def exact_sliding_window(
-    slice_data, clf, deltas, selector, scalers, sqrt_type='', l2_norm_type=''):
+    slice_data, clf, deltas, selector, scalers, sqrt_type='', l2_norm_type='',
+    top_k=None, score_threshold=None, block_size=1024):
+    """Scores the windows with the exact normalizations. The windows of each
+    delta are aggregated, normalized and scored `block_size` at a time, so
+    only a block of aggregated Fisher vectors is in memory, whatever the
+    length of the movie.
 
-    results = []
+    """
+    results = ResultBuffer(top_k=top_k, score_threshold=score_threshold)
     weights, bias = clf
 
     nr_descriptors_T = slice_data.nr_descriptors[:, np.newaxis]
@@ -341,12 +544,14 @@ def exact_sliding_window(
     begin_frames, end_frames = slice_data.begin_frames, slice_data.end_frames
     N = fisher_vectors.shape[0]
 
+    # The products with the number of descriptors are temporaries, so the
+    # integral images are computed in place, if their type allows it.
     if selector.integral:
-        fisher_vectors = integral(fisher_vectors)
-        nr_descriptors_T = integral(nr_descriptors_T)
+        fisher_vectors = selector.integral_image(fisher_vectors, overwrite=True)
+        nr_descriptors_T = selector.integral_image(nr_descriptors_T)
 
     if selector.integral and sqrt_type == 'approx':
-        counts = integral(counts)
+        counts = selector.integral_image(counts, overwrite=True)
 
     for delta in deltas:
 
@@ -354,337 +559,416 @@ def exact_sliding_window(
         mask = selector.get_mask(N, delta)
         begin_frame_idxs, end_frame_idxs = selector.get_frame_idxs(N, delta)
 
-        # Aggregate data into bigger slices.
-        agg_fisher_vectors = (
-            sum_by(fisher_vectors, mask) /
-            sum_by(nr_descriptors_T, mask))
-        agg_fisher_vectors[np.isnan(agg_fisher_vectors)] = 0
-
         agg_begin_frames = begin_frames[begin_frame_idxs]
         agg_end_frames = end_frames[end_frame_idxs]
 
-        assert len(agg_fisher_vectors) == len(agg_begin_frames) == len(agg_end_frames)
-
-        # Normalize aggregated data.
-        if scalers[0] is not None:
-            agg_fisher_vectors = scalers[0].transform(agg_fisher_vectors)
-        if sqrt_type == 'exact':
-            agg_fisher_vectors = power_normalize(agg_fisher_vectors, 0.5)
-        if sqrt_type == 'approx':
-            agg_counts = (
-                sum_by(counts, mask) /
-                sum_by(nr_descriptors_T, mask))
-            agg_fisher_vectors = approximate_signed_sqrt(
-                agg_fisher_vectors, agg_counts, pi_derivatives=False)
-        if scalers[1] is not None:
-            agg_fisher_vectors = scalers[1].transform(agg_fisher_vectors)
-
-        # More efficient, to apply L2 on the scores than on the FVs.
-        l2_norms = (
-            compute_L2_normalization(agg_fisher_vectors)
-            if l2_norm_type != 'none'
-            else np.ones(len(agg_fisher_vectors)))
-
-        # Predict with the linear classifier.
-        scores = (
-            - np.dot(agg_fisher_vectors, weights.T).squeeze()
-            / np.sqrt(l2_norms)
-            + bias)
+        assert mask.shape[0] == len(agg_begin_frames) == len(agg_end_frames)
+
+        scores = np.empty(mask.shape[0])
+
+        for ii in xrange(0, mask.shape[0], block_size):
+
+            block_mask = mask[ii: ii + block_size]
+
+            # Aggregate data into bigger slices.
+            agg_nr_descriptors = sum_by(nr_descriptors_T, block_mask)
+            agg_fisher_vectors = sum_by(fisher_vectors, block_mask) / agg_nr_descriptors
+            agg_fisher_vectors[np.isnan(agg_fisher_vectors)] = 0
+
+            # Normalize aggregated data.
+            if scalers[0] is not None:
+                agg_fisher_vectors = scalers[0].transform(agg_fisher_vectors, copy=False)
+            if sqrt_type == 'exact':
+                agg_fisher_vectors = power_normalize(agg_fisher_vectors, 0.5)
+            if sqrt_type == 'approx':
+                agg_counts = sum_by(counts, block_mask) / agg_nr_descriptors
+                agg_fisher_vectors = approximate_signed_sqrt(
+                    agg_fisher_vectors, agg_counts, pi_derivatives=False)
+            if scalers[1] is not None:
+                agg_fisher_vectors = scalers[1].transform(agg_fisher_vectors, copy=False)
+
+            # More efficient, to apply L2 on the scores than on the FVs.
+            l2_norms = (
+                compute_L2_normalization(agg_fisher_vectors)
+                if l2_norm_type != 'none'
+                else np.ones(len(agg_fisher_vectors)))
+
+            # Predict with the linear classifier.
+            scores[ii: ii + block_size] = (
+                - np.dot(agg_fisher_vectors, weights.T).ravel()
+                / np.sqrt(l2_norms)
+                + bias)
 
         nan_idxs = np.isnan(scores)
-        results += zip(
+        results.append(
             agg_begin_frames[~nan_idxs],
             agg_end_frames[~nan_idxs],
-            scores[~nan_idxs])
+            scores[~nan_idxs],
+            delta=delta)
 
-    return results
+    return results.to_array()
 
 
-@timer
-def approx_sliding_window(
-    slice_data, clf, deltas, selector, scalers, visual_word_mask):
+def window_bounds(mask, integral):
+    """The slices `[begins, ends)` summed by each row of a sliding window
+    mask (see `build_sliding_window_mask` and
+    `build_integral_sliding_window_mask`). The empty rows give the empty
+    window `[0, 0)`.
 
-    results = []
-    weights, bias = clf
+    """
+    mask = sparse.csr_matrix(mask, copy=True)
+    mask.eliminate_zeros()
+    mask.sort_indices()
 
-    # Prepare sliced data.
-    fisher_vectors = slice_data.fisher_vectors
-    for scaler in scalers:
-        if scaler is None:
-            continue
-        fisher_vectors = scaler.transform(fisher_vectors)
-    nr_descriptors_T = slice_data.nr_descriptors[:, np.newaxis]
+    nn = np.diff(mask.indptr)
+    begins = np.zeros(mask.shape[0], dtype=np.int)
+    ends = np.zeros(mask.shape[0], dtype=np.int)
 
-    # Multiply by the number of descriptors.
-    fisher_vectors = fisher_vectors * nr_descriptors_T
-    slice_vw_counts = slice_data.counts * nr_descriptors_T
+    # The first and last entries exist only for the non-empty rows.
+    rows = nn > 0
+    begins[rows] = mask.indices[mask.indptr[: -1][rows]]
+    ends[rows] = mask.indices[mask.indptr[1:][rows] - 1] + (0 if integral else 1)
+    return begins, ends
 
-    #
-    slice_vw_l2_norms = visual_word_l2_norm(fisher_vectors, visual_word_mask)
-    slice_vw_scores = visual_word_scores(fisher_vectors, weights, bias, visual_word_mask)
 
-    if selector.integral:
-        slice_vw_counts = integral(slice_vw_counts)
-        slice_vw_l2_norms = integral(slice_vw_l2_norms)
-        slice_vw_scores = integral(slice_vw_scores)
-        nr_descriptors_T = integral(nr_descriptors_T)
+def slice_gram_band(X, width, block_size=256):
+    """The band of the Gram matrix of the rows of `X`: `band[j, k]` is
+    `X[j - k] . X[j]` for `k < width` (zero if `j < k`). The rows are read a
+    block at a time, with the `width - 1` rows that precede the block.
+
+    """
+    N = X.shape[0]
+    band = np.zeros((N, width))
+    for ii in xrange(0, N, block_size):
+        first = max(0, ii - width + 1)
+        rows = np.asarray(X[first: ii + block_size], dtype=np.float64)
+        for kk in xrange(width):
+            start = max(ii - first, kk)
+            band[first + start: first + len(rows), kk] = np.einsum(
+                'ij,ij->i', rows[start:], rows[start - kk: len(rows) - kk])
+    return band
+
+
+def window_gram_sums(band):
+    """Sums of the Gram matrix over the windows of consecutive rows, from its
+    band (see `slice_gram_band`): `sums[b, l]` is the squared L2 norm of the
+    sum of the `l` rows starting at `b`, for `l` up to the band width. Each
+    row adds its product with itself and, twice, its products with the
+    previous rows of the window.
+
+    """
+    N, width = band.shape
+    band = 2 * band
+    band[:, 0] /= 2
+    np.cumsum(band, axis=1, out=band)
+    sums = np.zeros((N, width + 1))
+    for tt in xrange(width):
+        sums[: N - tt, tt + 1] = band[tt:, tt]
+    np.cumsum(sums, axis=1, out=sums)
+    return sums
+
+
+@timer
+def exact_sliding_window_gram(
+    slice_data, clf, deltas, selector, scalers, top_k=None,
+    score_threshold=None):
+    """Scores the windows as `exact_sliding_window` for the exact L2
+    normalization without square rooting, but never aggregates the Fisher
+    vectors of the windows: the squared L2 norm of a window is the sum of
+    the Gram matrix of its scaled slices, which is read from the band of the
+    slice Gram matrix (computed once, as wide as the longest window). The
+    division by the number of descriptors cancels out in the scores.
+
+    """
+    results = ResultBuffer(top_k=top_k, score_threshold=score_threshold)
+    weights, bias = clf
+
+    # Multiply by the number of descriptors and scale, as the L2 norms are
+    # those of the scaled data.
+    fisher_vectors = slice_data.fisher_vectors * slice_data.nr_descriptors[:, np.newaxis]
+    factors = scale_factors(scalers)
+    if factors is not None:
+        fisher_vectors *= factors
 
     N = fisher_vectors.shape[0]
+    slice_scores = selector.integral_image(
+        - np.dot(fisher_vectors, weights.T), overwrite=True)
+
+    bounds = {
+        delta: window_bounds(selector.get_mask(N, delta), selector.integral)
+        for delta in deltas}
+    width = max(
+        1, max(np.max(ends - begins) for begins, ends in bounds.itervalues()))
+    gram_sums = window_gram_sums(slice_gram_band(fisher_vectors, width))
 
     for delta in deltas:
 
-        # Build mask.
-        mask = selector.get_mask(N, delta)
+        begins, ends = bounds[delta]
         begin_frame_idxs, end_frame_idxs = selector.get_frame_idxs(N, delta)
 
-        # Approximated predictions.
-        scores = approximate_video_scores(
-            slice_vw_scores, slice_vw_counts, slice_vw_l2_norms, nr_descriptors_T, mask)
+        scores = (
+            slice_scores.window_sums(begins, ends)[:, 0] /
+            np.sqrt(gram_sums[begins, ends - begins]) + bias)
         agg_begin_frames = slice_data.begin_frames[begin_frame_idxs]
         agg_end_frames = slice_data.end_frames[end_frame_idxs]
 
         assert len(scores) == len(agg_begin_frames) == len(agg_end_frames)
 
         nan_idxs = np.isnan(scores)
-        results += zip(
+        results.append(
             agg_begin_frames[~nan_idxs],
             agg_end_frames[~nan_idxs],
-            scores[~nan_idxs])
+            scores[~nan_idxs],
+            delta=delta)
 
-    return results
+    return results.to_array()
 
 
 @timer
-def approx_sliding_window_ess(
-    slice_data, clf, deltas, selector, scalers, rescore, visual_word_mask):
-
-    from ess import Bounds
-    from ess import efficient_subwindow_search
-    from ess import bounds_in_blacklist
-
-    def eval_integral(X, bb):
-        low, high = bb
-        return X[high] - X[low] if high > low else 0
+def approx_sliding_window(
+    slice_data, clf, deltas, selector, scalers, visual_word_mask, top_k=None,
+    score_threshold=None, fold_scalers=True, folded=None):
 
+    results = ResultBuffer(top_k=top_k, score_threshold=score_threshold)
     weights, bias = clf
 
     # Prepare sliced data.
-    fisher_vectors = slice_data.fisher_vectors
-    for scaler in scalers:
-        if scaler is None:
-            continue
-        fisher_vectors = scaler.transform(fisher_vectors)
+    fisher_vectors, weights, l2_visual_word_mask = scale_or_fold(
+        slice_data.fisher_vectors, weights, scalers, visual_word_mask,
+        fold_scalers, folded)
     nr_descriptors_T = slice_data.nr_descriptors[:, np.newaxis]
 
     # Multiply by the number of descriptors.
-    fisher_vectors = fisher_vectors * nr_descriptors_T / np.sum(nr_descriptors_T)
-    slice_vw_counts = slice_data.counts * nr_descriptors_T / np.sum(nr_descriptors_T)
+    fisher_vectors = fisher_vectors * nr_descriptors_T
+    slice_vw_counts = slice_data.counts * nr_descriptors_T
 
     #
-    slice_vw_l2_norms = visual_word_l2_norm(fisher_vectors, visual_word_mask)
+    slice_vw_l2_norms = visual_word_l2_norm(fisher_vectors, l2_visual_word_mask)
     slice_vw_scores = visual_word_scores(fisher_vectors, weights, bias, visual_word_mask)
 
-    assert selector.integral
-
-    slice_vw_l2_norms_no_integral = slice_vw_l2_norms
-    slice_vw_scores_no_integral = slice_vw_scores
-
-    slice_vw_counts = integral(slice_vw_counts)
-    slice_vw_l2_norms = integral(slice_vw_l2_norms)
-    pos_slice_vw_scores = integral(only_positive(slice_vw_scores))
-    neg_slice_vw_scores = integral(only_negative(slice_vw_scores))
-    nr_descriptors_T = integral(nr_descriptors_T)
+    if selector.integral:
+        slice_vw_counts = selector.integral_image(slice_vw_counts, overwrite=True)
+        slice_vw_l2_norms = selector.integral_image(slice_vw_l2_norms, overwrite=True)
+        slice_vw_scores = selector.integral_image(slice_vw_scores, overwrite=True)
+        nr_descriptors_T = selector.integral_image(nr_descriptors_T)
 
     N = fisher_vectors.shape[0]
 
-    def bounding_function(bounds, banned_intervals, weight_by_slice_length):
-
-        union = bounds.get_union()
-        inter = bounds.get_intersection()
+    for delta in deltas:
 
-        if inter[0] == inter[1] == union[0] == union[1] or union[0] >= union[1]:
-            return - np.inf
+        # Build mask.
+        mask = selector.get_mask(N, delta)
+        begin_frame_idxs, end_frame_idxs = selector.get_frame_idxs(N, delta)
 
-        if inter[1] - inter[0] > max(deltas) / selector.chunk:
-            return - np.inf
+        # Approximated predictions.
+        scores = approximate_video_scores(
+            slice_vw_scores, slice_vw_counts, slice_vw_l2_norms, nr_descriptors_T, mask)
+        agg_begin_frames = slice_data.begin_frames[begin_frame_idxs]
+        agg_end_frames = slice_data.end_frames[end_frame_idxs]
 
-        if union[1] - union[0] < min(deltas) / selector.chunk:
-            return - np.inf
+        assert len(scores) == len(agg_begin_frames) == len(agg_end_frames)
 
-        if inter[1] <= inter[0]:
-            counts_union = eval_integral(slice_vw_counts, union)
-            idxs_union = counts_union == 0
-            if np.all(idxs_union):
-                return + np.inf
-            l2_norms_union = np.min(slice_vw_l2_norms_no_integral[union[0]:union[1]], axis=0)
-            scores_union = np.max(slice_vw_scores_no_integral[union[0]:union[1]], axis=0)
-            return ((
-                np.ma.array(scores_union, mask=idxs_union) /
-                np.ma.array(np.sqrt(counts_union), mask=idxs_union)).filled(0).sum() /
-                np.sqrt((
-                    np.ma.array(l2_norms_union, mask=idxs_union) /
-                    np.ma.array(counts_union, mask=idxs_union)).filled(0).sum()))
+        nan_idxs = np.isnan(scores)
+        results.append(
+            agg_begin_frames[~nan_idxs],
+            agg_end_frames[~nan_idxs],
+            scores[~nan_idxs],
+            delta=delta)
 
-        l2_norms_inter = eval_integral(slice_vw_l2_norms, inter)
-        if np.all(l2_norms_inter == 0):
-            return - np.inf
+    return results.to_array()
 
-        if len(banned_intervals) > 0 and bounds_in_blacklist(bounds, banned_intervals):
-            return - np.inf
 
-        score_union = eval_integral(pos_slice_vw_scores, union)
-        score_inter = eval_integral(neg_slice_vw_scores, inter)
+@timer
+def approx_sliding_window_multiclass(
+    slice_data, clfs, deltas, selector, scalers, visual_word_mask, top_k=None,
+    score_threshold=None, fold_scalers=True, folded=None, block_size=1024):
+    """Scores the windows for several classes at once, as `approx_sliding_window`
+    does for each classifier in `clfs`. The window sums of the Fisher vectors,
+    counts and L2 norms do not depend on the class, so they are computed once;
+    the scores of all classes come from a single product of the windowed
+    Fisher vectors, scaled by the inverse square root of their visual word
+    counts, with the stacked weights. As in `exact_sliding_window`, the
+    windows are processed `block_size` at a time, so only a block of windowed
+    Fisher vectors is in memory. The `folded` classifiers, if given, are
+    those of `clfs` (see `fold_classifier`). Returns the results of each
+    class.
 
-        counts_union = eval_integral(slice_vw_counts, union)
-        counts_inter = eval_integral(slice_vw_counts, inter)
+    """
+    results = [
+        ResultBuffer(top_k=top_k, score_threshold=score_threshold)
+        for _ in clfs]
+    weights = np.vstack([ww for ww, _ in clfs])
+    if folded is not None:
+        folded = folded[0]._replace(
+            weights=np.vstack([ff.weights for ff in folded]))
 
-        idxs_inter = counts_inter == 0
-        idxs_union = counts_union == 0
+    # Prepare sliced data.
+    fisher_vectors, weights, l2_visual_word_mask = scale_or_fold(
+        slice_data.fisher_vectors, weights, scalers, visual_word_mask,
+        fold_scalers, folded)
+    nr_descriptors_T = slice_data.nr_descriptors[:, np.newaxis]
 
-        bound_sqrt_scores = np.sum(((
-            np.ma.array(score_union, mask=idxs_union) +
-            np.ma.array(score_inter, mask=idxs_inter)) /
-            np.sqrt(np.ma.array(counts_inter, mask=idxs_inter))).filled(0))
+    # Multiply by the number of descriptors.
+    fisher_vectors = fisher_vectors * nr_descriptors_T
+    slice_vw_counts = slice_data.counts * nr_descriptors_T
+    slice_vw_l2_norms = visual_word_l2_norm(fisher_vectors, l2_visual_word_mask)
 
-        bound_approx_l2_norm = np.sum((
-            np.ma.array(l2_norms_inter, mask=idxs_inter) /
-            np.ma.array(counts_union, mask=idxs_union)).filled(0))
+    N = fisher_vectors.shape[0]
 
-        max_slice_length = union[1] - union[0] if weight_by_slice_length else 1.
-        return bound_sqrt_scores / np.sqrt(bound_approx_l2_norm) * max_slice_length
+    if selector.integral:
+        fisher_vectors = selector.integral_image(fisher_vectors, overwrite=True)
+        slice_vw_counts = selector.integral_image(slice_vw_counts, overwrite=True)
+        slice_vw_l2_norms = selector.integral_image(slice_vw_l2_norms, overwrite=True)
+        nr_descriptors_T = selector.integral_image(nr_descriptors_T)
 
-    banned_intervals = []
-    results = []
-    T = slice_data.end_frames[-1] - slice_data.begin_frames[0]
+    for delta in deltas:
 
-    ii = 0
-    covered = 0
-    heap = [(0, Bounds(np.array((0, 0)), np.array((N, N))))]
+        # Build mask.
+        mask = selector.get_mask(N, delta)
+        begin_frame_idxs, end_frame_idxs = selector.get_frame_idxs(N, delta)
 
-    while True:
+        agg_begin_frames = slice_data.begin_frames[begin_frame_idxs]
+        agg_end_frames = slice_data.end_frames[end_frame_idxs]
 
-        ii += 1
+        assert mask.shape[0] == len(agg_begin_frames) == len(agg_end_frames)
 
-        score, idxs, heap = efficient_subwindow_search(
-            lambda bounds: bounding_function(bounds, banned_intervals, rescore),
-            heap, blacklist=banned_intervals, verbose=2)
+        scores = np.empty((mask.shape[0], len(clfs)))
 
-        banned_intervals.append(idxs)
-        results.append((
-            slice_data.begin_frames[np.minimum(N - 1, idxs[0])],
-            slice_data.begin_frames[idxs[1]] if idxs[1] < N else slice_data.end_frames[-1],
-            score))
+        for ii in xrange(0, mask.shape[0], block_size):
 
-        covered += idxs[1] - idxs[0]
+            block_mask = mask[ii: ii + block_size]
 
-        if covered >= N or score == - np.inf:
-            break
+            # Class independent quantities.
+            agg_nr_descriptors = sum_by(nr_descriptors_T, block_mask)
+            agg_fisher_vectors = sum_by(fisher_vectors, block_mask) / agg_nr_descriptors
+            agg_counts = sum_by(slice_vw_counts, block_mask) / agg_nr_descriptors
+            agg_l2_norms = sum_by(slice_vw_l2_norms, block_mask) / agg_nr_descriptors ** 2
 
-        if results[-1][0] >= results[-1][1]:
-            pdb.set_trace()
+            zero_idxs = agg_counts == 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                inv_sqrt_counts = np.where(zero_idxs, 0, 1. / np.sqrt(agg_counts))
+                approx_l2_norm = np.sum(
+                    np.where(zero_idxs, 0, agg_l2_norms / agg_counts), axis=1)
 
-    return results
+            # Expand the per visual word terms to the Fisher vector dimensions.
+            agg_fisher_vectors *= visual_word_mask.dot(inv_sqrt_counts.T).T
 
+            # Approximated predictions for all classes.
+            scores[ii: ii + block_size] = (
+                - np.dot(agg_fisher_vectors, weights.T)
+                / np.sqrt(approx_l2_norm)[:, np.newaxis])
 
-@timer
-def cy_approx_sliding_window_ess(
-    slice_data, clf, deltas, selector, scalers, rescore, visual_word_mask,
-    timings_file=None):
+        for class_results, class_scores in izip(results, scores.T):
+            nan_idxs = np.isnan(class_scores)
+            class_results.append(
+                agg_begin_frames[~nan_idxs],
+                agg_end_frames[~nan_idxs],
+                class_scores[~nan_idxs],
+                delta=delta)
 
-    start = time.time()
+    return [class_results.to_array() for class_results in results]
 
-    import operator
 
-    from ess import Bounds
-    from ess import efficient_subwindow_search
+def prepare_ess_data(
+    slice_data, clf, scalers, visual_word_mask, fold_scalers=True,
+    folded=None):
+    """Per visual word scores, counts and L2 norms of the slices, together
+    with their integral quantities, as needed by the ESS bounding function.
+    For spatially binned slices (see `load_binned_data_delta_0`) the
+    quantities and the integrals are computed for each slice and bin.
 
-    from utils_ess import ApproxNormsBoundingFunction
-    from utils_ess import b_get_union
-    from utils_ess import b_get_intersection
-    from utils_ess import b_in_blacklist
-    from utils_ess import b_init_bounds
-    from utils_ess import b_init_interval
-    from utils_ess import efficient_subwindow_search as cy_efficient_subwindow_search
+    """
+    from ess import build_approx_norms_data
 
     weights, bias = clf
+    shape = slice_data.nr_descriptors.shape
 
-    # Prepare sliced data.
-    fisher_vectors = slice_data.fisher_vectors
-    for scaler in scalers:
-        if scaler is None:
-            continue
-        fisher_vectors = scaler.transform(fisher_vectors)
-    nr_descriptors_T = slice_data.nr_descriptors[:, np.newaxis]
+    # Prepare sliced data; the bins are processed as extra slices.
+    fisher_vectors, weights, l2_visual_word_mask = scale_or_fold(
+        slice_data.fisher_vectors.reshape(-1, slice_data.fisher_vectors.shape[-1]),
+        weights, scalers, visual_word_mask, fold_scalers, folded)
+    nr_descriptors_T = slice_data.nr_descriptors.reshape(-1, 1)
+    counts = slice_data.counts.reshape(-1, slice_data.counts.shape[-1])
 
     # Multiply by the number of descriptors.
     fisher_vectors = fisher_vectors * nr_descriptors_T / np.sum(nr_descriptors_T)
-    slice_vw_counts = slice_data.counts * nr_descriptors_T / np.sum(nr_descriptors_T)
+    slice_vw_counts = counts * nr_descriptors_T / np.sum(nr_descriptors_T)
 
     #
-    slice_vw_l2_norms = visual_word_l2_norm(fisher_vectors, visual_word_mask)
+    slice_vw_l2_norms = visual_word_l2_norm(fisher_vectors, l2_visual_word_mask)
     slice_vw_scores = visual_word_scores(fisher_vectors, weights, bias, visual_word_mask)
 
-    assert selector.integral
-
-    slice_vw_l2_norms_no_integral = slice_vw_l2_norms
-    slice_vw_scores_no_integral = slice_vw_scores
-
-    slice_vw_counts = integral(slice_vw_counts)
-    slice_vw_l2_norms = integral(slice_vw_l2_norms)
-    pos_slice_vw_scores = integral(only_positive(slice_vw_scores))
-    neg_slice_vw_scores = integral(only_negative(slice_vw_scores))
-    nr_descriptors_T = integral(nr_descriptors_T)
-
-    N = fisher_vectors.shape[0]
-
-    banned_intervals = []
-    results = []
-    T = slice_data.end_frames[-1] - slice_data.begin_frames[0]
-
-    ii = 0
-    covered = 0
-    heap = [(0, b_init_bounds((0, 0), (N, N)))]
-
-    bounding_function = ApproxNormsBoundingFunction(
-        slice_vw_scores_no_integral, slice_vw_l2_norms_no_integral,
-        pos_slice_vw_scores, neg_slice_vw_scores, slice_vw_counts,
-        slice_vw_l2_norms, min_window=min(deltas) / selector.chunk,
-        max_window=max(deltas) / selector.chunk, weight_by_slice_length=rescore)
-
-    ITERATION_TIMINGS.append((-1, time.time() - start))
-
-    while True:
-
-        start = time.time()
+    unflatten = lambda X: np.reshape(X, shape + (-1, ))
+    return build_approx_norms_data(
+        unflatten(slice_vw_scores), unflatten(slice_vw_counts),
+        unflatten(slice_vw_l2_norms), nr_dims=len(shape))
 
-        bounding_function.set_banned_intervals(banned_intervals)
-        score, idxs, heap = cy_efficient_subwindow_search(
-            bounding_function, heap, blacklist=banned_intervals, verbose=0)
 
-        if covered >= N or score == - np.inf:
-            break
+@timer
+def approx_sliding_window_ess(
+    slice_data, clf, deltas, selector, scalers, rescore, visual_word_mask,
+    engine='cython', timings_file=None, prune=False, stats_file=None, top_k=1,
+    node_budget=None, time_budget=None, max_heap_size=None, batch_size=1,
+    ban_spatially=False, tubes_file=None, fold_scalers=True, folded=None):
 
-        banned_intervals.append(b_init_interval(idxs))
-        results.append((
-            slice_data.begin_frames[np.minimum(N - 1, idxs[0])],
-            slice_data.begin_frames[idxs[1]] if idxs[1] < N else slice_data.end_frames[-1],
-            score))
+    from ess import MAX_NR_ITER
+    from ess import approx_norms_ess
 
-        if results[-1][0] >= results[-1][1]:
-            pdb.set_trace()
+    start = time.time()
 
-        covered += idxs[1] - idxs[0]
+    # The timings and the statistics of this call only.
+    iteration_timings = []
+    search_stats = []
 
-        ITERATION_TIMINGS.append((ii, time.time() - start))
+    assert selector.integral
 
-        ii += 1
+    data = prepare_ess_data(
+        slice_data, clf, scalers, visual_word_mask, fold_scalers=fold_scalers,
+        folded=folded)
+    N = data.slice_vw_scores.shape[0]
+
+    iteration_timings.append((-1, time.time() - start))
+
+    detections = approx_norms_ess(
+        data, min_window=min(deltas) / selector.chunk,
+        max_window=max(deltas) / selector.chunk,
+        weight_by_slice_length=rescore, engine=engine, top_k=top_k,
+        prune=prune, batch_size=batch_size,
+        max_nr_iter=node_budget or MAX_NR_ITER, time_budget=time_budget,
+        max_heap_size=max_heap_size, ban_spatially=ban_spatially,
+        stats=search_stats, timings=iteration_timings)
+
+    scores = np.array([score for score, _ in detections], dtype=np.float64)
+    idxs = np.array(
+        [idxs for _, idxs in detections] or [(0, 0)], dtype=np.int)[: len(detections)]
+
+    begin_frames = slice_data.begin_frames[np.minimum(N - 1, idxs[:, 0])]
+    end_frames = np.where(
+        idxs[:, 1] < N,
+        slice_data.begin_frames[np.minimum(N - 1, idxs[:, 1])],
+        slice_data.end_frames[-1])
+
+    results = ResultBuffer()
+    results.append(begin_frames, end_frames, scores)
+
+    # The results keep only the temporal extent; the spatial bins of the
+    # tubes are dumped separately.
+    if tubes_file is not None:
+        with open(tubes_file, 'w') as ff:
+            for begin, end, bins, score in izip(
+                begin_frames, end_frames, idxs[:, 2:], scores):
+                ff.write("%d %d %s %f\n" % (
+                    begin, end, ' '.join(map(str, bins)), score))
 
     if timings_file is not None:
         with open(timings_file, 'w') as ff:
-            for ii, tt in ITERATION_TIMINGS:
+            for ii, tt in iteration_timings:
                 ff.write("%4d %f\n" % (ii, tt))
 
-    return results
+    if stats_file is not None:
+        write_search_stats(stats_file, search_stats)
+
+    return results.to_array()
 
 
 def save_results(dataset, class_idx, adrien_results, deltas=None):
@@ -697,16 +981,18 @@ def save_results(dataset, class_idx, adrien_results, deltas=None):
             cPickle.dump(list(res), ff)
 
 
-@my_cacher('cp')
-def evaluation(
-    algo_type, src_cfg, class_idx, stride, deltas, no_integral, containing,
-    rescore, timings_file, outfile=None, verbose=0):
+def get_algo_params(
+    visual_word_mask, rescore=False, timings_file=None, prune_heap=False,
+    stats_file=None, top_k=1, search_budget=None, tubes_file=None,
+    ban_spatially=False, nr_spatial_bins=None):
+    """Returns the train normalizations and the sliding window function (with
+    its parameters) for each type of algorithm. The tubes are searched over
+    the `nr_spatial_bins` horizontal bins of the slices (see
+    `spatial_nr_bins`).
 
-    dataset = Dataset(CFG[src_cfg]['dataset_name'], **CFG[src_cfg]['dataset_params'])
-    D, K = dataset.D, dataset.VOC_SIZE
-    visual_word_mask = build_visual_word_mask(D, K)
-
-    ALGO_PARAMS = {
+    """
+    search_budget = search_budget or {}
+    return {
         'none': {
             'train_params': {
                 'l2_norm_type': 'none',
@@ -769,6 +1055,25 @@ def evaluation(
                 'sqrt_type': 'none'
             },
         },
+        'exact_L2.gram': {
+            'train_params': {
+                'l2_norm_type': 'exact',
+                'empirical_standardizations': [False, False],
+                'sqrt_type': 'none'
+            },
+            'sliding_window': exact_sliding_window_gram,
+            'sliding_window_params': {},
+        },
+        'exact_L2+e_std_1.gram': {
+            'train_params': {
+                'analytical_fim': False,
+                'l2_norm_type': 'exact',
+                'empirical_standardizations': [True, False],
+                'sqrt_type': 'none'
+            },
+            'sliding_window': exact_sliding_window_gram,
+            'sliding_window_params': {},
+        },
         'exact_sqrt': {
             'train_params': {
                 'l2_norm_type': 'none',
@@ -864,6 +1169,15 @@ def evaluation(
             'sliding_window_params': {
                 'visual_word_mask': visual_word_mask,
                 'rescore': rescore,
+                'engine': 'python',
+                'timings_file': timings_file,
+                'prune': prune_heap,
+                'stats_file': stats_file,
+                'top_k': top_k,
+                'node_budget': search_budget.get('node_budget'),
+                'time_budget': search_budget.get('time_budget'),
+                'max_heap_size': search_budget.get('max_heap_size'),
+                'batch_size': search_budget.get('batch_size', 1),
             },
         },
         'cy_approx_ess': {
@@ -872,11 +1186,19 @@ def evaluation(
                 'empirical_standardizations': [False, True],
                 'sqrt_type': 'approx'
             },
-            'sliding_window': cy_approx_sliding_window_ess,
+            'sliding_window': approx_sliding_window_ess,
             'sliding_window_params': {
                 'visual_word_mask': visual_word_mask,
                 'rescore': rescore,
+                'engine': 'cython',
                 'timings_file': timings_file,
+                'prune': prune_heap,
+                'stats_file': stats_file,
+                'top_k': top_k,
+                'node_budget': search_budget.get('node_budget'),
+                'time_budget': search_budget.get('time_budget'),
+                'max_heap_size': search_budget.get('max_heap_size'),
+                'batch_size': search_budget.get('batch_size', 1),
             },
         },
         'cy_approx_ess+e_std_1': {
@@ -886,81 +1208,638 @@ def evaluation(
                 'empirical_standardizations': [True, True],
                 'sqrt_type': 'approx'
             },
-            'sliding_window': cy_approx_sliding_window_ess,
+            'sliding_window': approx_sliding_window_ess,
             'sliding_window_params': {
                 'visual_word_mask': visual_word_mask,
                 'rescore': rescore,
+                'engine': 'cython',
                 'timings_file': timings_file,
+                'prune': prune_heap,
+                'stats_file': stats_file,
+                'top_k': top_k,
+                'node_budget': search_budget.get('node_budget'),
+                'time_budget': search_budget.get('time_budget'),
+                'max_heap_size': search_budget.get('max_heap_size'),
+                'batch_size': search_budget.get('batch_size', 1),
+            },
+        },
+        'approx_tube_ess': {
+            'train_params': {
+                'l2_norm_type': 'approx',
+                'empirical_standardizations': [False, True],
+                'sqrt_type': 'approx'
+            },
+            'nr_bins': nr_spatial_bins,
+            'sliding_window': approx_sliding_window_ess,
+            'sliding_window_params': {
+                'visual_word_mask': visual_word_mask,
+                'rescore': rescore,
+                'engine': 'python',
+                'timings_file': timings_file,
+                'stats_file': stats_file,
+                'node_budget': search_budget.get('node_budget'),
+                'time_budget': search_budget.get('time_budget'),
+                'max_heap_size': search_budget.get('max_heap_size'),
+                'ban_spatially': ban_spatially,
+                'tubes_file': tubes_file,
             },
         },
-
     }
 
-    chunk_size = CFG[src_cfg]['chunk_size']
-    base_chunk_size = mgcd(stride, *deltas)
-    tr_nr_agg = base_chunk_size / chunk_size
 
+# The sliding windows that can fold the scalers into the weights.
+FOLDING_SLIDING_WINDOWS = (
+    exact_sliding_window_no_sqrt_no_l2, approx_sliding_window,
+    approx_sliding_window_ess)
+
+
+def check_scaler_folding(D=4, K=8, nr_slices=120, chunk=5, seed=0):
+    """Checks on random data that folding the scalers into the weights gives
+    the same results as scaling the slices, for each algorithm that folds
+    them (and for the multi-class approximate scorer).
+
+    """
+    rng = np.random.RandomState(seed)
+    FV_LEN = 2 * D * K
+
+    nr_descriptors = rng.randint(0, 50, nr_slices).astype(np.float64)
+    nr_descriptors[rng.rand(nr_slices) < 0.1] = 0
+    slice_data = SliceData(
+        rng.randn(nr_slices, FV_LEN).astype(np.float32),
+        rng.rand(nr_slices, K).astype(np.float32),
+        nr_descriptors,
+        np.arange(nr_slices) * chunk,
+        np.arange(nr_slices) * chunk + chunk - 1)
+
+    scalers = [
+        DiagonalScaler().fit(rng.randn(200, FV_LEN) * rng.rand(FV_LEN) * 10),
+        DiagonalScaler().fit(rng.randn(200, FV_LEN) * rng.rand(FV_LEN))]
+    clfs = [(rng.randn(1, FV_LEN), rng.randn(1)) for _ in xrange(3)]
+
+    visual_word_mask = build_visual_word_mask(D, K)
+    selector = OverlappingSelector(chunk, chunk, False, integral=True)
+    deltas = [4 * chunk, 8 * chunk, 12 * chunk]
+
+    def same(results_1, results_2):
+        return (
+            len(results_1) == len(results_2) and
+            np.all(results_1['begin'] == results_2['begin']) and
+            np.all(results_1['end'] == results_2['end']) and
+            np.allclose(results_1['score'], results_2['score'], rtol=1e-4))
+
+    # The scaled slices are the reference, so they are computed in float64;
+    # scaling the float32 slices loses more precision than the folding.
+    reference_data = slice_data._replace(
+        fisher_vectors=slice_data.fisher_vectors.astype(np.float64))
+
+    all_ok = True
+    for algo_type, algo_params in sorted(get_algo_params(visual_word_mask).items()):
+
+        if algo_params['sliding_window'] not in FOLDING_SLIDING_WINDOWS:
+            continue
+        if 'nr_bins' in algo_params:
+            continue
+
+        sliding_window_params = algo_params['sliding_window_params'].copy()
+        if 'engine' in sliding_window_params:
+            sliding_window_params['engine'] = 'python'
+
+        folded, scaled = [
+            algo_params['sliding_window'](
+                data, clfs[0], deltas, selector, scalers,
+                fold_scalers=fold_scalers, folded=folding,
+                **sliding_window_params)
+            for data, fold_scalers, folding in (
+                (slice_data, True,
+                 fold_classifier(clfs[0][0], scalers, visual_word_mask)),
+                (reference_data, False, None))]
+
+        ok = same(folded, scaled)
+        all_ok &= ok
+        print "%-25s %s" % (algo_type, 'ok' if ok else 'MISMATCH')
+
+    folded = approx_sliding_window_multiclass(
+        slice_data, clfs, deltas, selector, scalers, visual_word_mask,
+        folded=[fold_classifier(ww, scalers, visual_word_mask) for ww, _ in clfs])
+    scaled = [
+        approx_sliding_window(
+            reference_data, clf, deltas, selector, scalers, visual_word_mask,
+            fold_scalers=False)
+        for clf in clfs]
+
+    ok = all(same(ff, ss) for ff, ss in izip(folded, scaled))
+    all_ok &= ok
+    print "%-25s %s" % ('multiclass approx', 'ok' if ok else 'MISMATCH')
+
+    return all_ok
+
+
+def check_gram_l2(D=4, K=8, nr_slices=120, chunk=5, seed=0):
+    """Checks on random data that `exact_sliding_window_gram` gives the same
+    results as `exact_sliding_window` with the exact L2 normalization, with
+    and without integral images (stored in blocks or not) and scalers.
+
+    """
+    rng = np.random.RandomState(seed)
+    FV_LEN = 2 * D * K
+
+    nr_descriptors = rng.randint(0, 50, nr_slices).astype(np.float64)
+    nr_descriptors[rng.rand(nr_slices) < 0.1] = 0
+    slice_data = SliceData(
+        rng.randn(nr_slices, FV_LEN).astype(np.float32),
+        rng.rand(nr_slices, K).astype(np.float32),
+        nr_descriptors,
+        np.arange(nr_slices) * chunk,
+        np.arange(nr_slices) * chunk + chunk - 1)
+
+    clf = rng.randn(1, FV_LEN), rng.randn(1)
+    deltas = [4 * chunk, 8 * chunk, 12 * chunk]
+
+    all_ok = True
+    for integral, block_size in ((True, 1), (True, 4), (False, 1)):
+        for with_scaler in (False, True):
+
+            scaler = DiagonalScaler().fit(rng.randn(200, FV_LEN) * rng.rand(FV_LEN) * 10)
+            scalers = [scaler if with_scaler else None, None]
+            selector = OverlappingSelector(
+                chunk, chunk, False, integral=integral,
+                integral_block_size=block_size)
+
+            gram = exact_sliding_window_gram(
+                slice_data, clf, deltas, selector, scalers)
+            exact = exact_sliding_window(
+                slice_data, clf, deltas, selector, scalers, sqrt_type='none',
+                l2_norm_type='exact')
+
+            ok = (
+                len(gram) == len(exact) and
+                np.all(gram['begin'] == exact['begin']) and
+                np.all(gram['end'] == exact['end']) and
+                np.allclose(gram['score'], exact['score'], rtol=1e-4))
+            all_ok &= ok
+            print "integral %-5s block %d scaler %-5s %s" % (
+                integral, block_size, with_scaler, 'ok' if ok else 'MISMATCH')
+
+    return all_ok
+
+
+WORKER_CONTEXT = {}
+
+
+def init_detection_worker(context):
+    WORKER_CONTEXT.clear()
+    WORKER_CONTEXT.update(context)
+
+
+def load_aggregated_slice_data(
+    ctx, movie, part, class_idx, analytical_fim, nr_bins):
+    """Loads the slices of a part of a test movie and aggregates them into
+    non-overlapping chunks of size `base_chunk_size`.
+
+    """
+    afim_suffix = '_no_afim' if not analytical_fim else ''
+    te_outfile = (
+        '/scratch2/clear/oneata/tmp/joblib/%s_cls%d_movie%s_part%d%s_test.dat' %
+        (ctx['src_cfg'], class_idx, movie, part, afim_suffix))
+    if ctx['quantize'] and nr_bins == 1:
+        codes, scales, counts, nr_descs, begin_frames, end_frames = load_quantized_data_delta_0(
+            ctx['dataset'], movie, part, class_idx,
+            delta_0=ctx['chunk_size'], analytical_fim=analytical_fim,
+            raw_outfile=te_outfile,
+            outfile=te_outfile.replace('_test.dat', '_int8_test.dat'))
+        te_slice_data = SliceData(
+            QuantizedFisherVectors(codes, scales), counts, nr_descs,
+            begin_frames, end_frames)
+        # The quantized slices are not copied if there is nothing to aggregate.
+        if ctx['non_overlapping_selector'].nr_agg == 1:
+            return te_slice_data
+        aggregate_slices = aggregate_quantized
+    elif nr_bins > 1:
+        te_slice_data = SliceData(*load_binned_data_delta_0(
+            ctx['dataset'], movie, part, class_idx,
+            nr_bins=nr_bins, delta_0=ctx['chunk_size'],
+            analytical_fim=analytical_fim,
+            outfile=te_outfile.replace('_test.dat', '_bins%d_test.dat' % nr_bins)))
+        aggregate_slices = aggregate_binned
+    else:
+        te_slice_data = SliceData(*load_data_delta_0(
+            ctx['dataset'], movie, part, class_idx,
+            delta_0=ctx['chunk_size'], analytical_fim=analytical_fim,
+            outfile=te_outfile))
+        aggregate_slices = aggregate
+
+    if ctx['verbose'] > 1:
+        print "Aggregating data."
+
+    N = te_slice_data.fisher_vectors.shape[0]
+    agg_slice_data = aggregate_slices(
+        te_slice_data,
+        ctx['non_overlapping_selector'].get_mask(N),
+        ctx['non_overlapping_selector'].get_frame_idxs(N))
+
+    # Keep only the Fisher vector blocks of the active visual words.
+    if ctx['block_sparse'] and nr_bins == 1:
+        agg_slice_data = agg_slice_data._replace(
+            fisher_vectors=BlockSparseFisherVectors.from_dense(
+                agg_slice_data.fisher_vectors, agg_slice_data.counts))
+
+    return agg_slice_data
+
+
+def detection_worker((movie, class_parts)):
+    """Runs the sliding window (or ESS) of each algorithm on a part of a test
+    movie, using the data shared through `init_detection_worker`. The part is
+    shared by the classes in `class_parts`, a list of `(class_idx, part)`.
+    The slice data is loaded once for the algorithms that use the same
+    features, and the `approx` algorithms score all classes at once. Only
+    `approx_sliding_window` scores the quantized or block sparse slices
+    directly; the other algorithms get them as arrays.
+
+    """
+    ctx = WORKER_CONTEXT
+    parts = dict(class_parts)
+    agg_slice_data = {}
+    results = [None] * len(ctx['algorithms'])
+
+    # The algorithms that differ only through the classifier.
+    groups = {}
+    for ii, algo_ctx in enumerate(ctx['algorithms']):
+        if algo_ctx['class_idx'] in parts:
+            key = algo_ctx['algo_type'], id(algo_ctx['scalers'])
+            groups.setdefault(key, []).append(ii)
+
+    for idxs in sorted(groups.values()):
+
+        algo_ctx = ctx['algorithms'][idxs[0]]
+        part = parts[algo_ctx['class_idx']]
+        sliding_window_params = algo_ctx['sliding_window_params'].copy()
+
+        # Each job writes its own timings, statistics and tubes.
+        for key in ('timings_file', 'stats_file', 'tubes_file'):
+            if sliding_window_params.get(key) is not None:
+                sliding_window_params[key] += '.%s_part%d' % (movie, part)
+
+        # The exhaustive sliding windows can retain only the best candidates.
+        if 'ess' not in algo_ctx['algo_type']:
+            sliding_window_params.update(ctx['retention'])
+
+        key = algo_ctx['analytical_fim'], algo_ctx['nr_bins']
+        if key not in agg_slice_data:
+            agg_slice_data[key] = load_aggregated_slice_data(
+                ctx, movie, part, algo_ctx['class_idx'], *key)
+
+        compact = isinstance(
+            agg_slice_data[key].fisher_vectors, COMPACT_FISHER_VECTORS)
+        if compact and algo_ctx['sliding_window'] is not approx_sliding_window:
+            key = key + ('dense', )
+            if key not in agg_slice_data:
+                agg_slice_data[key] = agg_slice_data[key[: -1]]._replace(
+                    fisher_vectors=agg_slice_data[key[: -1]].fisher_vectors.to_dense())
+            compact = False
+
+        if ctx['verbose'] > 1:
+            print "Starting the sliding window", algo_ctx['algo_type'], movie, part
+
+        if (algo_ctx['sliding_window'] is approx_sliding_window and
+            len(idxs) > 1 and not compact):
+            group_results = approx_sliding_window_multiclass(
+                agg_slice_data[key],
+                [ctx['algorithms'][ii]['clf'] for ii in idxs], ctx['deltas'],
+                ctx['overlapping_selector'], algo_ctx['scalers'],
+                folded=[ctx['algorithms'][ii]['folded'] for ii in idxs],
+                **sliding_window_params)
+        else:
+            group_results = []
+            for ii in idxs:
+                # The scalers folded into the classifier at train time.
+                params = sliding_window_params
+                if ctx['algorithms'][ii]['folded'] is not None:
+                    params = dict(params, folded=ctx['algorithms'][ii]['folded'])
+                group_results.append(ctx['algorithms'][ii]['sliding_window'](
+                    agg_slice_data[key], ctx['algorithms'][ii]['clf'],
+                    ctx['deltas'], ctx['overlapping_selector'],
+                    algo_ctx['scalers'], **params))
+
+        for ii, algo_results in izip(idxs, group_results):
+            algo_results['movie'] = ctx['movies'].index(movie)
+            results[ii] = algo_results
+
+    return results
+
+
+def nms_worker((movie_results, delta, min_slice, max_slice)):
+    # The zero-overlap NMS works on tuples; the other columns are recovered
+    # from the window's frames.
+    selected = non_maxima_supression_0(
+        to_tuples(movie_results), delta, min_slice, max_slice)
+    idxs = {
+        (begin, end): ii for ii, (begin, end) in enumerate(izip(
+            movie_results['begin'].tolist(), movie_results['end'].tolist()))}
+    results = movie_results[[idxs[begin, end] for begin, end, _ in selected]]
+    results['score'] = [score for _, _, score in selected]
+    return results
+
+
+def nms_iou_worker((movie_results, overlap, soft)):
+    if soft is not None:
+        return soft_non_maxima_supression(movie_results, overlap, method=soft)
+    else:
+        return non_maxima_supression(movie_results, overlap)
+
+
+def train_nr_agg(src_cfg, stride, deltas):
+    """Number of slices aggregated in the train data, to match the base
+    chunk of the sliding windows.
+
+    """
     # For the old C&C features I have one FV for the entire sample for the
     # train data, so I cannot aggregate.
     if src_cfg == 'cc':
-        tr_nr_agg = 1
+        return 1
+    return mgcd(stride, *deltas) / CFG[src_cfg]['chunk_size']
+
+
+def train_recipe_file(src_cfg, stride, deltas, train_params):
+    """Cache of the train data normalized according to `train_params`. The
+    train data contains all the classes, so the cache is shared by them.
+
+    """
+    train_params = train_params.copy()
+    analytical_fim = train_params.pop('analytical_fim', True)
+    afim_suffix = '_no_afim' if not analytical_fim else ''
+    return normalization_recipe_file(
+        '/scratch2/clear/oneata/tmp/joblib/%s_train%s.dat' % (src_cfg, afim_suffix),
+        train_nr_agg(src_cfg, stride, deltas), analytical_fim=analytical_fim,
+        **train_params)
+
+
+def detector_file(src_cfg, class_idx, recipe_file, classifier='dual'):
+    """Cache of the classifier of a class trained on the normalized data."""
+    if classifier != 'dual':
+        return '%s.clf_cls%d_%s_C%g' % (
+            recipe_file, class_idx, classifier, primal_C(src_cfg))
+    return '%s.clf_cls%d_%s' % (recipe_file, class_idx, recipe_hash(
+        CFG[src_cfg]['eval_name'], sorted(CFG[src_cfg]['eval_params'].items())))
+
+
+def load_train_data(
+    dataset, src_cfg, class_idx, stride, deltas, train_params, verbose=0):
+    """Loads the normalized train data, aggregated to match the base chunk
+    of the sliding windows.
+
+    """
+    train_params = train_params.copy()
+    analytical_fim = train_params.pop('analytical_fim', True)
 
-    analytical_fim = ALGO_PARAMS[algo_type]['train_params'].pop('analytical_fim', True)
     afim_suffix = '_no_afim' if not analytical_fim else ''
     tr_outfile = '/scratch2/clear/oneata/tmp/joblib/%s_cls%d_train%s.dat' % (
         src_cfg, class_idx, afim_suffix)
-    tr_video_data, tr_video_labels, tr_stds = load_normalized_tr_data(
-        dataset, tr_nr_agg, tr_outfile=tr_outfile, verbose=verbose,
-        analytical_fim=analytical_fim,
-        **ALGO_PARAMS[algo_type]['train_params'])
 
+    return load_normalized_tr_data(
+        dataset, train_nr_agg(src_cfg, stride, deltas), tr_outfile=tr_outfile,
+        verbose=verbose, analytical_fim=analytical_fim,
+        recipe_outfile=train_recipe_file(
+            src_cfg, stride, deltas, dict(train_params, analytical_fim=analytical_fim)),
+        **train_params)
+
+
+@my_cacher('np', 'np')
+def train_detector(
+    src_cfg, class_idx, tr_video_data, tr_video_labels, classifier='dual',
+    outfile=None):
+    """Trains the one-vs-null classifier of a class and returns its weights
+    and bias. The `dual` classifier is the kernel SVM of the configuration;
+    the others are trained in the primal (see `fit_primal_classifiers`).
+
+    """
     # Sub-sample data.
     no_tuple_labels = np.array([ll[0] for ll in tr_video_labels])
     idxs = (no_tuple_labels == class_idx) | (no_tuple_labels == NULL_CLASS_IDX)
     binary_labels = (no_tuple_labels[idxs] == class_idx) * 2 - 1
     class_tr_video_data = tr_video_data[idxs]
+
+    if classifier != 'dual':
+        return fit_primal_classifiers(
+            class_tr_video_data, binary_labels, classifier=classifier,
+            C=primal_C(src_cfg))
+
     tr_kernel = np.dot(class_tr_video_data, class_tr_video_data.T)
 
     eval = Evaluation(CFG[src_cfg]['eval_name'], **CFG[src_cfg]['eval_params'])
     eval.fit(tr_kernel, binary_labels)
-    clf = compute_weights(eval.get_classifier(), class_tr_video_data)
+    return compute_weights(eval.get_classifier(), class_tr_video_data)
+
+
+def train_key(algo_params):
+    """The algorithms with the same train parameters share the train data."""
+    return tuple(sorted(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in algo_params['train_params'].iteritems()))
+
+
+def run_detection(
+    dataset, src_cfg, stride, deltas, no_integral, containing, algorithms,
+    retention=None, quantize=False, block_sparse=False, integral_params=None,
+    nr_processes=1, verbose=0):
+    """Runs the detection with each of the given algorithms, specified as
+    dictionaries with the keys `algo_type`, `class_idx`, `clf`, `scalers`,
+    `folded`, `analytical_fim`, `nr_bins`, `sliding_window` and
+    `sliding_window_params` (see `algorithm_context`). Returns a dictionary
+    of results indexed by movie for each algorithm. If `quantize`, the test
+    slices are cached and scored quantized (see `QuantizedFisherVectors`);
+    if `block_sparse`, only their active visual words are kept (see
+    `BlockSparseFisherVectors`). The `integral_params` set how the integral
+    images are stored (see `OverlappingSelector`).
+
+    """
+    chunk_size = CFG[src_cfg]['chunk_size']
+    base_chunk_size = mgcd(stride, *deltas)
 
-    results = {}
-    class_name = dataset.IDX2CLS[class_idx]
     non_overlapping_selector = NonOverlappingSelector(base_chunk_size / chunk_size)
     overlapping_selector = OverlappingSelector(
         base_chunk_size, stride, containing,
-        integral=(not no_integral))
+        integral=(not no_integral), **(integral_params or {}))
+
+    # The classifiers and the rest of the shared data are passed once to each
+    # worker; the jobs only specify which part of which movie to process.
+    context = {
+        'dataset': dataset,
+        'src_cfg': src_cfg,
+        'chunk_size': chunk_size,
+        'deltas': deltas,
+        'non_overlapping_selector': non_overlapping_selector,
+        'overlapping_selector': overlapping_selector,
+        'algorithms': algorithms,
+        'movies': list(dataset.TE_MOVIES),
+        'retention': retention or {},
+        'quantize': quantize,
+        'block_sparse': block_sparse,
+        'nr_processes': nr_processes,
+        'verbose': verbose,
+    }
 
-    for movie in dataset.TE_MOVIES:
-        results[movie] = []
-        for part in xrange(len(dataset.CLASS_LIMITS[movie][class_name])):
-            te_outfile = (
-                '/scratch2/clear/oneata/tmp/joblib/%s_cls%d_movie%s_part%d%s_test.dat' %
-                (src_cfg, class_idx, movie, part, afim_suffix))
-            te_slice_data = SliceData(*load_data_delta_0(
-                dataset, movie, part, class_idx, delta_0=chunk_size,
-                analytical_fim=analytical_fim, outfile=te_outfile))
-            pdb.set_trace()
+    # The classes whose movie parts have the same limits share a job.
+    class_idxs = sorted(set(algo_ctx['class_idx'] for algo_ctx in algorithms))
+    job_idxs = {}
+    jobs = []
+    for class_idx in class_idxs:
+        class_name = dataset.IDX2CLS[class_idx]
+        for movie in dataset.TE_MOVIES:
+            for part, limits in enumerate(dataset.CLASS_LIMITS[movie][class_name]):
+                key = movie, tuple(limits)
+                if key not in job_idxs:
+                    job_idxs[key] = len(jobs)
+                    jobs.append((movie, []))
+                jobs[job_idxs[key]][1].append((class_idx, part))
+
+    if nr_processes > 1:
+        pool = Pool(
+            nr_processes, initializer=init_detection_worker,
+            initargs=(context, ))
+        jobs_results = pool.map(detection_worker, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        init_detection_worker(context)
+        jobs_results = map(detection_worker, jobs)
+
+    # Merge the results in the order of the jobs, so that they do not depend
+    # on the number of processes. The parts of a movie are merged and their
+    # candidates selected again.
+    all_results = []
+    for ii in xrange(len(algorithms)):
+        results = {movie: [] for movie in dataset.TE_MOVIES}
+        for (movie, _), job_results in izip(jobs, jobs_results):
+            if job_results[ii] is not None:
+                results[movie].append(job_results[ii])
+        all_results.append({
+            movie: select_top(concatenate_results(movie_results), **(retention or {}))
+            for movie, movie_results in results.iteritems()})
+
+    return all_results
+
+
+def algorithm_context(algo_type, algo_params, class_idx, clf, scalers):
+    assert algo_params.get('nr_bins', 1) is not None, (
+        "The %s algorithm needs slices split in horizontal spatial bins, "
+        "given by a `(1, H, 1)` entry of `spms` in the dataset config." % algo_type)
+    # Fold the scalers into the classifier once, instead of for each movie.
+    folded = None
+    if algo_params['sliding_window'] in FOLDING_SLIDING_WINDOWS:
+        folded = fold_classifier(
+            clf[0], scalers,
+            algo_params['sliding_window_params']['visual_word_mask'])
+    return {
+        'algo_type': algo_type,
+        'class_idx': class_idx,
+        'clf': clf,
+        'scalers': scalers,
+        'folded': folded,
+        'analytical_fim': algo_params['train_params'].get('analytical_fim', True),
+        'nr_bins': algo_params.get('nr_bins', 1),
+        'sliding_window': algo_params['sliding_window'],
+        'sliding_window_params': algo_params['sliding_window_params'],
+    }
 
-            if verbose > 1:
-                print "Aggregating data."
 
-            # Aggregate data into non-overlapping chunks of size `base_chunk_size`.
-            N = te_slice_data.fisher_vectors.shape[0]
-            agg_slice_data = aggregate(
-                te_slice_data,
-                non_overlapping_selector.get_mask(N),
-                non_overlapping_selector.get_frame_idxs(N))
+@my_cacher('cp')
+def evaluation(
+    algo_type, src_cfg, class_idx, stride, deltas, no_integral, containing,
+    rescore, timings_file, prune_heap=False, stats_file=None, top_k=1,
+    search_budget=None, tubes_file=None, ban_spatially=False, retention=None,
+    classifier='dual', quantize=False, block_sparse=False,
+    integral_params=None, nr_processes=1, outfile=None, verbose=0):
 
-            if verbose > 1:
-                print "Starting the sliding window", algo_type
+    dataset = Dataset(CFG[src_cfg]['dataset_name'], **CFG[src_cfg]['dataset_params'])
+    D, K = dataset.D, dataset.VOC_SIZE
+    visual_word_mask = build_visual_word_mask(D, K)
 
-            results[movie] += ALGO_PARAMS[algo_type]['sliding_window'](
-                agg_slice_data, clf, deltas, overlapping_selector, tr_stds,
-                **ALGO_PARAMS[algo_type]['sliding_window_params'])
+    ALGO_PARAMS = get_algo_params(
+        visual_word_mask, rescore=rescore, timings_file=timings_file,
+        prune_heap=prune_heap, stats_file=stats_file, top_k=top_k,
+        search_budget=search_budget, tubes_file=tubes_file,
+        ban_spatially=ban_spatially, nr_spatial_bins=spatial_nr_bins(src_cfg))
+
+    tr_video_data, tr_video_labels, tr_stds = load_train_data(
+        dataset, src_cfg, class_idx, stride, deltas,
+        ALGO_PARAMS[algo_type]['train_params'], verbose=verbose)
+    clf = train_detector(
+        src_cfg, class_idx, tr_video_data, tr_video_labels,
+        classifier=classifier,
+        outfile=detector_file(src_cfg, class_idx, train_recipe_file(
+            src_cfg, stride, deltas, ALGO_PARAMS[algo_type]['train_params']),
+            classifier))
+
+    return run_detection(
+        dataset, src_cfg, stride, deltas, no_integral, containing,
+        [algorithm_context(
+            algo_type, ALGO_PARAMS[algo_type], class_idx, clf, tr_stds)],
+        retention=retention, quantize=quantize, block_sparse=block_sparse,
+        integral_params=integral_params, nr_processes=nr_processes,
+        verbose=verbose)
+
+
+def sweep_evaluation(
+    algo_types, src_cfg, class_idxs, stride, deltas, no_integral, containing,
+    rescore, outfiles, prune_heap=False, top_k=1, search_budget=None,
+    retention=None, classifier='dual', quantize=False, block_sparse=False,
+    integral_params=None, nr_processes=1, verbose=0):
+    """Runs `evaluation` for each class and algorithm while loading the
+    train data once for each set of train parameters and the slice data of
+    each movie part once for all the algorithms and the classes that share
+    it. The results are stored in `outfiles[class_idx, algo_type]`, in the
+    format of `evaluation`; the pairs whose results file exists are skipped.
 
-    return [results]
+    """
+    dataset = Dataset(CFG[src_cfg]['dataset_name'], **CFG[src_cfg]['dataset_params'])
+    D, K = dataset.D, dataset.VOC_SIZE
+    visual_word_mask = build_visual_word_mask(D, K)
+
+    # The timings and statistics files are specific to a single run.
+    ALGO_PARAMS = get_algo_params(
+        visual_word_mask, rescore=rescore, prune_heap=prune_heap, top_k=top_k,
+        search_budget=search_budget, nr_spatial_bins=spatial_nr_bins(src_cfg))
+
+    todo = [
+        (class_idx, algo_type)
+        for class_idx in class_idxs
+        for algo_type in algo_types
+        if not os.path.exists(outfiles[class_idx, algo_type])]
+
+    # The train data includes all the classes, so it is normalized once for
+    # all of them; only the classifiers are trained for each class.
+    classifiers = {}
+    for key in set(train_key(ALGO_PARAMS[algo_type]) for _, algo_type in todo):
+
+        algo_type = next(aa for _, aa in todo if train_key(ALGO_PARAMS[aa]) == key)
+        tr_video_data, tr_video_labels, tr_stds = load_train_data(
+            dataset, src_cfg, class_idxs[0], stride, deltas,
+            ALGO_PARAMS[algo_type]['train_params'], verbose=verbose)
+
+        for class_idx in set(cc for cc, aa in todo if train_key(ALGO_PARAMS[aa]) == key):
+            clf = train_detector(
+                src_cfg, class_idx, tr_video_data, tr_video_labels,
+                classifier=classifier,
+                outfile=detector_file(src_cfg, class_idx, train_recipe_file(
+                    src_cfg, stride, deltas, ALGO_PARAMS[algo_type]['train_params']),
+                    classifier))
+            classifiers[class_idx, key] = clf, tr_stds
+
+    algorithms = [
+        algorithm_context(
+            algo_type, ALGO_PARAMS[algo_type], class_idx,
+            *classifiers[class_idx, train_key(ALGO_PARAMS[algo_type])])
+        for class_idx, algo_type in todo]
+
+    all_results = run_detection(
+        dataset, src_cfg, stride, deltas, no_integral, containing, algorithms,
+        retention=retention, quantize=quantize, block_sparse=block_sparse,
+        integral_params=integral_params, nr_processes=nr_processes,
+        verbose=verbose)
+
+    for (class_idx, algo_type), results in izip(todo, all_results):
+        with open(outfiles[class_idx, algo_type], 'w') as ff:
+            cPickle.dump(results, ff)
 
 
 def main():
@@ -971,11 +1850,12 @@ def main():
         dd for dd in CFG.keys()
         if dd.startswith('cc') or dd.startswith('duch09')]
     parser.add_argument(
-        '-d', '--dataset', required=True, choices=detection_dataset,
+        '-d', '--dataset', choices=detection_dataset,
         help="which dataset.")
     parser.add_argument(
-        '-a', '--algorithm', required=True,
-        help="specifies the type of normalizations.")
+        '-a', '--algorithm', nargs='+',
+        help=("specifies the type of normalizations; for multiple algorithms "
+              "(or classes) the data is loaded once for all of them."))
     parser.add_argument(
         '--rescore', action='store_true', default=False,
         help="rescores the slices according to their length.")
@@ -986,21 +1866,103 @@ def main():
               "considers the FVs corresponding to the dense trajectories that "
               "start in the given window."))
     parser.add_argument(
-        '--class_idx', default=1, type=int,
-        help="index of the class to evaluate.")
+        '--class_idx', default=[1], type=int, nargs='+',
+        help="indices of the classes to evaluate.")
     parser.add_argument(
         '--no_integral', action='store_true', default=False,
         help="does not use integral quantities for aggregation.")
+    parser.add_argument(
+        '--integral_block_size', type=int, default=1,
+        help=("stores only every n-th row of the integral images and sums the "
+              "rows of the block for the others."))
+    parser.add_argument(
+        '--integral_float32', action='store_true', default=False,
+        help=("stores the integral images in float32 (they are accumulated "
+              "in float64)."))
     parser.add_argument('-S', '--stride', type=int, help="window displacement step size.")
     parser.add_argument('-D', '--delta', type=int, help="base slice length.")
     parser.add_argument('--begin', type=int, help="smallest slice length.")
     parser.add_argument('--end', type=int, help="largest slice length.")
     parser.add_argument(
         '--timings_file', default=None,
-        help="where to store the iteration timings (only for `cy_approx_ess`.")
+        help=("where to store the iteration timings (only for the ESS "
+              "algorithms); each movie part gets its own file, suffixed by "
+              "`.<movie>_part<part>`."))
+    parser.add_argument(
+        '--prune_heap', action='store_true', default=False,
+        help=("removes the heap entries banned by each new detection (only "
+              "for the ESS algorithms)."))
+    parser.add_argument(
+        '--stats_file', default=None,
+        help=("where to store the per-detection search statistics, such as "
+              "the number of wasted heap pops (only for the ESS algorithms); "
+              "suffixed as the timings files."))
+    parser.add_argument(
+        '--top_k', type=int, default=1,
+        help=("number of non-overlapping windows returned by each "
+              "branch-and-bound pass (only for the ESS algorithms)."))
+    parser.add_argument(
+        '--keep_top_k', type=int, default=None,
+        help=("number of best scoring windows kept for each movie while "
+              "sliding the windows (only for the exhaustive algorithms)."))
+    parser.add_argument(
+        '--score_threshold', type=float, default=None,
+        help=("discards the windows scoring less while sliding the windows "
+              "(only for the exhaustive algorithms); applied to the scores "
+              "before the rescoring."))
+    parser.add_argument(
+        '--node_budget', type=int, default=None,
+        help=("maximum number of nodes explored by ESS for each detection; "
+              "returns the best window found so far when exceeded."))
+    parser.add_argument(
+        '--time_budget', type=float, default=None,
+        help="maximum number of seconds spent by ESS on each detection.")
+    parser.add_argument(
+        '--max_heap_size', type=int, default=None,
+        help="maximum number of boxes kept in the ESS heap.")
+    parser.add_argument(
+        '--batch_size', type=int, default=1,
+        help=("number of boxes split at each ESS step, whose children are "
+              "bounded in a single vectorized call."))
+    parser.add_argument(
+        '--tubes_file', default=None,
+        help=("where to store the spatial bins of the detected tubes (only "
+              "for `approx_tube_ess`); suffixed as the timings files."))
+    parser.add_argument(
+        '--ban_spatially', action='store_true', default=False,
+        help=("each detected tube bans only the tubes it overlaps, instead of "
+              "its time interval (only for `approx_tube_ess`)."))
+    parser.add_argument(
+        '--nms_overlap', type=float, default=None,
+        help=("IoU threshold of the non-maxima supression; by default, only "
+              "the windows with zero overlap are kept."))
+    parser.add_argument(
+        '--soft_nms', choices=['linear', 'gaussian'], default=None,
+        help="decays the scores of the overlapping windows instead of removing them.")
+    parser.add_argument(
+        '--classifier', choices=('dual', ) + PRIMAL_CLASSIFIERS, default='dual',
+        help=("trains the kernel SVM (`dual`) or a linear classifier in the "
+              "primal, which does not need the Gram matrix."))
+    parser.add_argument(
+        '--quantize', action='store_true', default=False,
+        help=("caches the test slices quantized to int8 per visual word and "
+              "scores them without decompressing them (only for `approx`)."))
+    parser.add_argument(
+        '--block_sparse', action='store_true', default=False,
+        help=("stores only the Fisher vector blocks of the visual words that "
+              "are active in each test slice (only for `approx`)."))
+    parser.add_argument(
+        '-np', '--nr_processes', type=int, default=1,
+        help="number of processes for the sliding window and the NMS.")
     parser.add_argument(
         '--results_file', default=None,
         help="where to store the scored slices.")
+    parser.add_argument(
+        '--evaluator', choices=['get_det_ap', 'builtin', 'compare'],
+        default='get_det_ap',
+        help=("computes the AP with `get_det_ap`, with the built-in evaluator "
+              "from `detection_evaluation.py` or with both (and fails if they "
+              "differ)."))
     parser.add_argument(
         '--save_results', action='store_true', default=False,
         help="dumps results to disk in seperate files for each delta.")
@@ -1010,9 +1972,105 @@ def main():
     parser.add_argument(
         '-v', '--verbose', action='count', help="verbosity level.")
 
+    parser.add_argument(
+        '--check_folding', action='store_true', default=False,
+        help=("checks on random data that folding the scalers into the "
+              "weights does not change the results, then exits."))
+
+    parser.add_argument(
+        '--check_gram', action='store_true', default=False,
+        help=("checks on random data that the exact L2 norms from the slice "
+              "Gram band match those of the aggregated windows, then exits."))
+
     args = parser.parse_args()
+
+    if args.check_folding:
+        sys.exit(0 if check_scaler_folding() else 1)
+    if args.check_gram:
+        sys.exit(0 if check_gram_l2() else 1)
+
+    if args.dataset is None or args.algorithm is None:
+        parser.error("the arguments -d/--dataset and -a/--algorithm are required.")
+    if args.quantize and args.block_sparse:
+        parser.error("--quantize and --block_sparse are exclusive.")
+    if args.time_budget is not None and args.batch_size > 1:
+        parser.error("--time_budget is not supported with --batch_size.")
+
+    # The tubes need slices split in spatial bins, which the detection
+    # configs do not provide yet.
+    ALGO_PARAMS = get_algo_params(
+        None, nr_spatial_bins=spatial_nr_bins(args.dataset))
+    for algorithm in args.algorithm:
+        if ALGO_PARAMS.get(algorithm, {}).get('nr_bins', 1) is None:
+            parser.error(
+                "%s needs a `(1, H, 1)` entry of `spms` in the config of %s." %
+                (algorithm, args.dataset))
+
+    # The other algorithms would keep a dense copy next to the sparse slices.
+    if args.block_sparse:
+        for algorithm in args.algorithm:
+            sliding_window = ALGO_PARAMS.get(algorithm, {}).get('sliding_window')
+            if sliding_window is not approx_sliding_window:
+                parser.error(
+                    "--block_sparse is only supported by the `approx` "
+                    "algorithms, not %s." % algorithm)
+
     deltas = range(args.begin, args.end + args.delta, args.delta)
 
+    pairs = [
+        (class_idx, algorithm)
+        for class_idx in args.class_idx
+        for algorithm in args.algorithm]
+
+    if len(pairs) > 1 and args.results_file is not None:
+        parser.error("--results_file requires a single class and algorithm.")
+
+    pairs_args = {}
+    for class_idx, algorithm in pairs:
+        pair_args = argparse.Namespace(**vars(args))
+        pair_args.class_idx, pair_args.algorithm = class_idx, algorithm
+        prepare_files(pair_args, deltas)
+        pairs_args[class_idx, algorithm] = pair_args
+
+    # Compute the results of all the classes and algorithms together; the
+    # evaluation of each pair then loads them from the results files.
+    if len(pairs) > 1:
+        sweep_evaluation(
+            args.algorithm, args.dataset, args.class_idx, args.stride, deltas,
+            rescore=args.rescore, no_integral=args.no_integral,
+            containing=args.containing, verbose=args.verbose,
+            outfiles={pair: pairs_args[pair].results_file for pair in pairs},
+            prune_heap=args.prune_heap, top_k=args.top_k,
+            classifier=args.classifier, quantize=args.quantize,
+            block_sparse=args.block_sparse, nr_processes=args.nr_processes,
+            integral_params=integral_params(args),
+            retention={
+                'top_k': args.keep_top_k,
+                'score_threshold': args.score_threshold,
+            },
+            search_budget={
+                'node_budget': args.node_budget,
+                'time_budget': args.time_budget,
+                'max_heap_size': args.max_heap_size,
+                'batch_size': args.batch_size,
+            })
+
+    for pair in pairs:
+        detect(pairs_args[pair], deltas)
+
+
+def integral_params(args):
+    return {
+        'integral_block_size': args.integral_block_size,
+        'integral_dtype': np.float32 if args.integral_float32 else np.float64,
+    }
+
+
+def prepare_files(args, deltas):
+    """Sets the default output files for `args.algorithm` and
+    `args.class_idx` and removes the results file if overwriting.
+
+    """
     if args.timings_file is None and args.algorithm.startswith('cy_approx_ess'):
          args.timings_file = (
              '/home/lear/oneata/data/cc/results/cy_approx_ess_class_%d_timings.txt'
@@ -1025,44 +2083,109 @@ def main():
             args.class_idx,
             args.stride,
             '_'.join(map(str, deltas)))
+        if args.keep_top_k is not None:
+            args.results_file += '.top%d' % args.keep_top_k
+        if args.score_threshold is not None:
+            args.results_file += '.thresh%g' % args.score_threshold
+        if args.classifier != 'dual':
+            args.results_file += '.' + args.classifier
+        if args.quantize:
+            args.results_file += '.int8'
+        # The ESS options that change the detections.
+        if args.top_k != 1:
+            args.results_file += '.pass_top%d' % args.top_k
+        if args.node_budget is not None:
+            args.results_file += '.nodes%d' % args.node_budget
+        if args.time_budget is not None:
+            args.results_file += '.time%g' % args.time_budget
+        if args.max_heap_size is not None:
+            args.results_file += '.heap%d' % args.max_heap_size
+        if args.batch_size > 1:
+            args.results_file += '.batch%d' % args.batch_size
+        if args.ban_spatially:
+            args.results_file += '.ban_spatially'
 
     if args.overwrite and os.path.exists(args.results_file):
         os.remove(args.results_file)
 
+
+def detect(args, deltas):
+    """Runs the detection (or loads its results) and evaluates it for
+    `args.algorithm` and `args.class_idx`.
+
+    """
     results = evaluation(
         args.algorithm, args.dataset, args.class_idx, args.stride, deltas,
         rescore=args.rescore, no_integral=args.no_integral,
         containing=args.containing, verbose=args.verbose,
-        outfile=args.results_file, timings_file=args.timings_file)[0]
+        outfile=args.results_file, timings_file=args.timings_file,
+        prune_heap=args.prune_heap, stats_file=args.stats_file,
+        top_k=args.top_k, nr_processes=args.nr_processes,
+        tubes_file=args.tubes_file, ban_spatially=args.ban_spatially,
+        classifier=args.classifier, quantize=args.quantize,
+        block_sparse=args.block_sparse, integral_params=integral_params(args),
+        retention={
+            'top_k': args.keep_top_k,
+            'score_threshold': args.score_threshold,
+        },
+        search_budget={
+            'node_budget': args.node_budget,
+            'time_budget': args.time_budget,
+            'max_heap_size': args.max_heap_size,
+            'batch_size': args.batch_size,
+        })[0]
+
+    dataset = Dataset(
+        CFG[args.dataset]['dataset_name'],
+        **CFG[args.dataset]['dataset_params'])
+    movies = list(dataset.TE_MOVIES)
+
+    # The older result files store lists of tuples.
+    results = {
+        movie: as_results(movie_results, movies.index(movie))
+        for movie, movie_results in results.iteritems()}
 
     if args.rescore and 'ess' not in args.algorithm:
         results = {
-            movie: [
-                (bf, ef, score * (ef - bf) / 30)
-                for bf, ef, score in movie_results]
+            movie: rescore_by_length(movie_results)
             for movie, movie_results in results.iteritems()}
 
     # I do the NMS myself and skip it in Adrien's code.
     if 'ess' not in args.algorithm:  # ESS does 0-NMS automatically.
         start = time.time()
-        # TODO Parallelize across movies.
-        results = {
-            movie: non_maxima_supression_0(
-                movie_results, args.delta, args.begin, args.end)
-            for movie, movie_results in results.iteritems()}
+        nms_movies = sorted(results.keys())
+
+        if args.nms_overlap is not None or args.soft_nms is not None:
+            worker = nms_iou_worker
+            nms_args = [
+                (results[movie], args.nms_overlap or 0., args.soft_nms)
+                for movie in nms_movies]
+        else:
+            worker = nms_worker
+            nms_args = [
+                (results[movie], args.delta, args.begin, args.end)
+                for movie in nms_movies]
+
+        if args.nr_processes > 1:
+            pool = Pool(args.nr_processes)
+            nms_results = pool.map(worker, nms_args, chunksize=1)
+            pool.close()
+            pool.join()
+        else:
+            nms_results = map(worker, nms_args)
+
+        results = dict(izip(nms_movies, nms_results))
 
         if args.verbose > 2:
             print "NMS time: %.2f s" % (time.time() - start)
             print "Results file:", args.results_file
 
-    adrien_results = [
-        (SampID(SAMPID % (movie, bf, ef)), score)
-        for movie, movie_results in results.iteritems()
-        for bf, ef, score in movie_results]
+    results = concatenate_results(results.values())
+    external = args.evaluator != 'builtin'
 
-    dataset = Dataset(
-        CFG[args.dataset]['dataset_name'],
-        **CFG[args.dataset]['dataset_params'])
+    # Python objects are created only for the detections left after the NMS.
+    if external or args.save_results:
+        adrien_results = to_samp_ids(results, movies)
 
     if args.save_results:
         save_results(dataset, args.class_idx, adrien_results, args.deltas)
@@ -1070,11 +2193,29 @@ def main():
     class_name = dataset.IDX2CLS[args.class_idx]
     gt_path = os.path.join(dataset.FL_DIR, 'keyframes_test_%s.list' % class_name)
 
-    ap = get_det_ap(adrien_results, gt_path, 'OV20', nmscrit='OV00')
+    if external:
+        nmscrit = 'OV%02d' % round(100 * (args.nms_overlap or 0))
+        ap = get_det_ap(adrien_results, gt_path, 'OV20', nmscrit=nmscrit)
+
+    if args.evaluator != 'get_det_ap':
+        ground_truth = load_ground_truth(gt_path, movies)
+        (builtin_ap, ), (builtin_recall, ), (builtin_precision, ) = (
+            evaluate_detections(results, ground_truth, parse_overlap('OV20')))
+
+    if args.evaluator == 'compare':
+        print "%10s get_det_ap %.2f builtin %.2f" % (
+            class_name, 100 * ap, 100 * builtin_ap)
+        check_get_det_ap(builtin_ap, ap, class_name)
+
+    if not external:
+        ap = builtin_ap
 
     if CVPR_XPS:
         # Save the precision, recall values.
-        recall, precision = get_det_pr(adrien_results, gt_path, 'OV20', 'OV00')
+        if external:
+            recall, precision = get_det_pr(adrien_results, gt_path, 'OV20', nmscrit)
+        else:
+            recall, precision = builtin_recall, builtin_precision
         oo = '/home/lear/oneata/tmp/pr_%s_%s_class_%d_strid_%d_delta_%s.dat' % (
             args.algorithm,
             args.dataset,
@@ -0,0 +1,298 @@
+"""Temporal detection evaluation on the structured results arrays (see
+`detection_results.py`). The ground truth is loaded once into arrays and the
+detections are matched to it with vectorized overlap matrices, for all the
+overlap thresholds at the same time.
+
+"""
+import argparse
+import numpy as np
+import os
+import sys
+import tempfile
+
+from dataset import SampID
+
+from detection_results import RESULT_DTYPE
+from detection_results import SAMPID
+from detection_results import to_samp_ids
+
+from nms.nms_iou import temporal_iou
+
+
+GT_DTYPE = np.dtype([
+    ('movie', np.int32),
+    ('begin', np.int64),
+    ('end', np.int64)])
+
+# Relative tolerance on the AP when comparing to `get_det_ap`.
+AP_TOLERANCE = 1e-6
+
+
+def parse_overlap(criterion):
+    """Converts an overlap criterion such as `'OV20'` to a threshold."""
+    assert criterion.startswith('OV'), criterion
+    return int(criterion[2:]) / 100.
+
+
+def parse_ground_truth(lines, movies):
+    """Builds the `GT_DTYPE` array of the ground truth actions from the
+    keyframe lists read by `get_det_ap`, whose lines start with the `SampID`
+    of an action; `movies` maps the movie names to the indices used by the
+    results (the actions in other movies are kept, with the index -1, as they
+    count towards the recall).
+
+    """
+    movie_idxs = {movie: ii for ii, movie in enumerate(movies)}
+    entries = []
+
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        sample = SampID(fields[0])
+        # The sample ids are built as in `to_samp_ids`; strip the frames.
+        suffix = SAMPID.split('%s', 1)[1] % (sample.bf, sample.ef)
+        name = str(sample)
+        if not name.endswith(suffix):
+            raise ValueError("Unknown ground truth entry: %r" % line)
+        entries.append((
+            movie_idxs.get(name[: - len(suffix)], -1), sample.bf, sample.ef))
+
+    return np.array(entries, dtype=GT_DTYPE)
+
+
+def load_ground_truth(path, movies):
+    with open(path, 'r') as ff:
+        return parse_ground_truth(ff, movies)
+
+
+def match_detections(results, ground_truth, overlaps):
+    """Greedily matches the detections, in decreasing order of their score,
+    to the unmatched ground truth action of the same movie they overlap most,
+    if their IoU is at least the threshold. Returns the sorted scores and a
+    boolean array of shape `(len(overlaps), len(results))` with the true
+    positives for each threshold.
+
+    """
+    overlaps = np.atleast_1d(np.asarray(overlaps, dtype=np.float64))
+    thresholds = overlaps[:, np.newaxis]
+    rows = np.arange(len(overlaps))
+
+    order = np.argsort(- results['score'], kind='mergesort')
+    results = results[order]
+    tp = np.zeros((len(overlaps), len(results)), dtype=np.bool)
+
+    for movie in np.unique(results['movie']):
+
+        if movie < 0:
+            continue
+
+        gt = ground_truth[ground_truth['movie'] == movie]
+        if not len(gt):
+            continue
+
+        det_idxs = np.where(results['movie'] == movie)[0]
+        iou = temporal_iou(
+            results['begin'][det_idxs, np.newaxis],
+            results['end'][det_idxs, np.newaxis],
+            gt['begin'], gt['end'])
+
+        # Only the detections that overlap enough an action need matching;
+        # the rest are false positives for every threshold.
+        candidates = np.where(np.any(iou >= overlaps.min(), axis=1))[0]
+        matched = np.zeros((len(overlaps), len(gt)), dtype=np.bool)
+
+        for ii in candidates:
+            valid = (iou[ii] >= thresholds) & ~matched
+            best = np.argmax(np.where(valid, iou[ii], -1), axis=1)
+            hit = valid[rows, best]
+            matched[rows[hit], best[hit]] = True
+            tp[hit, det_idxs[ii]] = True
+
+    return results['score'], tp
+
+
+def precision_recall(tp, nr_positives):
+    """Recall and precision at each rank, for each row of `tp`."""
+    nr_tp = np.cumsum(tp, axis=-1)
+    ranks = np.arange(1, tp.shape[-1] + 1)
+    recall = nr_tp / float(max(nr_positives, 1))
+    precision = nr_tp / ranks.astype(np.float64)
+    return recall, precision
+
+
+def average_precision(recall, precision):
+    """Area under the precision-recall curve, with the precision replaced
+    by its maximum at higher recalls (as for Pascal VOC).
+
+    """
+    recall = np.atleast_2d(recall)
+    precision = np.atleast_2d(precision)
+    nr_rows = len(recall)
+
+    recall = np.hstack((np.zeros((nr_rows, 1)), recall, np.ones((nr_rows, 1))))
+    precision = np.hstack((
+        np.zeros((nr_rows, 1)), precision, np.zeros((nr_rows, 1))))
+    precision = np.maximum.accumulate(precision[:, ::-1], axis=1)[:, ::-1]
+
+    return np.sum(np.diff(recall, axis=1) * precision[:, 1:], axis=1)
+
+
+def evaluate_detections(results, ground_truth, overlaps):
+    """Computes the AP, recall and precision for each overlap threshold;
+    `results` and `ground_truth` can also be dictionaries indexed by class,
+    in which case the values are returned in a dictionary.
+
+    """
+    if isinstance(results, dict):
+        return {
+            cls: evaluate_detections(results[cls], ground_truth[cls], overlaps)
+            for cls in results}
+
+    _, tp = match_detections(results, ground_truth, overlaps)
+    recall, precision = precision_recall(tp, len(ground_truth))
+    return average_precision(recall, precision), recall, precision
+
+
+def check_get_det_ap(ap, ext_ap, name):
+    """Fails if the AP of `evaluate_detections` differs from the one of
+    `get_det_ap`, on the same detections and ground truth.
+
+    """
+    assert np.isclose(ap, ext_ap, rtol=AP_TOLERANCE, atol=AP_TOLERANCE), (
+        "%s: the builtin AP %.6f differs from get_det_ap %.6f" % (name, ap, ext_ap))
+
+
+def evaluate_detections_reference(results, ground_truth, overlap):
+    """Straightforward version of `evaluate_detections` for a single overlap
+    threshold; used to check the vectorized one.
+
+    """
+    order = sorted(
+        xrange(len(results)), key=lambda ii: - results['score'][ii])
+    matched = set()
+    tp = []
+
+    for ii in order:
+        det = results[ii]
+        best_iou, best_jj = -1, None
+        for jj, gt in enumerate(ground_truth):
+            if gt['movie'] != det['movie'] or det['movie'] < 0 or jj in matched:
+                continue
+            iou = temporal_iou(det['begin'], det['end'], gt['begin'], gt['end'])
+            if iou >= overlap and iou > best_iou:
+                best_iou, best_jj = iou, jj
+        if best_jj is not None:
+            matched.add(best_jj)
+        tp.append(best_jj is not None)
+
+    recall, precision = precision_recall(np.array(tp, dtype=np.bool), len(ground_truth))
+    return average_precision(recall, precision)[0]
+
+
+def random_fixture(nr_movies, nr_actions, nr_detections, seed=0):
+    """Random ground truth actions, jittered detections of some of them
+    and random detections that do not overlap the actions or each other.
+
+    """
+    rng = np.random.RandomState(seed)
+    movies = ['movie_%d.avi' % ii for ii in xrange(nr_movies)]
+
+    # The actions and the detections are placed in disjoint slots.
+    nr_slots = nr_actions + nr_detections
+    slots = rng.permutation(nr_movies * nr_slots)
+    slot_movies, slot_begins = slots / nr_slots, (slots % nr_slots) * 1000
+
+    ground_truth = np.zeros(nr_actions, dtype=GT_DTYPE)
+    ground_truth['movie'] = slot_movies[: nr_actions]
+    ground_truth['begin'] = slot_begins[: nr_actions] + rng.randint(0, 200, nr_actions)
+    ground_truth['end'] = ground_truth['begin'] + rng.randint(50, 300, nr_actions)
+
+    # At most half of the detections are jittered actions, one per action.
+    nr_close = min(nr_actions, nr_detections / 2)
+    close = rng.permutation(nr_actions)[: nr_close]
+
+    results = np.zeros(nr_detections, dtype=RESULT_DTYPE)
+    results['movie'][: nr_close] = ground_truth['movie'][close]
+    results['begin'][: nr_close] = np.maximum(
+        0, ground_truth['begin'][close] + rng.randint(-100, 100, nr_close))
+    results['end'][: nr_close] = (
+        ground_truth['end'][close] + rng.randint(-100, 100, nr_close))
+    results['end'][: nr_close] = np.maximum(
+        results['end'][: nr_close], results['begin'][: nr_close] + 1)
+
+    free = slice(nr_actions + nr_close, nr_actions + nr_detections)
+    results['movie'][nr_close:] = slot_movies[free]
+    results['begin'][nr_close:] = slot_begins[free]
+    results['end'][nr_close:] = (
+        results['begin'][nr_close:] + rng.randint(50, 300, nr_detections - nr_close))
+
+    results['score'] = rng.randn(nr_detections)
+    results['delta'] = results['end'] - results['begin']
+
+    return movies, ground_truth, results
+
+
+def write_ground_truth(path, ground_truth, movies):
+    with open(path, 'w') as ff:
+        for movie, begin, end in ground_truth:
+            ff.write(str(SampID(SAMPID % (movies[movie], begin, end))) + '\n')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Checks the vectorized temporal detection evaluation.")
+
+    parser.add_argument('--nr_movies', type=int, default=5, help="number of movies.")
+    parser.add_argument('--nr_actions', type=int, default=50, help="number of actions.")
+    parser.add_argument(
+        '--nr_detections', type=int, default=500, help="number of detections.")
+    parser.add_argument('--nr_trials', type=int, default=10, help="number of fixtures.")
+    parser.add_argument(
+        '--overlaps', type=float, nargs='+', default=[0.1, 0.2, 0.5],
+        help="IoU thresholds.")
+    parser.add_argument(
+        '--get_det_ap', action='store_true', default=False,
+        help=("compares also to `get_det_ap` (criterion `OV20`) and fails if "
+              "the APs differ."))
+
+    args = parser.parse_args()
+
+    if args.get_det_ap:
+        from result_file_functions import get_det_ap
+
+    all_ok = True
+    for seed in xrange(args.nr_trials):
+
+        movies, ground_truth, results = random_fixture(
+            args.nr_movies, args.nr_actions, args.nr_detections, seed=seed)
+
+        # Round-trip the ground truth through its file format.
+        fd, gt_path = tempfile.mkstemp(suffix='.list')
+        os.close(fd)
+        write_ground_truth(gt_path, ground_truth, movies)
+        ground_truth = load_ground_truth(gt_path, movies)
+
+        aps, _, _ = evaluate_detections(results, ground_truth, args.overlaps)
+        for overlap, ap in zip(args.overlaps, aps):
+            ref_ap = evaluate_detections_reference(results, ground_truth, overlap)
+            ok = np.isclose(ap, ref_ap)
+            all_ok &= ok
+            print "Seed %d overlap %.2f: AP %.4f reference %.4f%s" % (
+                seed, overlap, ap, ref_ap, '' if ok else ' MISMATCH')
+
+        if args.get_det_ap:
+            ap, = evaluate_detections(results, ground_truth, parse_overlap('OV20'))[0]
+            ext_ap = get_det_ap(
+                to_samp_ids(results, movies), gt_path, 'OV20', nmscrit='OV00')
+            print "Seed %d get_det_ap: AP %.4f external %.4f" % (seed, ap, ext_ap)
+            check_get_det_ap(ap, ext_ap, "Seed %d" % seed)
+
+        os.remove(gt_path)
+
+    sys.exit(0 if all_ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import numpy as np
+
+from dataset import SampID
+
+
+# Columns of the detection results. The `delta` is the length of the sliding
+# window that produced the detection (0 for ESS) and `movie` is the index of
+# the movie in `dataset.TE_MOVIES` (-1 if not set).
+RESULT_DTYPE = np.dtype([
+    ('begin', np.int64),
+    ('end', np.int64),
+    ('score', np.float64),
+    ('delta', np.int32),
+    ('movie', np.int32)])
+
+CHUNK_SIZE = 65536
+SAMPID = '%s-frames-%d-%d'
+
+
+class ResultBuffer:
+    """Accumulates detections in preallocated chunks of `RESULT_DTYPE`
+    records, instead of building a tuple for each detection.
+
+    In streaming mode, only the detections scoring at least `score_threshold`
+    are stored and, if `top_k` is set, the buffer is compacted to its `top_k`
+    best detections whenever it holds more than `top_k + chunk_size`, so the
+    memory does not grow with the number of appended detections.
+
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, top_k=None, score_threshold=None):
+        self.chunk_size = chunk_size
+        self.top_k = top_k
+        self.score_threshold = score_threshold
+        self.chunks = []
+        self.size = 0  # Number of records used in the last chunk.
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks[: -1]) + self.size
+
+    def append(self, begin, end, score, delta=0, movie=-1):
+        """Appends the detections given by the arrays `begin`, `end` and
+        `score`; `delta` and `movie` can be either scalars or arrays.
+
+        """
+        nn = len(score)
+        column = lambda xx: np.resize(np.asarray(xx), nn)
+        columns = zip(
+            RESULT_DTYPE.names,
+            map(column, (begin, end, score, delta, movie)))
+
+        # Drop the detections that cannot be retained before copying them.
+        if self.score_threshold is not None or self.top_k is not None:
+            score = columns[2][1]
+            idxs = np.arange(nn)
+            if self.score_threshold is not None:
+                idxs = idxs[score >= self.score_threshold]
+            if self.top_k is not None:
+                idxs = np.sort(idxs[top_k_idxs(score[idxs], self.top_k)])
+            columns = [(name, values[idxs]) for name, values in columns]
+            nn = len(idxs)
+
+        written = 0
+        while written < nn:
+
+            if not self.chunks or self.size == len(self.chunks[-1]):
+                self.chunks.append(np.empty(
+                    max(self.chunk_size, nn - written), dtype=RESULT_DTYPE))
+                self.size = 0
+
+            chunk = self.chunks[-1]
+            mm = min(len(chunk) - self.size, nn - written)
+
+            for name, values in columns:
+                chunk[name][self.size: self.size + mm] = values[written: written + mm]
+
+            self.size += mm
+            written += mm
+
+        if self.top_k is not None and len(self) > self.top_k + self.chunk_size:
+            self.chunks = [select_top(self.to_array(), self.top_k)]
+            self.size = len(self.chunks[0])
+
+    def to_array(self):
+        if not self.chunks:
+            return empty_results()
+        return np.concatenate(self.chunks[: -1] + [self.chunks[-1][: self.size]])
+
+
+def top_k_idxs(scores, top_k):
+    """Indices of the `top_k` highest scores, in no particular order."""
+    if len(scores) <= top_k:
+        return np.arange(len(scores))
+    return np.argpartition(- scores, top_k - 1)[: top_k]
+
+
+def select_top(results, top_k=None, score_threshold=None):
+    """Keeps the detections scoring at least `score_threshold` and, out of
+    these, the `top_k` best ones; the order of the detections is preserved.
+
+    """
+    if score_threshold is not None:
+        results = results[results['score'] >= score_threshold]
+    if top_k is not None:
+        results = results[np.sort(top_k_idxs(results['score'], top_k))]
+    return results
+
+
+def empty_results():
+    return np.zeros(0, dtype=RESULT_DTYPE)
+
+
+def concatenate_results(results):
+    results = [rr for rr in results if len(rr)]
+    return np.concatenate(results) if results else empty_results()
+
+
+def as_results(results, movie=-1):
+    """Converts the lists of `(begin_frame, end_frame, score)` tuples, as
+    stored in the older result files, to a structured array.
+
+    """
+    if isinstance(results, np.ndarray):
+        return results
+    out = np.zeros(len(results), dtype=RESULT_DTYPE)
+    if len(results):
+        begin, end, score = zip(*results)
+        out['begin'], out['end'], out['score'] = begin, end, score
+        out['delta'] = out['end'] - out['begin']
+    out['movie'] = movie
+    return out
+
+
+def to_tuples(results):
+    """The `(begin_frame, end_frame, score)` tuples used by the old NMS."""
+    return zip(
+        results['begin'].tolist(), results['end'].tolist(),
+        results['score'].tolist())
+
+
+def rescore_by_length(results, frame_rate=30):
+    """Weights the scores by the duration of the detections in seconds."""
+    results = results.copy()
+    results['score'] *= (results['end'] - results['begin']) / float(frame_rate)
+    return results
+
+
+def to_samp_ids(results, movies):
+    """Builds the `(SampID, score)` pairs expected by `get_det_ap`."""
+    return [
+        (SampID(SAMPID % (movies[movie], begin, end)), score)
+        for begin, end, score, movie in zip(
+            results['begin'].tolist(), results['end'].tolist(),
+            results['score'].tolist(), results['movie'].tolist())]
@@ -1,20 +1,42 @@
 import argparse
+from collections import namedtuple
 import heapq
+import itertools
 import numpy as np
 import pdb
+import time
 
+from integral_image import compensated_cumsum
 
-MAX_NR_ITER = 10000
+
+MAX_NR_ITER = 100000
 
 # TODO Things to improve.
 # [x] Fix boundaries for integral images.
 # [ ] Write `integral` function in Cython.
-# [ ] Generalize algorithm for more dimensions.
+# [x] Generalize algorithm for more dimensions.
 # [ ] The `Bounds` class is not well written; replace the indexes with namedtuples.
 # [ ] Avoid mutable data.
+# [x] Share the detection loop between the Python and Cython engines.
+
+
+ApproxNormsData = namedtuple(
+    'ApproxNormsData', ['slice_vw_scores', 'slice_vw_l2_norms',
+                        'pos_slice_vw_scores', 'neg_slice_vw_scores',
+                        'slice_vw_counts', 'integral_slice_vw_l2_norms'])
+
+Engine = namedtuple(
+    'Engine', ['bounding_function', 'init_bounds', 'init_interval', 'search',
+               'search_top_k', 'batch_search', 'prune_heap'])
 
 
 class Bounds:
+    """Set of boxes whose `begin` and `end` indexes lie between `low` and
+    `high`. For N dimensions, the indexes are stored as [begin_1, end_1,
+    ..., begin_N, end_N]; `get_union` and `get_intersection` refer to the
+    first (temporal) dimension.
+
+    """
     def __init__(self, low, high):
         self.low = low
         self.high = high
@@ -24,13 +46,20 @@ class Bounds:
             ','.join(map(str, self.low)),
             ','.join(map(str, self.high)))
 
+    def __cmp__(self, other):
+        # Breaks the ties between the scores on the heap by the indexes, not
+        # by the memory addresses of the boxes.
+        return cmp(
+            (tuple(self.low), tuple(self.high)),
+            (tuple(other.low), tuple(other.high)))
+
     def get_maximum_index(self):
         delta = self.high - self.low
         ii = np.argmax(self.high - self.low)
         return -1 if delta[ii] <= 0 else ii
 
     def is_legal(self):
-        return self.low[0] <= self.high[1]
+        return np.all(self.low[0::2] <= self.high[1::2])
 
     def get_union(self):
         return self.low[0], self.high[1]
@@ -38,18 +67,53 @@ class Bounds:
     def get_intersection(self):
         return self.high[0], self.low[1]
 
+    def get_unions(self):
+        """Union intervals for each dimension, as an array of shape D x 2."""
+        return np.vstack((self.low[0::2], self.high[1::2])).T
+
+    def get_intersections(self):
+        return np.vstack((self.high[0::2], self.low[1::2])).T
+
 
 def efficient_subwindow_search(
-    bounding_function, heap, blacklist=[], verbose=0):
+    bounding_function, heap, blacklist=[], verbose=0, max_nr_iter=MAX_NR_ITER,
+    time_budget=None, max_heap_size=None, stats=None):
+    """Best-first branch-and-bound search for the window that maximizes the
+    `bounding_function`.
+
+    The search is interrupted after `max_nr_iter` popped nodes or after
+    `time_budget` seconds. In that case it returns the best fully resolved
+    window found so far or, if there is none, the middle of the top box with
+    its own score (`-inf` and no window if it is illegal or banned), and
+    `stats['upper_bound']` gives the bound on the optimal score. If
+    `max_heap_size` is set, the heap is cut down to its best half whenever
+    it grows larger than that, and the bound accounts for the dropped boxes.
+
+    """
 
     nr_inf_bounds = 0
+    nr_wasted_pops = 0
+    nr_nodes = 0
+    nr_dropped = 0
+    max_dropped_bound = - np.inf
+    max_size = len(heap)
+    deadline = time.time() + time_budget if time_budget is not None else None
+    resolved = False
+    incumbent = None
+
+    for ii in xrange(max_nr_iter):
+
+        if deadline is not None and time.time() > deadline:
+            break
 
-    for ii in xrange(MAX_NR_ITER):
+        if len(heap) == 0:
+            break
 
         if verbose > 2:
             print ii, heap
 
         score, bounds = heapq.heappop(heap)
+        nr_nodes += 1
 
         if score == - np.inf:
             nr_inf_bounds += 1
@@ -58,51 +122,329 @@ def efficient_subwindow_search(
             print "Pop", score, bounds
 
         if len(blacklist) > 0 and bounds_in_blacklist(bounds, blacklist):
+            nr_wasted_pops += 1
             continue
 
         # Branch...
         split_index = bounds.get_maximum_index()
 
         if split_index == -1:
+            resolved = True
             break
 
-        bounds_i = Bounds(bounds.low.copy(), bounds.high.copy())
-        bounds_j = Bounds(bounds.low.copy(), bounds.high.copy())
+        # ... and bound.
+        best_child = branch_and_bound(
+            bounding_function, heap, bounds, split_index, verbose)
+
+        if (best_child is not None and
+            (incumbent is None or best_child[0] < incumbent[0]) and
+            not (len(blacklist) > 0 and bounds_in_blacklist(best_child[1], blacklist))):
+            incumbent = best_child
+
+        max_size = max(max_size, len(heap))
+        dropped, dropped_bound = cap_heap(heap, max_heap_size)
+        nr_dropped += dropped
+        max_dropped_bound = max(max_dropped_bound, dropped_bound)
+
+    if resolved:
+        upper_bound = max(- score, max_dropped_bound)
+    else:
+        # Search interrupted: the best candidate is either the best fully
+        # resolved window seen so far or the middle of the top box.
+        upper_bound = max(- heap[0][0] if heap else - np.inf, max_dropped_bound)
+        if incumbent is not None:
+            score, bounds = incumbent
+        elif heap:
+            window_score, bounds = middle_window(
+                bounding_function, heap[0][1], blacklist)
+            score = - window_score
+        else:
+            score, bounds = np.inf, None
 
-        middle = (bounds.low[split_index] + bounds.high[split_index]) / 2
+    if verbose > 1:
+        print "Number of `Inf` bounds", nr_inf_bounds
+        print "Evaluated %d states." % nr_nodes
 
-        bounds_i.high[split_index] = middle
-        bounds_j.low[split_index] = middle + 1
+    if stats is not None:
+        stats['nr_wasted_pops'] = nr_wasted_pops
+        stats['nr_nodes'] = nr_nodes
+        stats['heap_size'] = len(heap)
+        stats['max_heap_size'] = max_size
+        stats['nr_dropped_boxes'] = nr_dropped
+        stats['resolved'] = resolved
+        stats['upper_bound'] = upper_bound
+        stats['gap'] = upper_bound + score
 
-        # ... and bound.
-        if bounds_i.is_legal():
-            score = bounding_function(bounds_i)
-            heapq.heappush(heap, (-score, bounds_i))
+    if score == np.inf:
+        return - np.inf, None, heap
 
-            if verbose > 2:
-                print "Push", score, bounds_i
+    return - score, (bounds.low + bounds.high) / 2, heap
 
-        if bounds_j.is_legal():
-            score = bounding_function(bounds_j)
-            heapq.heappush(heap, (-score, bounds_j))
 
-            if verbose > 2:
-                print "Push", score, bounds_j
+def cap_heap(heap, max_heap_size):
+    """Cuts the heap down, in place, to its best half if it holds more than
+    `max_heap_size` boxes. Returns the number of dropped boxes and the best
+    bound among them.
+
+    """
+    if max_heap_size is None or len(heap) <= max_heap_size:
+        return 0, - np.inf
+    kept = heapq.nsmallest(max_heap_size / 2 + 1, heap)
+    max_dropped_bound = - kept.pop()[0]
+    nr_dropped = len(heap) - len(kept)
+    heap[:] = kept
+    return nr_dropped, max_dropped_bound
+
+
+def middle_window(bounding_function, bounds, blacklist=[]):
+    """The window in the middle of `bounds`, as a box, and its score, which
+    is `-inf` if the window is empty or banned.
+
+    """
+    middle = (bounds.low + bounds.high) / 2
+    window = Bounds(middle, middle.copy())
+    if (np.any(middle[0::2] >= middle[1::2]) or
+        (len(blacklist) > 0 and bounds_in_blacklist(window, blacklist))):
+        return - np.inf, window
+    return bounding_function(window), window
+
+
+def efficient_subwindow_search_top_k(
+    bounding_function, heap, k, blacklist=[], verbose=0,
+    max_nr_iter=MAX_NR_ITER, time_budget=None, max_heap_size=None,
+    stats=None):
+    """Continues the branch-and-bound search until `k` fully resolved windows
+    are popped. Each window found is appended to `blacklist`, hence the
+    following ones do not overlap it; if the bounding function bans intervals
+    as well, it should share the same list. The search gives up after
+    `max_nr_iter` nodes without a new window or after `time_budget` seconds,
+    returning the windows found so far; the heap is capped by
+    `max_heap_size` as in `efficient_subwindow_search`. Returns
+    `(score, idxs)` pairs in decreasing order of the score.
+
+    """
+
+    detections = []
+    nr_iter = 0
+    nr_nodes = 0
+    nr_wasted_pops = 0
+    nr_dropped = 0
+    max_dropped_bound = - np.inf
+    max_size = len(heap)
+    deadline = time.time() + time_budget if time_budget is not None else None
+
+    while len(detections) < k and len(heap) > 0 and nr_iter < max_nr_iter:
+
+        if deadline is not None and time.time() > deadline:
+            break
+
+        nr_iter += 1
+        nr_nodes += 1
+        score, bounds = heapq.heappop(heap)
 
         if verbose > 2:
-            print
+            print "Pop", score, bounds
+
+        if len(blacklist) > 0 and bounds_in_blacklist(bounds, blacklist):
+            nr_wasted_pops += 1
+            continue
+
+        split_index = bounds.get_maximum_index()
+
+        if split_index == -1:
+
+            # The remaining windows are all illegal.
+            if score == np.inf:
+                break
+
+            idxs = (bounds.low + bounds.high) / 2
+            detections.append((- score, idxs))
+            blacklist.append(idxs)
+
+            nr_iter = 0
+            continue
+
+        branch_and_bound(bounding_function, heap, bounds, split_index, verbose)
+
+        max_size = max(max_size, len(heap))
+        dropped, dropped_bound = cap_heap(heap, max_heap_size)
+        nr_dropped += dropped
+        max_dropped_bound = max(max_dropped_bound, dropped_bound)
 
     if verbose > 1:
-        print "Number of `Inf` bounds", nr_inf_bounds
-        print "Evaluated %d states." % ii
+        print "Found %d windows." % len(detections)
+
+    if stats is not None:
+        stats['nr_wasted_pops'] = nr_wasted_pops
+        stats['nr_nodes'] = nr_nodes
+        stats['max_heap_size'] = max_size
+        stats['nr_dropped_boxes'] = nr_dropped
+        stats['max_dropped_bound'] = max_dropped_bound
+
+    return detections
+
+
+def branch_and_bound(bounding_function, heap, bounds, split_index, verbose=0):
+    """Splits `bounds` in two along `split_index` and pushes the legal
+    children on the heap. Returns the heap entry of the best child that is a
+    single window or None.
+
+    """
+
+    best_child = None
+
+    for child in split_bounds(bounds, split_index):
+
+        score = bounding_function(child)
+        heapq.heappush(heap, (-score, child))
+
+        if verbose > 2:
+            print "Push", score, child
+
+        if (child.get_maximum_index() == -1 and score != - np.inf and
+            (best_child is None or -score < best_child[0])):
+            best_child = (-score, child)
+
+    if verbose > 2:
+        print
+
+    return best_child
+
+
+def split_bounds(bounds, split_index):
+    """Returns the legal halves of `bounds` split along `split_index`."""
+
+    bounds_i = Bounds(bounds.low.copy(), bounds.high.copy())
+    bounds_j = Bounds(bounds.low.copy(), bounds.high.copy())
+
+    middle = (bounds.low[split_index] + bounds.high[split_index]) / 2
+
+    bounds_i.high[split_index] = middle
+    bounds_j.low[split_index] = middle + 1
+
+    return [child for child in (bounds_i, bounds_j) if child.is_legal()]
+
+
+def batch_efficient_subwindow_search(
+    batch_bounding_function, heap, batch_size, blacklist=[], verbose=0,
+    max_nr_iter=MAX_NR_ITER, max_heap_size=None, stats=None):
+    """Branch-and-bound search that pops the best `batch_size` boxes at each
+    step, splits all of them and bounds the children with a single call of
+    `batch_bounding_function`. The latter gets two arrays with the `low` and
+    `high` indexes of the children, both of shape (nr_children, 2), and
+    returns their bounds. The search stops when the top box is a single
+    window, which is then optimal (unless boxes were dropped to cap the heap
+    to `max_heap_size`; see `efficient_subwindow_search`). If `max_nr_iter`
+    batches are used up first, returns the best window found so far, as
+    `efficient_subwindow_search` does; `stats['nr_nodes']` counts the popped
+    boxes.
+
+    """
+
+    nr_nodes = 0
+    nr_wasted_pops = 0
+    resolved = False
+    nr_dropped = 0
+    max_dropped_bound = - np.inf
+    max_size = len(heap)
+    incumbent = None
+
+    for ii in xrange(max_nr_iter):
+
+        popped = []
+        while len(popped) < batch_size and len(heap) > 0:
+            score, bounds = heapq.heappop(heap)
+            nr_nodes += 1
+            if len(blacklist) > 0 and bounds_in_blacklist(bounds, blacklist):
+                nr_wasted_pops += 1
+                continue
+            popped.append((score, bounds))
+
+        # The heap ran out without a single window.
+        if len(popped) == 0:
+            break
+
+        score, bounds = popped[0]
+
+        if bounds.get_maximum_index() == -1:
+            for entry in popped[1:]:
+                heapq.heappush(heap, entry)
+            resolved = True
+            break
+
+        children = []
+        for entry in popped:
+            split_index = entry[1].get_maximum_index()
+            if split_index == -1:
+                heapq.heappush(heap, entry)
+            else:
+                children += split_bounds(entry[1], split_index)
+
+        if len(children) == 0:
+            continue
+
+        scores = batch_bounding_function(
+            np.vstack([child.low for child in children]),
+            np.vstack([child.high for child in children]))
+
+        for child_score, child in zip(scores, children):
+            heapq.heappush(heap, (- child_score, child))
+            # The banned windows are bounded by `-inf`.
+            if (child.get_maximum_index() == -1 and child_score != - np.inf and
+                (incumbent is None or - child_score < incumbent[0])):
+                incumbent = (- child_score, child)
+
+        max_size = max(max_size, len(heap))
+        dropped, dropped_bound = cap_heap(heap, max_heap_size)
+        nr_dropped += dropped
+        max_dropped_bound = max(max_dropped_bound, dropped_bound)
+
+    if resolved:
+        upper_bound = max(- score, max_dropped_bound)
+    else:
+        # Search interrupted: the best candidate is either the best fully
+        # resolved window seen so far or the middle of the top box.
+        upper_bound = max(- heap[0][0] if heap else - np.inf, max_dropped_bound)
+        if incumbent is not None:
+            score, bounds = incumbent
+        elif heap:
+            window_score, bounds = middle_window(
+                lambda window: batch_bounding_function(
+                    window.low[np.newaxis], window.high[np.newaxis])[0],
+                heap[0][1], blacklist)
+            score = - window_score
+        else:
+            score, bounds = np.inf, None
+
+    if verbose > 1:
+        print "Evaluated %d states in %d batches." % (nr_nodes, ii + 1)
+
+    if stats is not None:
+        stats['nr_wasted_pops'] = nr_wasted_pops
+        stats['nr_nodes'] = nr_nodes
+        stats['heap_size'] = len(heap)
+        stats['max_heap_size'] = max_size
+        stats['nr_dropped_boxes'] = nr_dropped
+        stats['max_dropped_bound'] = max_dropped_bound
+        stats['resolved'] = resolved
+        stats['upper_bound'] = upper_bound
+        stats['gap'] = upper_bound + score
+
+    if score == np.inf:
+        return - np.inf, None, heap
 
     return - score, (bounds.low + bounds.high) / 2, heap
 
 
 def bounds_in_blacklist(bounds, blacklist):
 
+    if len(bounds.low) > 2:
+        return bounds_in_blacklist_nd(bounds, blacklist)
+
+    # The intersection is not sorted: an empty intersection (its begin after
+    # its end) overlaps no banned window, while its sorted copy could.
     union = np.sort(bounds.get_union())
-    inter = np.sort(bounds.get_intersection())
+    inter = bounds.get_intersection()
 
     def contains(xx, yy):
         return yy[0] <= xx[0] and xx[1] <= yy[1]
@@ -115,17 +457,70 @@ def bounds_in_blacklist(bounds, blacklist):
         any(intersects(inter, window) for window in blacklist))
 
 
-def integral(X):
-    return np.hstack((0, np.cumsum(X)))
+def bounds_in_blacklist_nd(bounds, blacklist):
+    """Same as `bounds_in_blacklist` for boxes in more dimensions: the boxes
+    are banned if their union is contained in a banned box or their
+    intersection overlaps one along every dimension.
+
+    """
+
+    unions = np.sort(bounds.get_unions(), axis=1)
+    inters = bounds.get_intersections()
+
+    for window in blacklist:
+        window = np.reshape(window, (-1, 2))
+        if np.all((window[:, 0] <= unions[:, 0]) & (unions[:, 1] <= window[:, 1])):
+            return True
+        if np.all(
+            np.minimum(inters[:, 1], window[:, 1]) -
+            np.maximum(inters[:, 0], window[:, 0]) > 0):
+            return True
 
+    return False
 
-def pos_neg_integral(scores):
-    """Works only for 1D arrays at the moment, but can be easily extended."""
-    scores = np.hstack([[0], scores])  # Padding.
+
+def integral(X, nr_dims=1, compensated=True):
+    """Cumulative sums along the first `nr_dims` axes, each padded with zeros
+    at the beginning. If `compensated`, the floating point sums are computed
+    with `compensated_cumsum`, so their error does not grow along long
+    movies.
+
+    """
+    X = np.asarray(X)
+    padding = [(1, 0)] * nr_dims + [(0, 0)] * (X.ndim - nr_dims)
+    X = np.pad(X, padding, mode='constant')
+    for axis in xrange(nr_dims):
+        if compensated and X.dtype.kind == 'f':
+            compensated_cumsum(X, axis=axis, out=X)
+        else:
+            np.cumsum(X, axis=axis, out=X)
+    return X
+
+
+def pos_neg_integral(scores, nr_dims=1, compensated=True):
+    """Integrals of the positive and of the negative part of `scores`."""
+    scores = np.asarray(scores)
     pos_scores, neg_scores = scores.copy(), scores.copy()
     idxs = scores >= 0
     pos_scores[~idxs], neg_scores[idxs] = 0, 0
-    return np.cumsum(pos_scores), np.cumsum(neg_scores)
+    return (
+        integral(pos_scores, nr_dims, compensated),
+        integral(neg_scores, nr_dims, compensated))
+
+
+def eval_integral_nd(X, begins, ends):
+    """Sum over the box [begins, ends) from the integral image `X`, using
+    the inclusion-exclusion principle (2^D look-ups for D dimensions).
+
+    """
+    if np.any(ends <= begins):
+        return 0
+    D = len(begins)
+    result = 0
+    for corner in itertools.product((0, 1), repeat=D):
+        idxs = tuple(ends[dd] if cc else begins[dd] for dd, cc in enumerate(corner))
+        result = result + (-1) ** (D - sum(corner)) * X[idxs]
+    return result
 
 
 def eval_integral(X, bb):
@@ -149,6 +544,22 @@ def linear_bounding_function_builder(scores):
     return linear_bounding_function
 
 
+def linear_nd_bounding_function_builder(scores):
+
+    pos_integral_scores, neg_integral_scores = pos_neg_integral(scores, scores.ndim)
+
+    def linear_nd_bounding_function(bounds):
+        unions = bounds.get_unions()
+        inters = bounds.get_intersections()
+
+        pos_union = eval_integral_nd(pos_integral_scores, unions[:, 0], unions[:, 1])
+        neg_inter = eval_integral_nd(neg_integral_scores, inters[:, 0], inters[:, 1])
+
+        return pos_union + neg_inter
+
+    return linear_nd_bounding_function
+
+
 def norm_bounding_function_builder(scores):
 
     pos_integral_scores, neg_integral_scores = pos_neg_integral(scores)
@@ -175,6 +586,518 @@ def norm_bounding_function_builder(scores):
     return norm_bounding_function
 
 
+class ApproxNormsBoundingFunction:
+    """Bound for the approximate power and L2 normalized scores, based on the
+    per visual word quantities of the slices. Same as the Cython class with
+    the same name from `utils_ess`.
+
+    The slices can also be split spatially, in which case the quantities
+    have shape N x nr_bins x K (and their integrals are two dimensional) and
+    the bound is evaluated for tubes spanning a temporal interval and a
+    range of spatial bins. The window length constraints apply only to the
+    temporal dimension.
+
+    """
+    def __init__(
+        self, slice_vw_scores_no_integral, slice_vw_l2_norms_no_integral,
+        pos_slice_vw_scores, neg_slice_vw_scores, slice_vw_counts,
+        slice_vw_l2_norms, min_window, max_window, weight_by_slice_length):
+
+        self.slice_vw_scores_no_integral = slice_vw_scores_no_integral
+        self.slice_vw_l2_norms_no_integral = slice_vw_l2_norms_no_integral
+        self.pos_slice_vw_scores = pos_slice_vw_scores
+        self.neg_slice_vw_scores = neg_slice_vw_scores
+        self.slice_vw_counts = slice_vw_counts
+        self.slice_vw_l2_norms = slice_vw_l2_norms
+
+        self.min_window = min_window
+        self.max_window = max_window
+
+        self.weight_by_slice_length = weight_by_slice_length
+        self.banned_intervals = []
+
+        self.nr_dims = slice_vw_scores_no_integral.ndim - 1
+
+    def __call__(self, bounds):
+        return self.evaluate(bounds)
+
+    def set_banned_intervals(self, banned_intervals):
+        self.banned_intervals = banned_intervals
+
+    def evaluate(self, bounds):
+
+        if self.nr_dims > 1:
+            return self.evaluate_nd(bounds)
+
+        union = bounds.get_union()
+        inter = bounds.get_intersection()
+
+        if inter[0] == inter[1] == union[0] == union[1] or union[0] >= union[1]:
+            return - np.inf
+
+        if inter[1] - inter[0] > self.max_window:
+            return - np.inf
+
+        if union[1] - union[0] < self.min_window:
+            return - np.inf
+
+        # Empty intersection.
+        if inter[1] <= inter[0]:
+
+            return self.empty_intersection_bound(
+                eval_integral(self.slice_vw_counts, union),
+                np.min(self.slice_vw_l2_norms_no_integral[union[0]: union[1]], axis=0),
+                np.max(self.slice_vw_scores_no_integral[union[0]: union[1]], axis=0))
+
+        if (len(self.banned_intervals) > 0 and
+            bounds_in_blacklist(bounds, self.banned_intervals)):
+            return - np.inf
+
+        # An intersection without descriptors leaves the longer windows of
+        # the box unbounded; only a single window is empty.
+        l2_norms_inter = eval_integral(self.slice_vw_l2_norms, inter)
+        if np.all(l2_norms_inter == 0):
+            return - np.inf if np.all(bounds.low == bounds.high) else np.inf
+
+        max_slice_length = union[1] - union[0] if self.weight_by_slice_length else 1.
+        return max_slice_length * self.integral_bound(
+            eval_integral(self.pos_slice_vw_scores, union),
+            eval_integral(self.neg_slice_vw_scores, inter),
+            eval_integral(self.slice_vw_counts, union),
+            eval_integral(self.slice_vw_counts, inter),
+            l2_norms_inter)
+
+    def evaluate_nd(self, bounds):
+
+        unions = bounds.get_unions()
+        inters = bounds.get_intersections()
+        u0, u1 = unions[:, 0], unions[:, 1]
+        i0, i1 = inters[:, 0], inters[:, 1]
+
+        if np.any(u0 >= u1):
+            return - np.inf
+
+        if i1[0] - i0[0] > self.max_window:
+            return - np.inf
+
+        if u1[0] - u0[0] < self.min_window:
+            return - np.inf
+
+        # The tubes span at least one bin, so each of them contains the bins
+        # from the latest possible begin, `min(high_begin, high_end - 1)`, to
+        # the earliest possible end, `max(low_end, low_begin + 1)`.
+        i0[1:] = np.minimum(bounds.high[2::2], bounds.high[3::2] - 1)
+        i1[1:] = np.maximum(bounds.low[3::2], bounds.low[2::2] + 1)
+
+        # Empty temporal intersection or no bin common to all the tubes.
+        if np.any(i1 <= i0):
+            K = self.slice_vw_scores_no_integral.shape[-1]
+            region = tuple(slice(bb, ee) for bb, ee in unions)
+            return self.empty_intersection_bound(
+                eval_integral_nd(self.slice_vw_counts, u0, u1),
+                self.slice_vw_l2_norms_no_integral[region].reshape(-1, K).min(axis=0),
+                self.slice_vw_scores_no_integral[region].reshape(-1, K).max(axis=0))
+
+        if (len(self.banned_intervals) > 0 and
+            bounds_in_blacklist(bounds, self.banned_intervals)):
+            return - np.inf
+
+        # An intersection without descriptors leaves the longer windows of
+        # the box unbounded; only a single window is empty.
+        l2_norms_inter = eval_integral_nd(self.slice_vw_l2_norms, i0, i1)
+        if np.all(l2_norms_inter == 0):
+            return - np.inf if np.all(bounds.low == bounds.high) else np.inf
+
+        max_slice_length = u1[0] - u0[0] if self.weight_by_slice_length else 1.
+        return max_slice_length * self.integral_bound(
+            eval_integral_nd(self.pos_slice_vw_scores, u0, u1),
+            eval_integral_nd(self.neg_slice_vw_scores, i0, i1),
+            eval_integral_nd(self.slice_vw_counts, u0, u1),
+            eval_integral_nd(self.slice_vw_counts, i0, i1),
+            l2_norms_inter)
+
+    def empty_intersection_bound(self, counts_union, l2_norms_union, scores_union):
+        """Bound from the per visual word minimum L2 norms and maximum scores
+        of the slices in the union.
+
+        """
+
+        idxs = counts_union != 0
+        bound_approx_l2_norm = np.sum(l2_norms_union[idxs] / counts_union[idxs])
+
+        if bound_approx_l2_norm == 0:
+            return + np.inf
+
+        bound_sqrt_scores = np.sum(
+            scores_union[idxs] / np.sqrt(counts_union[idxs]))
+
+        return bound_sqrt_scores / np.sqrt(bound_approx_l2_norm)
+
+    def integral_bound(
+        self, score_union, score_inter, counts_union, counts_inter,
+        l2_norms_inter):
+        """Bound from the integral quantities over the union and the
+        intersection of the box.
+
+        """
+
+        idxs = (counts_inter != 0) & (counts_union != 0)
+
+        bound_sqrt_scores = np.sum(
+            (score_union[idxs] + score_inter[idxs]) / np.sqrt(counts_inter[idxs]))
+        bound_approx_l2_norm = np.sum(l2_norms_inter[idxs] / counts_union[idxs])
+
+        if bound_approx_l2_norm == 0:
+            return - np.inf
+
+        return bound_sqrt_scores / np.sqrt(bound_approx_l2_norm)
+
+    def evaluate_batch(self, lows, highs):
+        """Vectorized version of `evaluate` over a batch of boxes, given by the
+        `low` and `high` indexes, both of shape (nr_boxes, 2).
+
+        """
+
+        u0, u1 = lows[:, 0], highs[:, 1]
+        i0, i1 = highs[:, 0], lows[:, 1]
+
+        bounds = np.zeros(len(lows))
+
+        illegal = (
+            ((i0 == i1) & (i1 == u0) & (u0 == u1)) | (u0 >= u1) |
+            (i1 - i0 > self.max_window) |
+            (u1 - u0 < self.min_window))
+        bounds[illegal] = - np.inf
+
+        # Boxes with empty intersection need the minimum and maximum over the
+        # slices, which cannot be computed from integral quantities.
+        empty = ~illegal & (i1 <= i0)
+        for jj in np.where(empty)[0]:
+            bounds[jj] = self.evaluate(Bounds(lows[jj], highs[jj]))
+
+        idxs = ~illegal & ~empty
+        u0, u1, i0, i1 = u0[idxs], u1[idxs], i0[idxs], i1[idxs]
+
+        l2_norms_inter = self.slice_vw_l2_norms[i1] - self.slice_vw_l2_norms[i0]
+        score_union = self.pos_slice_vw_scores[u1] - self.pos_slice_vw_scores[u0]
+        score_inter = self.neg_slice_vw_scores[i1] - self.neg_slice_vw_scores[i0]
+        counts_union = self.slice_vw_counts[u1] - self.slice_vw_counts[u0]
+        counts_inter = self.slice_vw_counts[i1] - self.slice_vw_counts[i0]
+
+        valid = (counts_inter != 0) & (counts_union != 0)
+        counts_inter[~valid] = 1
+        counts_union[~valid] = 1
+
+        bound_sqrt_scores = np.sum(
+            np.where(valid, (score_union + score_inter) / np.sqrt(counts_inter), 0),
+            axis=1)
+        bound_approx_l2_norm = np.sum(
+            np.where(valid, l2_norms_inter / counts_union, 0), axis=1)
+
+        max_slice_length = u1 - u0 if self.weight_by_slice_length else 1.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            batch_bounds = (
+                bound_sqrt_scores / np.sqrt(bound_approx_l2_norm) *
+                max_slice_length)
+
+        batch_bounds[bound_approx_l2_norm == 0] = - np.inf
+
+        # As in `evaluate`, only a single window without descriptors is empty.
+        no_norms = np.all(l2_norms_inter == 0, axis=1)
+        batch_bounds[no_norms] = np.where(
+            np.all(lows[idxs] == highs[idxs], axis=1)[no_norms], - np.inf, np.inf)
+
+        if len(self.banned_intervals) > 0:
+            banned = np.array(self.banned_intervals)
+            union = np.sort(np.vstack((u0, u1)).T, axis=1)
+            inter = np.vstack((i0, i1)).T
+            contained = (
+                (banned[:, 0] <= union[:, 0, np.newaxis]) &
+                (union[:, 1, np.newaxis] <= banned[:, 1]))
+            intersecting = (
+                np.minimum(inter[:, 1, np.newaxis], banned[:, 1]) -
+                np.maximum(inter[:, 0, np.newaxis], banned[:, 0]) > 0)
+            batch_bounds[np.any(contained | intersecting, axis=1)] = - np.inf
+
+        bounds[idxs] = batch_bounds
+        return bounds
+
+
+def prune_heap(bounding_function, heap, intervals, stats=None):
+    """Removes from the heap the boxes that are banned by the newly detected
+    `intervals`, in bulk, and returns the compacted heap. The bounds of the
+    other boxes do not change, as the bounding function uses the banned
+    intervals only to discard the banned boxes.
+
+    """
+
+    nr_dropped = 0
+    pruned_heap = []
+
+    for score, bounds in heap:
+
+        if bounds_in_blacklist(bounds, intervals):
+            nr_dropped += 1
+            continue
+
+        pruned_heap.append((score, bounds))
+
+    heapq.heapify(pruned_heap)
+
+    if stats is not None:
+        stats['nr_dropped'] = nr_dropped
+
+    return pruned_heap
+
+
+def build_approx_norms_data(
+    slice_vw_scores, slice_vw_counts, slice_vw_l2_norms, nr_dims=1):
+    """Computes the integral quantities used by the approximate normalizations
+    bounding function from the per visual word scores, counts and L2 norms of
+    each slice (arrays of shape N x K, or N x nr_bins x K for `nr_dims=2`).
+
+    """
+    slice_vw_scores = np.asarray(slice_vw_scores, dtype=np.float64)
+    slice_vw_counts = np.asarray(slice_vw_counts, dtype=np.float64)
+    slice_vw_l2_norms = np.asarray(slice_vw_l2_norms, dtype=np.float64)
+
+    pos_slice_vw_scores, neg_slice_vw_scores = pos_neg_integral(
+        slice_vw_scores, nr_dims)
+
+    return ApproxNormsData(
+        slice_vw_scores=slice_vw_scores,
+        slice_vw_l2_norms=slice_vw_l2_norms,
+        pos_slice_vw_scores=pos_slice_vw_scores,
+        neg_slice_vw_scores=neg_slice_vw_scores,
+        slice_vw_counts=integral(slice_vw_counts, nr_dims),
+        integral_slice_vw_l2_norms=integral(slice_vw_l2_norms, nr_dims))
+
+
+def get_engine(name):
+    """Returns the data structures and search functions of the `python` or
+    of the `cython` implementation of the branch-and-bound search. Only the
+    former handles more than one dimension.
+
+    """
+    if name == 'python':
+        return Engine(
+            bounding_function=ApproxNormsBoundingFunction,
+            init_bounds=lambda shape: Bounds(
+                np.zeros(2 * len(shape), dtype=np.int), np.repeat(shape, 2)),
+            init_interval=lambda idxs: tuple(idxs),
+            search=efficient_subwindow_search,
+            search_top_k=efficient_subwindow_search_top_k,
+            batch_search=lambda bounding_function, heap, batch_size, **kwargs: (
+                batch_efficient_subwindow_search(
+                    bounding_function.evaluate_batch, heap, batch_size,
+                    **kwargs)),
+            prune_heap=prune_heap)
+    elif name == 'cython':
+        import utils_ess
+        return Engine(
+            bounding_function=utils_ess.ApproxNormsBoundingFunction,
+            init_bounds=lambda shape: utils_ess.b_init_bounds(
+                (0, 0), (shape[0], shape[0])),
+            init_interval=lambda idxs: utils_ess.b_init_interval(tuple(idxs)),
+            search=utils_ess.efficient_subwindow_search,
+            search_top_k=utils_ess.efficient_subwindow_search_top_k,
+            batch_search=utils_ess.batch_efficient_subwindow_search,
+            prune_heap=utils_ess.prune_heap)
+    else:
+        raise ValueError("Unknown ESS engine %s." % name)
+
+
+def approx_norms_ess(
+    data, min_window, max_window, weight_by_slice_length, engine='cython',
+    top_k=1, prune=False, batch_size=1, max_nr_iter=MAX_NR_ITER,
+    time_budget=None, max_heap_size=None, ban_spatially=False, stats=None,
+    timings=None):
+    """Repeatedly searches for the best window that does not overlap the
+    previous detections, until the windows cover all the slices or no legal
+    window is left. Returns a list of `(score, (begin_idx, end_idx))` in the
+    order the windows were found.
+
+    For spatially split slices the windows are tubes and their indexes are
+    `(begin_idx, end_idx, begin_bin, end_bin)`. By default a detected tube
+    bans the overlapping time intervals for all the bins; with
+    `ban_spatially` it bans only the tubes it overlaps. Tubes are searched
+    only by the `python` engine, one at a time.
+
+    If given, the `stats` and `timings` lists are extended with the search
+    statistics and with the duration of each detection step.
+
+    """
+
+    shape = data.slice_vw_scores.shape[: -1]
+    N = shape[0]
+
+    if len(shape) > 1 and (engine != 'python' or top_k > 1 or batch_size > 1):
+        raise ValueError(
+            "Tubes are searched only by the `python` engine, one at a time.")
+
+    # The batched search is bounded by the number of batches only.
+    assert batch_size == 1 or time_budget is None, (
+        "The time budget is not supported by the batched search.")
+
+    # Bans the whole spatial extent of the detections.
+    full_extent = sum(((0, nn) for nn in shape[1:]), ())
+
+    engine = get_engine(engine)
+
+    bounding_function = engine.bounding_function(
+        data.slice_vw_scores, data.slice_vw_l2_norms,
+        data.pos_slice_vw_scores, data.neg_slice_vw_scores,
+        data.slice_vw_counts, data.integral_slice_vw_l2_norms,
+        min_window=min_window, max_window=max_window,
+        weight_by_slice_length=weight_by_slice_length)
+
+    banned_intervals = []
+    bounding_function.set_banned_intervals(banned_intervals)
+
+    heap = [(0, engine.init_bounds(shape))]
+    detections = []
+    covered = 0
+    ii = 0
+
+    while True:
+
+        start = time.time()
+
+        search_stats = {}
+        nr_banned_intervals = len(banned_intervals)
+
+        if top_k > 1:
+            # The search bans the windows it finds.
+            windows = engine.search_top_k(
+                bounding_function, heap, top_k, blacklist=banned_intervals,
+                stats=search_stats, max_nr_iter=max_nr_iter,
+                time_budget=time_budget, max_heap_size=max_heap_size)
+            windows = [(score, tuple(idxs)) for score, idxs in windows]
+        else:
+            if batch_size > 1:
+                score, idxs, heap = engine.batch_search(
+                    bounding_function, heap, batch_size,
+                    blacklist=banned_intervals, stats=search_stats,
+                    max_nr_iter=max_nr_iter, max_heap_size=max_heap_size)
+            else:
+                score, idxs, heap = engine.search(
+                    bounding_function, heap, blacklist=banned_intervals,
+                    stats=search_stats, max_nr_iter=max_nr_iter,
+                    time_budget=time_budget, max_heap_size=max_heap_size)
+            windows = [(score, tuple(idxs))] if score != - np.inf else []
+            banned_intervals += [
+                engine.init_interval(idxs if ban_spatially else idxs[: 2] + full_extent)
+                for _, idxs in windows]
+
+        if covered >= N or len(windows) == 0:
+            break
+
+        # Drop the boxes that are now banned.
+        if prune:
+            heap = engine.prune_heap(
+                bounding_function, heap,
+                banned_intervals[nr_banned_intervals:], stats=search_stats)
+
+        search_stats['heap_size'] = len(heap)
+        search_stats['nr_detections'] = len(windows)
+
+        if stats is not None:
+            stats.append((ii, search_stats))
+
+        for score, idxs in windows:
+            detections.append((score, idxs))
+            covered += idxs[1] - idxs[0]
+
+        if timings is not None:
+            timings.append((ii, time.time() - start))
+
+        ii += 1
+
+        if len(heap) == 0:
+            break
+
+    return detections
+
+
+def synthetic_approx_norms_data(N, K, seed=0):
+    """Random per visual word quantities for `N` slices and `K` words."""
+    rng = np.random.RandomState(seed)
+    slice_vw_counts = rng.gamma(1., 1., (N, K)) * (rng.rand(N, K) < 0.5)
+    slice_vw_scores = rng.randn(N, K) * slice_vw_counts
+    slice_vw_l2_norms = (rng.rand(N, K) + 0.1) * slice_vw_counts
+    return build_approx_norms_data(
+        slice_vw_scores, slice_vw_counts, slice_vw_l2_norms)
+
+
+def test_engines(nr_tests, verbose=0):
+    """Checks that the `python` and `cython` engines return the same
+    detections on synthetic data, for each of the search variants.
+
+    """
+    VARIANTS = [
+        {},
+        {'weight_by_slice_length': True},
+        {'top_k': 3},
+        {'prune': True},
+        {'batch_size': 8},
+        {'max_heap_size': 64},
+        {'max_nr_iter': 50},
+        {'top_k': 3, 'max_heap_size': 64},
+        {'batch_size': 8, 'max_heap_size': 64},
+        {'batch_size': 8, 'max_nr_iter': 20}]
+
+    nr_failed = 0
+
+    for seed in xrange(nr_tests):
+
+        data = synthetic_approx_norms_data(N=60, K=16, seed=seed)
+
+        for variant in VARIANTS:
+
+            params = {
+                'min_window': 2,
+                'max_window': 20,
+                'weight_by_slice_length': False}
+            params.update(variant)
+
+            detections = [
+                approx_norms_ess(data, engine=engine, **params)
+                for engine in ('python', 'cython')]
+
+            idxs = [[ii for _, ii in dd] for dd in detections]
+            scores = [np.array([ss for ss, _ in dd]) for dd in detections]
+
+            same = (
+                idxs[0] == idxs[1] and
+                np.allclose(scores[0], scores[1], rtol=1e-7, atol=0))
+            nr_failed += not same
+
+            if verbose or not same:
+                print "%s seed=%d %s: %d detections" % (
+                    "OK  " if same else "FAIL", seed, variant,
+                    len(detections[0]))
+
+    print "%d failed out of %d." % (nr_failed, nr_tests * len(VARIANTS))
+    return nr_failed == 0
+
+
+def benchmark_engines(N, K, nr_repeats=3, engines=('python', 'cython')):
+    """Times the full detection loop of each engine on synthetic data."""
+    data = synthetic_approx_norms_data(N, K)
+    params = {'min_window': 2, 'max_window': max(N / 4, 2),
+              'weight_by_slice_length': False}
+
+    print "%8s %10s %10s %8s" % ('engine', 'best (s)', 'mean (s)', 'nr_dets')
+    for engine in engines:
+        durations = []
+        for _ in xrange(nr_repeats):
+            start = time.time()
+            detections = approx_norms_ess(data, engine=engine, **params)
+            durations.append(time.time() - start)
+        print "%8s %10.3f %10.3f %8d" % (
+            engine, np.min(durations), np.mean(durations), len(detections))
+
+
 def max_subarray(A):
     """Maximum sub-array search (from Wikipedia)."""
     max_ending_here = max_so_far = 0
@@ -211,6 +1134,56 @@ def test(bounding_function_builder, nr_tests, verbose=0):
         # assert scores[idxs[0]: idxs[1]].sum() == max_subarray(scores)
 
 
+def test_nd(nr_tests, verbose=0):
+    """Checks the multi-dimensional search: (i) the linear bound finds the
+    maximum sub-box found by brute force; (ii) tubes over a single spatial
+    bin give the same detections as the one dimensional windows.
+
+    """
+    nr_failed = 0
+
+    for seed in xrange(nr_tests):
+
+        rng = np.random.RandomState(seed)
+        scores = rng.randn(12, 4)
+        T, S = scores.shape
+
+        best = max(
+            scores[t0: t1, s0: s1].sum()
+            for t0 in xrange(T) for t1 in xrange(t0 + 1, T + 1)
+            for s0 in xrange(S) for s1 in xrange(s0 + 1, S + 1))
+
+        heap = [(0, Bounds(np.zeros(4, dtype=np.int), np.array((T, T, S, S))))]
+        score, idxs, _ = efficient_subwindow_search(
+            linear_nd_bounding_function_builder(scores), heap, verbose=verbose)
+
+        same_linear = np.allclose(score, best)
+
+        data = synthetic_approx_norms_data(N=40, K=8, seed=seed)
+        tube_data = build_approx_norms_data(
+            data.slice_vw_scores[:, np.newaxis],
+            np.diff(data.slice_vw_counts, axis=0)[:, np.newaxis],
+            data.slice_vw_l2_norms[:, np.newaxis], nr_dims=2)
+
+        params = {'min_window': 2, 'max_window': 15,
+                  'weight_by_slice_length': False, 'engine': 'python'}
+        windows = approx_norms_ess(data, **params)
+        tubes = approx_norms_ess(tube_data, **params)
+
+        same_tubes = (
+            [ii for _, ii in windows] == [ii[: 2] for _, ii in tubes] and
+            np.allclose([ss for ss, _ in windows], [ss for ss, _ in tubes]))
+
+        nr_failed += not (same_linear and same_tubes)
+
+        if verbose or not (same_linear and same_tubes):
+            print "seed=%d linear: %s (%.3f vs %.3f) tubes: %s" % (
+                seed, same_linear, score, best, same_tubes)
+
+    print "%d failed out of %d." % (nr_failed, nr_tests)
+    return nr_failed == 0
+
+
 def main():
     BUILDERS = {
         'linear': linear_bounding_function_builder,
@@ -220,20 +1193,36 @@ def main():
     parser = argparse.ArgumentParser(
         description="Efficient sub-window search with branch and bound method.")
 
+    parser.add_argument(
+        '-t', '--task', choices=['test', 'test_nd', 'test_engines', 'benchmark'],
+        default='test', help="what to run.")
     parser.add_argument(
         '-f', '--bounding_function', choices=BUILDERS.keys(),
         help="type of the bounding function.")
     parser.add_argument(
         '--nr_tests', type=int, default=1, help="number of tests to run.")
+    parser.add_argument(
+        '-N', '--nr_slices', type=int, default=500,
+        help="number of slices for the benchmark.")
+    parser.add_argument(
+        '-K', '--nr_visual_words', type=int, default=64,
+        help="number of visual words for the benchmark.")
     parser.add_argument(
         '-v', '--verbose', action='count', help="verbosity level.")
 
     args = parser.parse_args()
 
-    test(
-        BUILDERS[args.bounding_function],
-        nr_tests=args.nr_tests,
-        verbose=args.verbose)
+    if args.task == 'test':
+        test(
+            BUILDERS[args.bounding_function],
+            nr_tests=args.nr_tests,
+            verbose=args.verbose)
+    elif args.task == 'test_nd':
+        test_nd(nr_tests=args.nr_tests, verbose=args.verbose)
+    elif args.task == 'test_engines':
+        test_engines(nr_tests=args.nr_tests, verbose=args.verbose)
+    elif args.task == 'benchmark':
+        benchmark_engines(args.nr_slices, args.nr_visual_words)
 
 
 if __name__ == "__main__":
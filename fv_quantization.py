@@ -0,0 +1,194 @@
+"""Compressed storage of the slice Fisher vectors. Each slice stores, for
+each visual word, the `2D` components of its Fisher vector as int8 codes
+and a single float32 scale. The per visual word scores and L2 norms, which
+are all that the approximate normalizations need, are computed directly
+from the codes, one block of slices at a time, and the scales are applied
+to the per visual word sums.
+
+"""
+import argparse
+import numpy as np
+import time
+
+
+BLOCK_SIZE = 1024
+MAX_CODE = 127
+
+
+class QuantizedFisherVectors(object):
+    """Slice Fisher vectors quantized per visual word: the component `d` of
+    the visual word `k` of slice `n` is approximated by
+    `codes[n, d] * scales[n, k]`. The layout of the components is the one
+    of `build_visual_word_mask`.
+
+    """
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def K(self):
+        return self.scales.shape[1]
+
+    @property
+    def D(self):
+        return self.codes.shape[1] / 2 / self.K
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __mul__(self, coef):
+        """Multiplies the rows by `coef`, of shape `(N, 1)`, as for an array;
+        only the scales change.
+
+        """
+        coef = np.asarray(coef)
+        assert coef.shape == (len(self), 1), coef.shape
+        return QuantizedFisherVectors(
+            self.codes, (self.scales * coef).astype(np.float32))
+
+    @classmethod
+    def quantize(cls, fisher_vectors, K, block_size=BLOCK_SIZE):
+        N, dim = fisher_vectors.shape
+        D = dim / 2 / K
+
+        codes = np.empty((N, dim), dtype=np.int8)
+        scales = np.empty((N, K), dtype=np.float32)
+
+        for ii in xrange(0, N, block_size):
+            block = np.asarray(
+                fisher_vectors[ii: ii + block_size], dtype=np.float32)
+            block = block.reshape(len(block), 2, K, D)
+
+            scale = np.abs(block).max(axis=3).max(axis=1) / MAX_CODE
+            with np.errstate(divide='ignore'):
+                inv_scale = np.where(scale > 0, 1. / scale, 0.)
+
+            codes[ii: ii + block_size] = np.rint(
+                block * inv_scale[:, np.newaxis, :, np.newaxis]).reshape(
+                    len(block), dim)
+            scales[ii: ii + block_size] = scale
+
+        return cls(codes, scales)
+
+    def dequantize(self):
+        N = len(self)
+        codes = self.codes.reshape(N, 2, self.K, self.D)
+        return (
+            codes * self.scales[:, np.newaxis, :, np.newaxis]).reshape(N, -1)
+
+    to_dense = dequantize
+
+    def visual_word_sums(self, func, visual_word_mask, power=1, block_size=BLOCK_SIZE):
+        """Per visual word sums, given by `visual_word_mask`, of `func`
+        applied to the Fisher vectors, where `func` is element-wise and
+        homogeneous of degree `power`, so it can be applied to the codes.
+
+        """
+        out = np.empty((len(self), visual_word_mask.shape[1]))
+        for ii in xrange(0, len(self), block_size):
+            codes = self.codes[ii: ii + block_size].astype(np.float32)
+            out[ii: ii + block_size] = (
+                func(codes) * visual_word_mask *
+                self.scales[ii: ii + block_size] ** power)
+        return out
+
+    def visual_word_l2_norm(self, visual_word_mask):
+        return self.visual_word_sums(np.square, visual_word_mask, power=2)
+
+    def visual_word_scores(self, weights, visual_word_mask):
+        return self.visual_word_sums(lambda X: - X * weights, visual_word_mask)
+
+
+def main():
+
+    from scipy import sparse
+
+    # Run as a script, this module is `__main__`; the class is imported from
+    # `fv_quantization`, as the one that `ssqrt_l2_approx` dispatches on.
+    from fv_quantization import QuantizedFisherVectors
+
+    from ssqrt_l2_approx import approximate_video_scores
+    from ssqrt_l2_approx import build_visual_word_mask
+    from ssqrt_l2_approx import visual_word_l2_norm
+    from ssqrt_l2_approx import visual_word_scores
+
+    parser = argparse.ArgumentParser(
+        description=("Reports the size and the accuracy of the quantized Fisher "
+                     "vectors, on random or on cached slices."))
+
+    parser.add_argument('-N', '--nr_slices', type=int, default=2000, help="number of slices.")
+    parser.add_argument('-K', '--nr_clusters', type=int, default=256, help="vocabulary size.")
+    parser.add_argument('-D', '--nr_dims', type=int, default=64, help="descriptor dimension.")
+    parser.add_argument(
+        '--cache', default=None,
+        help=("cache file of `load_slices` or `load_data_delta_0`, whose first "
+              "array holds the slice Fisher vectors (needs `-K` and `-D`)."))
+    parser.add_argument('--seed', type=int, default=0, help="random seed.")
+
+    args = parser.parse_args()
+
+    D, K = args.nr_dims, args.nr_clusters
+    rng = np.random.RandomState(args.seed)
+
+    if args.cache:
+        with open(args.cache, 'r') as ff:
+            fisher_vectors = np.load(ff)
+    else:
+        # Sparse visual word activations, as for short slices.
+        active = rng.rand(args.nr_slices, 1, K, 1) < 0.3
+        fisher_vectors = (
+            rng.randn(args.nr_slices, 2, K, D) * active *
+            rng.gamma(1., 1., (args.nr_slices, 1, K, 1))).reshape(args.nr_slices, -1)
+        fisher_vectors = fisher_vectors.astype(np.float32)
+
+    N = len(fisher_vectors)
+    nr_descs = rng.randint(1, 500, N).astype(np.float64)[:, np.newaxis]
+    counts = np.abs(fisher_vectors.reshape(N, 2, K, D)[:, 0, :, 0]) + 1e-3
+    weights = rng.randn(1, 2 * K * D).astype(np.float32)
+    visual_word_mask = build_visual_word_mask(D, K)
+    video_mask = sparse.csr_matrix(np.ones((1, N)))
+
+    start = time.time()
+    quantized = QuantizedFisherVectors.quantize(fisher_vectors, K)
+    print "Quantized %d slices in %.2f s." % (N, time.time() - start)
+    print "Size: %.1f MB float32, %.1f MB quantized (%.2fx smaller)." % (
+        fisher_vectors.nbytes / 2. ** 20, quantized.nbytes / 2. ** 20,
+        float(fisher_vectors.nbytes) / quantized.nbytes)
+
+    relative_error = lambda xx, yy: np.linalg.norm(xx - yy) / np.linalg.norm(xx)
+
+    print "Relative error of the Fisher vectors: %.2e" % relative_error(
+        fisher_vectors, quantized.dequantize())
+
+    exact_scores = visual_word_scores(fisher_vectors * nr_descs, weights, 0, visual_word_mask)
+    exact_l2_norms = visual_word_l2_norm(fisher_vectors * nr_descs, visual_word_mask)
+
+    start = time.time()
+    scores = visual_word_scores(quantized * nr_descs, weights, 0, visual_word_mask)
+    l2_norms = visual_word_l2_norm(quantized * nr_descs, visual_word_mask)
+    print "Scored the quantized slices in %.2f s." % (time.time() - start)
+
+    print "Relative error of the visual word scores: %.2e" % relative_error(
+        exact_scores, scores)
+    print "Relative error of the visual word L2 norms: %.2e" % relative_error(
+        exact_l2_norms, l2_norms)
+
+    slice_counts = counts * nr_descs
+    exact_score = approximate_video_scores(
+        exact_scores, slice_counts, exact_l2_norms, nr_descs, video_mask)
+    score = approximate_video_scores(
+        scores, slice_counts, l2_norms, nr_descs, video_mask)
+    print "Video score: %.6f float32, %.6f quantized." % (exact_score[0], score[0])
+
+
+if __name__ == '__main__':
+    main()
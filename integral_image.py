@@ -0,0 +1,249 @@
+"""Integral images (prefix sums along the rows) for the sliding windows.
+
+The prefix sums of long movies are large compared to the sums over short
+windows, which are differences of far apart prefix sums, so their rounding
+errors do not cancel. `IntegralImage` stores the prefix sums relative to
+anchors placed every few rows, and the anchors as compensated (double-double)
+sums; `compensated_cumsum` computes plain prefix sums whose error does not
+grow with the number of rows. The prefix sums are accumulated in float64 and
+can be stored in float32.
+
+"""
+import argparse
+import numpy as np
+import time
+
+
+CHUNK_SIZE = 4096
+
+
+def two_sum(a, b):
+    """Error-free transformation: `a + b = s + e` exactly, with `s` the
+    rounded sum.
+
+    """
+    s = a + b
+    bb = s - a
+    e = (a - (s - bb)) + (b - bb)
+    return s, e
+
+
+def compensated_cumsum(X, axis=0, out=None, residuals=False, block_size=CHUNK_SIZE):
+    """Cumulative sum along `axis` whose error does not grow with the length
+    of `X`: `np.cumsum` sums the rows within blocks of `block_size` and the
+    block totals are accumulated as double-double (high and low part) sums.
+    The result is stored in `out` (a new float64 array by default, possibly
+    `X` itself). With `residuals`, also returns the low parts, the exact
+    prefix sums minus the stored ones, in float64.
+
+    """
+    X = np.asarray(X)
+    if out is None:
+        out = np.empty(X.shape, dtype=np.float64)
+    lows = np.empty(X.shape) if residuals else None
+
+    X_, out_ = np.swapaxes(X, 0, axis), np.swapaxes(out, 0, axis)
+    lows_ = np.swapaxes(lows, 0, axis) if residuals else None
+
+    hi = np.zeros(X_.shape[1:])
+    lo = np.zeros(X_.shape[1:])
+
+    for ii in xrange(0, len(X_), block_size):
+        local = np.cumsum(X_[ii: ii + block_size], axis=0, dtype=np.float64)
+        sums, errors = two_sum(hi, local + lo)
+        out_[ii: ii + block_size] = sums
+        if residuals:
+            lows_[ii: ii + block_size] = (sums - out_[ii: ii + block_size]) + errors
+        hi, error = two_sum(hi, local[-1])
+        lo += error
+
+    return (out, lows) if residuals else out
+
+
+class IntegralImage(object):
+    """Integral image `P` of a matrix `X` of shape `(N, d)`: `P[0] = 0` and
+    `P[i] = X[0] + ... + X[i - 1]`, so that the sum of the rows in
+    `[begin, end)` is `P[end] - P[begin]`. It has the shape `(N + 1, d)` and
+    it can be aggregated with the sparse masks of the integral sliding
+    windows (see `sum_by`).
+
+    The prefix sums are split as `P[i] = A[q] + L[i]`, where the anchor
+    `A[q] = P[q * S]` is stored as a double-double sum (see
+    `compensated_cumsum`) and `L[i]` sums the rows from `q * S` to `i`; so
+    the window sums do not lose precision far into the movie.
+
+    With `block_size = 1`, the anchors are placed every `chunk_size` rows
+    and the local sums `L[1], ..., L[N]` are stored in a buffer of shape
+    `(N, d)` and of type `dtype`; if `overwrite`, `X` itself is used as the
+    buffer, when it has this type. With `block_size = B > 1`, the anchors are
+    placed every `B` rows and the local sums are recomputed from `X` when
+    queried.
+
+    """
+    def __init__(
+        self, X, block_size=1, dtype=np.float64, overwrite=False,
+        chunk_size=CHUNK_SIZE):
+
+        assert X.ndim == 2, X.shape
+        assert block_size >= 1, block_size
+
+        N, d = X.shape
+        self.block_size = block_size
+        self.anchor_size = chunk_size if block_size == 1 else block_size
+        self.nr_rows = N
+
+        # The totals of the anchored blocks, summed in place into the anchors.
+        nr_blocks = N / self.anchor_size
+        anchors = np.zeros((nr_blocks + 1, d))
+
+        if block_size == 1:
+
+            if overwrite and X.dtype == dtype and X.flags.c_contiguous:
+                self.local_sums = X
+            else:
+                self.local_sums = np.empty(X.shape, dtype=dtype)
+            self.data = None
+
+            for bb, ii in enumerate(xrange(0, N, chunk_size)):
+                local = np.cumsum(X[ii: ii + chunk_size], axis=0, dtype=np.float64)
+                self.local_sums[ii: ii + chunk_size] = local
+                if bb < nr_blocks:
+                    anchors[bb + 1] = local[-1]
+
+        else:
+
+            self.local_sums = None
+            self.data = X
+
+            blocks_per_chunk = max(1, chunk_size / block_size)
+            for bb in xrange(0, nr_blocks, blocks_per_chunk):
+                nn = min(blocks_per_chunk, nr_blocks - bb)
+                rows = X[bb * block_size: (bb + nn) * block_size]
+                anchors[bb + 1: bb + nn + 1] = rows.reshape(
+                    nn, block_size, d).sum(axis=1, dtype=np.float64)
+
+        self.anchors, self.anchor_residuals = compensated_cumsum(
+            anchors, out=anchors, residuals=True)
+
+    @property
+    def shape(self):
+        return self.nr_rows + 1, self.anchors.shape[1]
+
+    @property
+    def nbytes(self):
+        nbytes = self.anchors.nbytes + self.anchor_residuals.nbytes
+        if self.local_sums is not None:
+            nbytes += self.local_sums.nbytes
+        return nbytes
+
+    def prefix_parts(self, idxs):
+        """The rows `P[idxs]` as the sum of their anchor and of the rest, both
+        in float64; the anchors are exact floats, so their differences are
+        accurate.
+
+        """
+        idxs = np.asarray(idxs, dtype=np.int)
+        anchors, offsets = np.divmod(idxs, self.anchor_size)
+        rest = self.anchor_residuals[anchors]
+
+        if self.block_size == 1:
+            sel = offsets > 0
+            rest[sel] += self.local_sums[idxs[sel] - 1]
+        else:
+            for jj in xrange(self.block_size - 1):
+                sel = offsets > jj
+                if not np.any(sel):
+                    break
+                rest[sel] += self.data[anchors[sel] * self.block_size + jj]
+
+        return self.anchors[anchors], rest
+
+    def prefix_sums(self, idxs):
+        """The rows `P[idxs]`, in float64."""
+        anchors, rest = self.prefix_parts(idxs)
+        return anchors + rest
+
+    def window_sums(self, begins, ends):
+        """Sums of the rows in the windows `[begins, ends)`."""
+        begin_anchors, begin_rest = self.prefix_parts(begins)
+        end_anchors, end_rest = self.prefix_parts(ends)
+        return (end_anchors - begin_anchors) + (end_rest - begin_rest)
+
+    def sum_by(self, mask, chunk_size=CHUNK_SIZE):
+        """Computes `mask * P` for a sparse `mask` with `N + 1` columns, such
+        as those of `build_integral_sliding_window_mask`, querying only the
+        prefix sums of its non-zero columns, a chunk at a time. The anchors
+        and the rest are aggregated separately, so that the anchors cancel
+        before being added to the rest.
+
+        """
+        mask = mask.tocsc()
+        cols = np.where(np.diff(mask.indptr) > 0)[0]
+        out_anchors = np.zeros((mask.shape[0], self.anchors.shape[1]))
+        out_rest = np.zeros((mask.shape[0], self.anchors.shape[1]))
+        for ii in xrange(0, len(cols), chunk_size):
+            chunk_cols = cols[ii: ii + chunk_size]
+            anchors, rest = self.prefix_parts(chunk_cols)
+            out_anchors += mask[:, chunk_cols] * anchors
+            out_rest += mask[:, chunk_cols] * rest
+        return out_anchors + out_rest
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=("Compares the integral images to `np.cumsum`: memory, "
+                     "time and accuracy of the window sums at the end of a "
+                     "long synthetic movie."))
+
+    parser.add_argument(
+        '-N', '--nr_rows', type=int, default=1000000, help="number of slices.")
+    parser.add_argument('-d', '--nr_dims', type=int, default=16, help="number of columns.")
+    parser.add_argument('-w', '--window', type=int, default=8, help="window length.")
+    parser.add_argument(
+        '--nr_windows', type=int, default=1000,
+        help="number of windows checked, at the end of the movie.")
+    parser.add_argument(
+        '-B', '--block_sizes', type=int, nargs='+', default=[1, 16],
+        help="block sizes of the stored prefix sums.")
+    parser.add_argument('--seed', type=int, default=0, help="random seed.")
+
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    # Scores with a positive mean, as the counts and the L2 norms.
+    X = (rng.randn(args.nr_rows, args.nr_dims) + 3).astype(np.float32)
+
+    ends = np.arange(args.nr_rows - args.nr_windows + 1, args.nr_rows + 1)
+    begins = ends - args.window
+    direct = np.vstack([
+        X[begin: end].astype(np.float64).sum(axis=0)
+        for begin, end in zip(begins, ends)])
+
+    def report(name, nbytes, duration, sums):
+        print "%-36s %8.1f MB %7.3f s max error %.2e" % (
+            name, nbytes / 2. ** 20, duration, np.abs(sums - direct).max())
+
+    for dtype in (np.float32, np.float64):
+        start = time.time()
+        P = np.vstack((np.zeros((1, X.shape[1]), dtype=dtype), np.cumsum(X, axis=0, dtype=dtype)))
+        report(
+            "np.cumsum (%s)" % np.dtype(dtype).name, P.nbytes,
+            time.time() - start, P[ends] - P[begins])
+
+    start = time.time()
+    P = compensated_cumsum(np.vstack((np.zeros((1, X.shape[1])), X)))
+    report("compensated_cumsum (float64)", P.nbytes, time.time() - start, P[ends] - P[begins])
+
+    for block_size in args.block_sizes:
+        for dtype in (np.float32, np.float64):
+            start = time.time()
+            integral_image = IntegralImage(X, block_size=block_size, dtype=dtype)
+            sums = integral_image.window_sums(begins, ends)
+            report(
+                "IntegralImage B=%d (%s)" % (block_size, np.dtype(dtype).name),
+                integral_image.nbytes, time.time() - start, sums)
+
+
+if __name__ == '__main__':
+    main()
@@ -306,6 +306,107 @@ CFG.update(hmdb_all_descs_dict)
 CFG.update(hmdb_delta_5)
 
 
+class DiagonalScaler(object):
+    """Divides each dimension by its standard deviation, as the scikit-learn
+    `StandardScaler(with_mean=False)`, but keeps only a float32 vector of
+    scales. It can be fit on blocks of streamed data (`partial_fit`),
+    transforms in place if `copy` is False and is saved as a `.npy` file.
+
+    """
+    def __init__(self, copy=True):
+        self.copy = copy
+        self.scale_ = None
+        self.n_samples_seen_ = 0
+        self.mean_ = None
+        self.m2_ = None
+
+    @property
+    def std_(self):
+        return self.scale_
+
+    def partial_fit(self, X, y=None):
+        """Updates the variances with a block of samples, by merging the
+        per-block means and squared deviations (in double precision).
+
+        """
+        X = np.asarray(X, dtype=np.float64)
+        nn = X.shape[0]
+        if nn == 0:
+            return self
+
+        mean = np.mean(X, axis=0)
+        m2 = np.sum((X - mean) ** 2, axis=0)
+
+        if self.n_samples_seen_ == 0:
+            self.mean_, self.m2_ = mean, m2
+        else:
+            total = self.n_samples_seen_ + nn
+            delta = mean - self.mean_
+            self.mean_ += delta * nn / total
+            self.m2_ += m2 + delta ** 2 * self.n_samples_seen_ * nn / total
+
+        self.n_samples_seen_ += nn
+
+        std = np.sqrt(self.m2_ / self.n_samples_seen_)
+        std[std == 0] = 1.
+        self.scale_ = std.astype(np.float32)
+        return self
+
+    def fit(self, X, y=None, block_size=4096):
+        self.__init__(copy=self.copy)
+        for ii in xrange(0, X.shape[0], block_size):
+            self.partial_fit(X[ii: ii + block_size])
+        return self
+
+    def transform(self, X, y=None, copy=None):
+        copy = self.copy if copy is None else copy
+        if copy:
+            return X / self.scale_
+        X /= self.scale_
+        return X
+
+    def fit_transform(self, X, y=None):
+        return self.fit(X).transform(X)
+
+    def inverse_transform(self, X, copy=None):
+        copy = self.copy if copy is None else copy
+        if copy:
+            return X * self.scale_
+        X *= self.scale_
+        return X
+
+    def save(self, filename):
+        np.save(filename, self.scale_)
+
+    @classmethod
+    def load(cls, filename, copy=True):
+        scaler = cls(copy=copy)
+        scaler.scale_ = np.load(filename).astype(np.float32)
+        return scaler
+
+    def __getstate__(self):
+        # Pickle (for the caches and the worker processes) only the scales.
+        return {'copy': self.copy, 'scale_': self.scale_}
+
+    def __setstate__(self, state):
+        self.__init__(copy=state['copy'])
+        self.scale_ = state['scale_']
+
+
+def apply_scalers(X, scalers):
+    """Applies the scalers in turn, ignoring the `None` entries; `X` is
+    copied once, by the first scaler, and then transformed in place.
+
+    """
+    copy = True
+    for scaler in scalers:
+        if scaler is None:
+            continue
+        X = scaler.transform(X, copy=copy)
+        copy = False
+    return X
+
+
 def my_cacher(*args):
 
     def loader(file, format):
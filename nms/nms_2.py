@@ -1,5 +1,6 @@
 
 import argparse
+import bisect
 import cPickle
 import pdb
 import itertools
@@ -9,7 +10,8 @@ import sys
 import time
 
 
-def non_maxima_supression_0(scored_windows, delta, min_slice, max_slice):
+def non_maxima_supression_0_reference(
+    scored_windows, delta, min_slice, max_slice):
     """Non-maxima supression with zero overlap."""
 
     def generate_overlapping_windows(low, high):
@@ -52,6 +54,124 @@ def non_maxima_supression_0(scored_windows, delta, min_slice, max_slice):
         for window in selected_windows]
 
 
+def non_maxima_supression_0(scored_windows, delta, min_slice, max_slice):
+    """Non-maxima supression with zero overlap. Returns the same windows, in
+    the same order, as `non_maxima_supression_0_reference`, but instead of
+    enumerating the windows that overlap each candidate it looks up the
+    selected windows, which are kept sorted by their begin frame and grouped
+    by the residues of their frames modulo `delta`.
+
+    A window (l, h) is generated as overlapping (a, b) iff
+        l = a - max_slice (mod delta), a - max_slice + delta <= l < b,
+        h = a (mod delta), a + delta <= h < b + max_slice and
+        min_slice <= h - l <= max_slice.
+
+    """
+
+    # Convert frame indexes to integers.
+    scored_windows = [
+        (int(begin_frame), int(end_frame), score)
+        for begin_frame, end_frame, score in scored_windows]
+
+    sorted_windows = sorted(scored_windows, key=lambda xx: xx[2], reverse=True)
+    window_to_score = {
+        (scored_window[0], scored_window[1]): scored_window[2]
+        for scored_window in scored_windows}
+
+    # Bounds the begin frames to look at, given a constraint on the end.
+    max_length = max([high - low for low, high, _ in scored_windows] or [0])
+
+    # The selected windows grouped by `begin % delta` and by the pair
+    # `(begin % delta, end % delta)`; each group stores the sorted begin
+    # frames and the corresponding end frames.
+    selected_by_begin = {}
+    selected_by_begin_end = {}
+    selected_windows = set()
+
+    bisect_left = bisect.bisect_left
+    bisect_right = bisect.bisect_right
+
+    for low, high, score in sorted_windows:
+
+        low_residue = low % delta
+        high_residue = high % delta
+
+        # Is the window blacklisted by one of the selected windows? It needs
+        # begin <= `max_begin` and end > `min_end`; the closest begin frames
+        # are checked first.
+        if (min_slice <= high - low <= max_slice and
+            (low + max_slice - high) % delta == 0 and
+            high_residue in selected_by_begin):
+
+            begins, ends = selected_by_begin[high_residue]
+            min_end = max(low, high - max_slice)
+            max_begin = min(low + max_slice - delta, high - delta)
+
+            first = bisect_left(begins, min_end - max_length + 1)
+            idx = bisect_right(begins, max_begin) - 1
+
+            while idx >= first and ends[idx] <= min_end:
+                idx -= 1
+            if idx >= first:
+                continue
+
+        # Does the window blacklist one of the selected windows?
+        key = ((low - max_slice) % delta, low_residue)
+        if key in selected_by_begin_end:
+
+            begins, ends = selected_by_begin_end[key]
+            idx = bisect_left(begins, low + delta - max_slice)
+            last = bisect_left(begins, high)
+
+            while idx < last and not (
+                low + delta <= ends[idx] < high + max_slice and
+                min_slice <= ends[idx] - begins[idx] <= max_slice):
+                idx += 1
+            if idx < last:
+                continue
+
+        selected_windows.add((low, high))
+
+        for group in (
+            selected_by_begin.setdefault(low_residue, ([], [])),
+            selected_by_begin_end.setdefault((low_residue, high_residue), ([], []))):
+            idx = bisect_right(group[0], low)
+            group[0].insert(idx, low)
+            group[1].insert(idx, high)
+
+    return [
+        (window[0], window[1], window_to_score[(window[0], window[1])])
+        for window in selected_windows]
+
+
+def benchmark(nr_windows, delta, min_slice, max_slice, check=False):
+    """Times the NMS on random scores of `nr_windows` windows aligned to the
+    `delta` grid, with lengths between `min_slice` and `max_slice`.
+
+    """
+    lengths = range(min_slice, max_slice + 1, delta)
+    nr_begins = nr_windows / len(lengths) + 1
+
+    rng = np.random.RandomState(0)
+    scored_windows = [
+        (begin, begin + length, score)
+        for (begin, length), score in itertools.izip(
+            itertools.product(xrange(0, nr_begins * delta, delta), lengths),
+            rng.randn(nr_begins * len(lengths)))][: nr_windows]
+
+    start = time.time()
+    out = non_maxima_supression_0(scored_windows, delta, min_slice, max_slice)
+    print "Sorted NMS: %.2f s, %d windows kept out of %d." % (
+        time.time() - start, len(out), len(scored_windows))
+
+    if check:
+        start = time.time()
+        ref = non_maxima_supression_0_reference(
+            scored_windows, delta, min_slice, max_slice)
+        print "Reference NMS: %.2f s." % (time.time() - start)
+        print "Same output:", out == ref
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -62,9 +182,20 @@ def main():
     parser.add_argument('-D', '--delta', type=int, help="base slice length.")
     parser.add_argument('--begin', type=int, help="smallest slice length.")
     parser.add_argument('--end', type=int, help="largest slice length.")
+    parser.add_argument(
+        '--benchmark', type=int, default=None,
+        help="runs the NMS on this many random windows instead of `infile`.")
+    parser.add_argument(
+        '--check', action='store_true', default=False,
+        help="compares the output with the reference implementation.")
 
     args = parser.parse_args()
 
+    if args.benchmark is not None:
+        benchmark(
+            args.benchmark, args.delta, args.begin, args.end, check=args.check)
+        return
+
     with open(args.infile, 'r') as ff:
         results = cPickle.load(ff)
 
@@ -81,6 +212,12 @@ def main():
     start = time.time()
     out = non_maxima_supression_0(results, args.delta, args.begin, args.end)
     print "Time for NMS: %.2f s" % (time.time() - start)
+
+    if args.check:
+        ref = non_maxima_supression_0_reference(
+            results, args.delta, args.begin, args.end)
+        print "Same output:", out == ref
+
     pdb.set_trace()
 
 
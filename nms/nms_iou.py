@@ -0,0 +1,204 @@
+
+import argparse
+import heapq
+import numpy as np
+import time
+
+
+def temporal_iou(begin_1, end_1, begin_2, end_2):
+    """Intersection over union of the intervals [begin, end); broadcasts."""
+    inter = np.maximum(0, np.minimum(end_1, end_2) - np.maximum(begin_1, begin_2))
+    union = (end_1 - begin_1) + (end_2 - begin_2) - inter
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, np.true_divide(inter, union), 0.)
+
+
+def overlaps_kept(begins, ends, kept_begins, kept_ends, max_length, overlap):
+    """Checks whether each window overlaps by more than `overlap` one of the
+    kept windows, which are sorted by their begin frame. Only the kept
+    windows that start in (begin - max_length, end) can intersect a window.
+
+    """
+    lo = np.searchsorted(kept_begins, begins - max_length, side='right')
+    hi = np.searchsorted(kept_begins, ends, side='left')
+    width = np.max(hi - lo) if len(lo) else 0
+
+    if width <= 0:
+        return np.zeros(len(begins), dtype=np.bool)
+
+    idxs = lo[:, np.newaxis] + np.arange(width)
+    valid = idxs < hi[:, np.newaxis]
+    idxs = np.minimum(idxs, len(kept_begins) - 1)
+
+    iou = temporal_iou(
+        begins[:, np.newaxis], ends[:, np.newaxis],
+        kept_begins[idxs], kept_ends[idxs])
+
+    return np.any(valid & (iou > overlap), axis=1)
+
+
+def non_maxima_supression(detections, overlap=0., block_size=1024):
+    """Greedy non-maxima supression: a window is kept if its overlap (IoU)
+    with each of the kept windows with a higher score is at most `overlap`.
+    The windows are processed in blocks of `block_size` in decreasing order
+    of their score; each block is checked against the kept windows and then
+    against itself with vectorized overlap computations. Returns the kept
+    detections in decreasing order of the score.
+
+    """
+    order = np.argsort(- detections['score'], kind='mergesort')
+    detections = detections[order]
+
+    begins = detections['begin']
+    ends = detections['end']
+    max_length = np.max(ends - begins) if len(detections) else 0
+
+    keep = np.zeros(len(detections), dtype=np.bool)
+    kept_begins = np.zeros(0, dtype=begins.dtype)
+    kept_ends = np.zeros(0, dtype=ends.dtype)
+
+    for start in xrange(0, len(detections), block_size):
+
+        block_begins = begins[start: start + block_size]
+        block_ends = ends[start: start + block_size]
+
+        idxs = np.where(~overlaps_kept(
+            block_begins, block_ends, kept_begins, kept_ends, max_length,
+            overlap))[0]
+
+        # Row `ii` suppresses the windows with a lower score in the block.
+        suppress = np.triu(temporal_iou(
+            block_begins[idxs, np.newaxis], block_ends[idxs, np.newaxis],
+            block_begins[idxs], block_ends[idxs]) > overlap, k=1)
+
+        alive = np.ones(len(idxs), dtype=np.bool)
+        for ii in xrange(len(idxs)):
+            if alive[ii]:
+                alive[suppress[ii]] = False
+
+        idxs = idxs[alive]
+        keep[start + idxs] = True
+
+        kept_begins = np.hstack((kept_begins, block_begins[idxs]))
+        kept_ends = np.hstack((kept_ends, block_ends[idxs]))
+        by_begin = np.argsort(kept_begins, kind='mergesort')
+        kept_begins, kept_ends = kept_begins[by_begin], kept_ends[by_begin]
+
+    return detections[keep]
+
+
+def soft_non_maxima_supression(
+    detections, overlap=0., method='linear', sigma=0.5):
+    """Soft non-maxima supression: instead of removing the windows that
+    overlap the selected one, decays their scores by `1 - IoU` (for IoU
+    above `overlap`) or by `exp(-IoU^2 / sigma)`. Since the classifier scores
+    can be negative, the scores are decayed towards the lowest score. Returns
+    all the detections, re-scored, in the order they were selected.
+
+    """
+    assert method in ('linear', 'gaussian')
+
+    detections = detections.copy()
+    begins = detections['begin']
+    ends = detections['end']
+    max_length = np.max(ends - begins) if len(detections) else 0
+
+    scores = detections['score'].astype(np.float64)
+    floor = np.min(scores) if len(scores) else 0.
+    heights = scores - floor
+
+    by_begin = np.argsort(begins, kind='mergesort')
+    sorted_begins = begins[by_begin]
+
+    heap = [(- height, ii) for ii, height in enumerate(heights)]
+    heapq.heapify(heap)
+
+    done = np.zeros(len(detections), dtype=np.bool)
+    order = []
+
+    while heap:
+
+        height, ii = heapq.heappop(heap)
+
+        # Skip the entries whose score was decayed after they were pushed.
+        if done[ii] or - height != heights[ii]:
+            continue
+
+        done[ii] = True
+        order.append(ii)
+
+        lo = np.searchsorted(sorted_begins, begins[ii] - max_length, side='right')
+        hi = np.searchsorted(sorted_begins, ends[ii], side='left')
+        others = by_begin[lo: hi]
+        others = others[~done[others]]
+
+        iou = temporal_iou(begins[ii], ends[ii], begins[others], ends[others])
+
+        if method == 'linear':
+            decay = np.where(iou > overlap, 1 - iou, 1.)
+        else:
+            decay = np.exp(- iou ** 2 / sigma)
+
+        idxs = decay < 1
+        others = others[idxs]
+        heights[others] *= decay[idxs]
+
+        for jj in others:
+            heapq.heappush(heap, (- heights[jj], jj))
+
+    detections['score'] = heights + floor
+    return detections[order]
+
+
+def random_detections(nr_windows, delta, min_slice, max_slice, seed=0):
+    """Random scores for windows aligned to the `delta` grid, in a structured
+    array with the `begin`, `end` and `score` columns of the results.
+
+    """
+    lengths = np.arange(min_slice, max_slice + 1, delta)
+    nr_begins = nr_windows / len(lengths) + 1
+    detections = np.zeros(nr_begins * len(lengths), dtype=[
+        ('begin', np.int64), ('end', np.int64), ('score', np.float64)])
+    detections['begin'] = np.repeat(np.arange(nr_begins) * delta, len(lengths))
+    detections['end'] = detections['begin'] + np.tile(lengths, nr_begins)
+    detections['score'] = np.random.RandomState(seed).randn(len(detections))
+    return detections[: nr_windows]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Temporal non-maxima supression with overlap thresholds.")
+
+    parser.add_argument(
+        '-N', '--nr_windows', type=int, default=1000000,
+        help="number of random windows.")
+    parser.add_argument('-D', '--delta', type=int, default=30, help="base slice length.")
+    parser.add_argument('--begin', type=int, default=60, help="smallest slice length.")
+    parser.add_argument('--end', type=int, default=240, help="largest slice length.")
+    parser.add_argument(
+        '--overlaps', type=float, nargs='+', default=[0., 0.2, 0.5],
+        help="IoU thresholds to sweep.")
+    parser.add_argument(
+        '--soft', choices=['linear', 'gaussian'], default=None,
+        help="uses soft-NMS.")
+    parser.add_argument(
+        '--block_size', type=int, default=1024, help="number of windows per block.")
+
+    args = parser.parse_args()
+
+    detections = random_detections(
+        args.nr_windows, args.delta, args.begin, args.end)
+
+    for overlap in args.overlaps:
+        start = time.time()
+        if args.soft:
+            out = soft_non_maxima_supression(detections, overlap, method=args.soft)
+        else:
+            out = non_maxima_supression(detections, overlap, args.block_size)
+        print "Overlap %.2f: %.2f s, %d windows." % (
+            overlap, time.time() - start, len(out))
+
+
+if __name__ == '__main__':
+    main()
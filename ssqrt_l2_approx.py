@@ -1,7 +1,9 @@
 """ Uses approximations for both signed square rooting and l2 normalization."""
 import argparse
 from collections import defaultdict
+from collections import namedtuple
 import cPickle
+import hashlib
 from itertools import izip
 from multiprocessing import Pool
 import numpy as np
@@ -13,7 +15,7 @@ from scipy import sparse
 from joblib import Memory
 from sklearn.datasets.samples_generator import make_blobs
 from sklearn.metrics import accuracy_score
-from sklearn.preprocessing import StandardScaler
+from sklearn.preprocessing import LabelBinarizer
 from yael import threads
 
 from dataset import Dataset
@@ -22,8 +24,14 @@ from fisher_vectors.evaluation.utils import average_precision
 from fisher_vectors.model.utils import L2_normalize as exact_l2_normalize
 from fisher_vectors.model.utils import power_normalize
 
+from block_sparse import BlockSparseFisherVectors
+from fv_quantization import QuantizedFisherVectors
+from integral_image import IntegralImage
+
 from load_data import CACHE_PATH
 from load_data import CFG
+from load_data import DiagonalScaler
+from load_data import apply_scalers
 from load_data import approximate_signed_sqrt
 from load_data import load_kernels
 from load_data import load_sample_data
@@ -44,6 +52,10 @@ from load_data import SliceData
 # [x] Parallelize per-class evaluation.
 
 
+# Fisher vector formats that implement the per visual word reductions
+# (`visual_word_l2_norm` and `visual_word_scores`) themselves.
+COMPACT_FISHER_VECTORS = (BlockSparseFisherVectors, QuantizedFisherVectors)
+
 LOAD_SAMPLE_DATA_PARAMS = {
     'pi_derivatives' : False,
     'sqrt_nr_descs'  : False,
@@ -51,7 +63,13 @@ LOAD_SAMPLE_DATA_PARAMS = {
 }
 
 
+# The weights of a classifier and the visual word mask for the L2 norms, with
+# the scalers folded in (see `fold_classifier`).
+FoldedClassifier = namedtuple('FoldedClassifier', ['weights', 'l2_visual_word_mask'])
+
+
 def compute_weights(clf, xx, tr_std=None):
+    """Weights and bias of the linear classifier."""
     weights = np.dot(clf.dual_coef_, xx[clf.support_])
     bias = clf.intercept_
     if tr_std is not None:
@@ -59,6 +77,53 @@ def compute_weights(clf, xx, tr_std=None):
     return weights, bias
 
 
+def scale_factors(scalers):
+    """Per dimension factors by which the diagonal scalers (`DiagonalScaler`
+    or scikit-learn's `StandardScaler(with_mean=False)`) multiply the data,
+    when applied in turn; None if there are no scalers. The factors are
+    computed in float64, even from the float32 scales of `DiagonalScaler`.
+
+    """
+    factors = None
+    for scaler in scalers:
+        if scaler is None:
+            continue
+        scale = scaler.scale_ if hasattr(scaler, 'scale_') else scaler.std_
+        scale = np.asarray(scale, dtype=np.float64)
+        factors = 1. / scale if factors is None else factors / scale
+    return factors
+
+
+def fold_weights(weights, scalers):
+    """Absorbs the scalers into the weights: w . (x / s) = (w / s) . x"""
+    factors = scale_factors(scalers)
+    return weights if factors is None else weights * factors
+
+
+def fold_visual_word_mask(visual_word_mask, scalers):
+    """Weights the rows of the visual word mask by the squared scale factors,
+    so that `visual_word_l2_norm` of the unscaled data gives the per visual
+    word L2 norms of the scaled data.
+
+    """
+    factors = scale_factors(scalers)
+    if factors is None:
+        return visual_word_mask
+    nn = len(factors)
+    return sparse.csr_matrix(
+        sparse.spdiags(factors ** 2, 0, nn, nn) * visual_word_mask)
+
+
+def fold_classifier(weights, scalers, visual_word_mask):
+    """Folds the scalers into the weights and into the visual word mask used
+    for the L2 norms, once for all the slices scored by the classifier.
+
+    """
+    return FoldedClassifier(
+        fold_weights(weights, scalers),
+        fold_visual_word_mask(visual_word_mask, scalers))
+
+
 def predict(yy, weights, bias):
     return (- np.dot(yy, weights.T) + bias).squeeze()
 
@@ -121,10 +186,14 @@ def group_data(data, nr_to_group):
 
 
 def visual_word_l2_norm(fisher_vectors, visual_word_mask):
+    if isinstance(fisher_vectors, COMPACT_FISHER_VECTORS):
+        return fisher_vectors.visual_word_l2_norm(visual_word_mask)
     return fisher_vectors ** 2 * visual_word_mask  # NxK
 
 
 def visual_word_scores(fisher_vectors, weights, bias, visual_word_mask):
+    if isinstance(fisher_vectors, COMPACT_FISHER_VECTORS):
+        return fisher_vectors.visual_word_scores(weights, visual_word_mask)
     return (- fisher_vectors * weights) * visual_word_mask  # NxK
 
 
@@ -141,12 +210,21 @@ def approx_l2_normalize(data, l2_norms, counts):
     return data / np.sqrt(approx_l2_norm[:, np.newaxis])
 
 
+def as_dense(data):
+    """Converts the sparse per visual word quantities, such as those of
+    `BlockSparseFisherVectors`, to arrays.
+
+    """
+    return data.toarray() if sparse.issparse(data) else data
+
+
 def approximate_video_scores(
     slice_scores, slice_counts, slice_l2_norms, nr_descriptors, video_mask):
 
-    video_scores = sum_by(slice_scores, video_mask) / sum_by(nr_descriptors, video_mask)
-    video_counts = sum_by(slice_counts, video_mask) / sum_by(nr_descriptors, video_mask)
-    video_l2_norms = sum_by(slice_l2_norms, video_mask) / sum_by(nr_descriptors, video_mask) ** 2
+    # The per slice quantities can be sparse; their sums are dense.
+    video_scores = as_dense(sum_by(slice_scores, video_mask)) / sum_by(nr_descriptors, video_mask)
+    video_counts = as_dense(sum_by(slice_counts, video_mask)) / sum_by(nr_descriptors, video_mask)
+    video_l2_norms = as_dense(sum_by(slice_l2_norms, video_mask)) / sum_by(nr_descriptors, video_mask) ** 2
 
     zero_idxs = video_counts == 0
     masked_scores = np.ma.masked_array(video_scores, zero_idxs)
@@ -166,6 +244,8 @@ def sum_by(data, mask=None):
     """
     if mask is None:
         return np.sum(data, axis=0)
+    if isinstance(data, IntegralImage):
+        return data.sum_by(mask)
     return mask * data
 
 
@@ -237,10 +317,7 @@ def load_corrected_norms(
         slice_agg_mask = build_slice_agg_mask(X.shape[0], nr_slices_to_aggregate)
         Xagg = sum_by(X * nn, mask=slice_agg_mask) / nn.sum()
         Xagg[np.isnan(Xagg)] = 0
-        for scaler in scalers:
-            if scaler is None:
-                continue
-            Xagg = scaler.transform(Xagg)
+        Xagg = apply_scalers(Xagg, scalers)
         return visual_word_l2_norm(Xagg, visual_word_mask)
 
     def aggregate_1(X, nn):
@@ -345,6 +422,31 @@ def load_slices(dataset, samples, analytical_fim=True, outfile=None, verbose=0):
     return fisher_vectors, counts, nr_descs, nr_slices, names, labels
 
 
+@my_cacher('np', 'np', 'np', 'np', 'np', 'cp', 'cp')
+def load_quantized_slices(
+    dataset, samples, analytical_fim=True, raw_outfile=None, outfile=None,
+    verbose=0):
+    """Compressed version of `load_slices`, which stores the codes and the
+    scales of the quantized Fisher vectors (see `QuantizedFisherVectors`)
+    instead of the Fisher vectors. The uncompressed data is read from
+    `raw_outfile`, if it exists, or computed and not kept.
+
+    """
+    keep_raw = raw_outfile is not None and os.path.exists(raw_outfile)
+    if not keep_raw:
+        raw_outfile = outfile + '.raw'
+
+    fisher_vectors, counts, nr_descs, nr_slices, names, labels = load_slices(
+        dataset, samples, analytical_fim=analytical_fim, outfile=raw_outfile,
+        verbose=verbose)
+
+    if not keep_raw:
+        os.remove(raw_outfile)
+
+    quantized = QuantizedFisherVectors.quantize(fisher_vectors, dataset.VOC_SIZE)
+    return quantized.codes, quantized.scales, counts, nr_descs, nr_slices, names, labels
+
+
 def slice_aggregator(slice_data, nr_slices, nr_agg):
 
     # Generate idxs.
@@ -355,6 +457,19 @@ def slice_aggregator(slice_data, nr_slices, nr_agg):
         ii = int(np.ceil((ii + dd) / float(nr_agg))) * nr_agg
 
     assert len(idxs) == nr_slices.sum()
+
+    # The quantized slices are quantized again after being aggregated.
+    fisher_vectors = slice_data.fisher_vectors
+    if isinstance(fisher_vectors, QuantizedFisherVectors):
+        if nr_agg == 1:
+            return slice_data
+        agg_slice_data = slice_aggregator(
+            slice_data._replace(fisher_vectors=fisher_vectors.dequantize()),
+            nr_slices, nr_agg)
+        return agg_slice_data._replace(
+            fisher_vectors=QuantizedFisherVectors.quantize(
+                agg_slice_data.fisher_vectors, fisher_vectors.K))
+
     mask = build_aggregation_mask(idxs)
 
     agg_fisher_vectors = scale_and_sum_by(
@@ -400,24 +515,33 @@ def evaluate_worker((
     prediction_type, verbose)):
 
     if prediction_type == 'approx':
+        # The slice data is not scaled; the scalers are folded into the
+        # weights and into the mask used for the L2 norms.
+        folded = fold_classifier(weight, tr_scalers, visual_word_mask)
         slice_vw_counts = slice_data.counts * slice_data.nr_descriptors[:, np.newaxis]
-        slice_vw_l2_norms = visual_word_l2_norm(slice_data.fisher_vectors, visual_word_mask)
-        slice_vw_scores = visual_word_scores(slice_data.fisher_vectors, weight, bias, visual_word_mask)
+        slice_vw_l2_norms = visual_word_l2_norm(
+            slice_data.fisher_vectors, folded.l2_visual_word_mask)
+        slice_vw_scores = visual_word_scores(
+            slice_data.fisher_vectors, folded.weights, bias, visual_word_mask)
         predictions = approximate_video_scores(
             slice_vw_scores, slice_vw_counts, slice_vw_l2_norms,
             slice_data.nr_descriptors[:, np.newaxis], video_mask)
     elif prediction_type == 'exact':
+        fisher_vectors = slice_data.fisher_vectors
+        if isinstance(fisher_vectors, COMPACT_FISHER_VECTORS):
+            fisher_vectors = fisher_vectors.to_dense()
+
         # Aggregate slice data into video data.
         video_data = (
-            sum_by(slice_data.fisher_vectors, video_mask) /
+            sum_by(fisher_vectors, video_mask) /
             sum_by(slice_data.nr_descriptors, video_mask)[:, np.newaxis])
 
         # Apply exact normalization on the test video data.
         if tr_scalers[0] is not None:
-            video_data = tr_scalers[0].transform(video_data)
+            video_data = tr_scalers[0].transform(video_data, copy=False)
         video_data = power_normalize(video_data, 0.5)
         if tr_scalers[1] is not None:
-            video_data = tr_scalers[1].transform(video_data)
+            video_data = tr_scalers[1].transform(video_data, copy=False)
         video_data = exact_l2_normalize(video_data)
 
         # Apply linear classifier.
@@ -431,9 +555,57 @@ def evaluate_worker((
     return cls, predictions
 
 
+def recipe_hash(*recipe):
+    """Short hash that identifies a normalization recipe (or any other tuple
+    of parameters with a stable `repr`).
+
+    """
+    return hashlib.md5(repr(recipe)).hexdigest()[:16]
+
+
+def normalization_recipe_file(
+    prefix, nr_slices_to_aggregate, l2_norm_type, empirical_standardizations,
+    sqrt_type, analytical_fim, samples=None):
+    """Where to cache the train data normalized with the given recipe. The
+    samples are part of the recipe only if they are not the default ones.
+
+    """
+    return "%s.normalized_%s" % (prefix, recipe_hash(
+        nr_slices_to_aggregate, l2_norm_type, tuple(empirical_standardizations),
+        sqrt_type, bool(analytical_fim),
+        None if samples is None else tuple(map(str, samples))))
+
+
 def load_normalized_tr_data(
     dataset, nr_slices_to_aggregate, l2_norm_type, empirical_standardizations,
-    sqrt_type, analytical_fim, tr_outfile, verbose, samples=None):
+    sqrt_type, analytical_fim, tr_outfile, verbose, samples=None,
+    recipe_outfile=None):
+    """Loads the train data, normalizes it and returns it together with the
+    labels and the fitted scalers. The results are cached in
+    `recipe_outfile`, which defaults to a file named after `tr_outfile` and
+    the hash of the normalization recipe.
+
+    """
+    if recipe_outfile is None:
+        recipe_outfile = normalization_recipe_file(
+            tr_outfile, nr_slices_to_aggregate, l2_norm_type,
+            empirical_standardizations, sqrt_type, analytical_fim,
+            samples=samples)
+
+    if verbose and os.path.exists(recipe_outfile):
+        print "Loading normalized train data from", recipe_outfile
+
+    return normalize_tr_data(
+        dataset, nr_slices_to_aggregate, l2_norm_type,
+        empirical_standardizations, sqrt_type, analytical_fim, tr_outfile,
+        verbose, samples=samples, outfile=recipe_outfile)
+
+
+@my_cacher('np', 'cp', 'cp')
+def normalize_tr_data(
+    dataset, nr_slices_to_aggregate, l2_norm_type, empirical_standardizations,
+    sqrt_type, analytical_fim, tr_outfile, verbose, samples=None,
+    outfile=None):
 
     D, K = dataset.D, dataset.VOC_SIZE
 
@@ -488,8 +660,8 @@ def load_normalized_tr_data(
     scalers = []
 
     if empirical_standardizations[0]:
-        scaler = StandardScaler(with_mean=False)
-        tr_video_data = scaler.fit_transform(tr_video_data)
+        scaler = DiagonalScaler().fit(tr_video_data)
+        tr_video_data = scaler.transform(tr_video_data, copy=False)
         scalers.append(scaler)
     else:
         scalers.append(None)
@@ -499,8 +671,8 @@ def load_normalized_tr_data(
 
     # Empirical standardization.
     if empirical_standardizations[1]:
-        scaler = StandardScaler(with_mean=False)
-        tr_video_data = scaler.fit_transform(tr_video_data)
+        scaler = DiagonalScaler().fit(tr_video_data)
+        tr_video_data = scaler.transform(tr_video_data, copy=False)
         scalers.append(scaler)
     else:
         scalers.append(None)
@@ -511,10 +683,224 @@ def load_normalized_tr_data(
     return tr_video_data, tr_video_labels, scalers
 
 
+@my_cacher('cp', 'cp')
+def train_classifiers(
+    src_cfg, tr_video_data, tr_video_labels, verbose=0, outfile=None):
+    """Trains the one-vs-rest classifiers and returns the evaluation object
+    together with the weights and bias of each class.
+
+    """
+    # Computing kernel.
+    tr_kernel = np.dot(tr_video_data, tr_video_data.T)
+
+    if verbose > 1:
+        print '\tTrain data:   %dx%d.' % tr_video_data.shape
+        print '\tTrain kernel: %dx%d.' % tr_kernel.shape
+
+    if verbose:
+        print "Training classifier."
+
+    eval = Evaluation(CFG[src_cfg]['eval_name'], **CFG[src_cfg]['eval_params'])
+    eval.fit(tr_kernel, tr_video_labels)
+    clfs = [
+        compute_weights(eval.get_classifier(cls), tr_video_data, tr_std=None)
+        for cls in xrange(eval.nr_classes)]
+
+    return eval, clfs
+
+
+# Classifiers trained directly in the primal, on the normalized FVs.
+PRIMAL_CLASSIFIERS = ('sgd', 'linear_svc')
+
+
+def primal_C(src_cfg):
+    """The regularization of the primal classifiers: the `C` that the
+    configuration passes to the kernel classifiers (see `Evaluation`), or 1
+    if it does not set one.
+
+    """
+    return CFG[src_cfg]['eval_params'].get('C', 1.)
+
+
+def fit_primal_classifiers(
+    tr_data, binary_labels, classifier='sgd', C=1., nr_epochs=5,
+    batch_size=4096, seed=0, verbose=0):
+    """Trains a linear classifier for each column of `binary_labels` (with
+    values -1 and +1) in the primal, without building the Gram matrix; the
+    SGD solver streams the data in mini-batches (see
+    `fit_streamed_classifiers`). Returns the weights, as a float32 matrix
+    with a row per class, and the biases, with the sign convention of
+    `compute_weights` (see `predict`).
+
+    """
+    if classifier == 'sgd':
+        return fit_streamed_classifiers(
+            tr_data, binary_labels, C=C, nr_epochs=nr_epochs,
+            batch_size=batch_size, seed=seed, verbose=verbose)
+
+    from sklearn.svm import LinearSVC
+    assert classifier == 'linear_svc', "Unknown classifier %s." % classifier
+
+    binary_labels = np.asarray(binary_labels).reshape(len(binary_labels), -1)
+    clfs = []
+
+    for labels in binary_labels.T:
+        clfs.append(LinearSVC(C=C).fit(tr_data, labels))
+        if verbose > 1:
+            print len(clfs) - 1,
+
+    return export_primal_classifiers(clfs)
+
+
+def export_primal_classifiers(clfs):
+    """Weights and biases of the fitted scikit-learn linear classifiers; the
+    scores are computed as `- x . w + b`.
+
+    """
+    weights = - np.vstack([clf.coef_ for clf in clfs]).astype(np.float32)
+    biases = np.array([clf.intercept_[0] for clf in clfs])
+    return weights, biases
+
+
+def minibatch_idxs(nr_samples, batch_size, nr_epochs=1, seed=0):
+    """Yields the indices of the mini-batches of each epoch. The samples are
+    shuffled by a new permutation at each epoch; the indices of each batch
+    are sorted, so the reads from a memory-mapped array go forward.
+
+    """
+    rng = np.random.RandomState(seed)
+    for epoch in xrange(nr_epochs):
+        perm = rng.permutation(nr_samples)
+        for ii in xrange(0, nr_samples, batch_size):
+            yield np.sort(perm[ii: ii + batch_size])
+
+
+def fit_streamed_classifiers(
+    tr_data, binary_labels, C=1., nr_epochs=5, batch_size=4096, seed=0,
+    verbose=0):
+    """Trains a linear SVM with SGD for each column of `binary_labels`. The
+    data, possibly memory-mapped (see `store_normalized_tr_slices`), is read
+    one mini-batch at a time and each batch is used by all the classes, so
+    the memory is bounded by `batch_size`, whatever the number of samples.
+
+    """
+    from sklearn.linear_model import SGDClassifier
+
+    binary_labels = np.asarray(binary_labels).reshape(len(binary_labels), -1)
+    N, nr_classes = binary_labels.shape
+    classes = np.array([-1, 1])
+
+    clfs = [
+        SGDClassifier(loss='hinge', alpha=1. / (C * N))
+        for _ in xrange(nr_classes)]
+
+    for batch, idxs in enumerate(minibatch_idxs(N, batch_size, nr_epochs, seed)):
+        batch_data = np.asarray(tr_data[idxs], dtype=np.float32)
+        for clf, labels in izip(clfs, binary_labels.T):
+            clf.partial_fit(batch_data, labels[idxs], classes=classes)
+        if verbose > 1:
+            print batch,
+
+    return export_primal_classifiers(clfs)
+
+
+def store_normalized_tr_slices(
+    dataset, src_cfg, samples, nr_slices_to_aggregate, l2_norm_type,
+    sqrt_type, scalers, analytical_fim, tr_outfile, outfile, verbose=0):
+    """Normalizes the aggregated slices of the train samples and stores them
+    as float32 rows in the raw file `outfile` (and their labels, which are
+    the labels of their videos, in `outfile.labels`). Returns the slices
+    memory-mapped and the labels.
+
+    The samples are loaded in parts of `samples_chunk` (as the test data), so
+    only a part is in memory at a time. The slices use the scalers fitted on
+    the train videos and the L2 normalization of the detector: the `approx`
+    norm is computed from the per visual word norms of each slice, as
+    `load_corrected_norms` does for the videos.
+
+    """
+    labels_file = outfile + '.labels'
+    visual_word_mask = build_visual_word_mask(dataset.D, dataset.VOC_SIZE)
+
+    if not os.path.exists(outfile):
+
+        chunk = CFG[src_cfg]['samples_chunk']
+        labels = []
+
+        with open(outfile + '.tmp', 'wb') as ff:
+            for part, low in enumerate(xrange(0, len(samples), chunk)):
+
+                fisher_vectors, counts, nr_descs, nr_slices, _, part_labels = load_slices(
+                    dataset, samples[low: low + chunk], analytical_fim,
+                    outfile="%s.slices_part_%d" % (tr_outfile, part),
+                    verbose=verbose)
+                agg_slice_data = slice_aggregator(
+                    SliceData(fisher_vectors, counts, nr_descs), nr_slices,
+                    nr_slices_to_aggregate)
+
+                data = apply_scalers(agg_slice_data.fisher_vectors, scalers[: 1])
+                if sqrt_type == 'exact':
+                    data = power_normalize(data, 0.5)
+                elif sqrt_type == 'approx':
+                    data = approximate_signed_sqrt(
+                        data, agg_slice_data.counts, pi_derivatives=False)
+                data = apply_scalers(data, scalers[1:])
+                if l2_norm_type == 'exact':
+                    data = exact_l2_normalize(data)
+                elif l2_norm_type == 'approx':
+                    # Same approximation as for the test windows: the per
+                    # visual word norms of the scaled slices over the counts.
+                    l2_norms = visual_word_l2_norm(
+                        apply_scalers(agg_slice_data.fisher_vectors, scalers),
+                        visual_word_mask)
+                    counts = (
+                        agg_slice_data.counts if sqrt_type != 'none' else
+                        np.ones(agg_slice_data.counts.shape))
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        data = approx_l2_normalize(data, l2_norms, counts)
+                    # Remove the slices without descriptors.
+                    data[np.isnan(data) | np.isinf(data)] = 0.
+
+                data.astype(np.float32).tofile(ff)
+                labels += sum([
+                    [label] * int(np.ceil(float(nn) / nr_slices_to_aggregate))
+                    for label, nn in izip(part_labels, nr_slices)], [])
+
+        with open(labels_file, 'w') as ff:
+            cPickle.dump(labels, ff)
+        os.rename(outfile + '.tmp', outfile)
+
+    with open(labels_file, 'r') as ff:
+        labels = cPickle.load(ff)
+
+    assert len(labels) > 0, "No train slices stored in %s." % outfile
+    dim = os.path.getsize(outfile) / np.dtype(np.float32).itemsize / len(labels)
+    tr_slice_data = np.memmap(
+        outfile, dtype=np.float32, mode='r', shape=(len(labels), dim))
+    return tr_slice_data, labels
+
+
+@my_cacher('np', 'np')
+def train_primal_classifiers(tr_data, binary_labels, outfile=None, **kwargs):
+    """Cached version of `fit_primal_classifiers`."""
+    return fit_primal_classifiers(tr_data, binary_labels, **kwargs)
+
+
+def primal_clfs(weights, biases):
+    """Splits the output of `train_primal_classifiers` into the `(weights,
+    bias)` pairs returned by `compute_weights`.
+
+    """
+    return [
+        (weights[cls: cls + 1], biases[cls: cls + 1])
+        for cls in xrange(len(weights))]
+
+
 def predict_main(
     src_cfg, sqrt_type, empirical_standardizations, l2_norm_type,
     prediction_type, analytical_fim, part, nr_slices_to_aggregate=1,
-    nr_threads=4, verbose=0):
+    classifier='dual', train_level='video', quantize=False,
+    block_sparse=False, nr_threads=4, verbose=0):
 
     dataset = Dataset(CFG[src_cfg]['dataset_name'], **CFG[src_cfg]['dataset_params'])
     D, K = dataset.D, dataset.VOC_SIZE
@@ -530,21 +916,33 @@ def predict_main(
         empirical_standardizations, sqrt_type, analytical_fim, tr_outfile,
         verbose)
 
-    # Computing kernel.
-    tr_kernel = np.dot(tr_video_data, tr_video_data.T)
-
-    if verbose > 1:
-        print '\tTrain data:   %dx%d.' % tr_video_data.shape
-        print '\tTrain kernel: %dx%d.' % tr_kernel.shape
-
-    if verbose:
-        print "Training classifier."
-
-    eval = Evaluation(CFG[src_cfg]['eval_name'], **CFG[src_cfg]['eval_params'])
-    eval.fit(tr_kernel, tr_video_labels)
-    clfs = [
-        compute_weights(eval.get_classifier(cls), tr_video_data, tr_std=None)
-        for cls in xrange(eval.nr_classes)]
+    recipe_file = normalization_recipe_file(
+        tr_outfile, nr_slices_to_aggregate, l2_norm_type,
+        empirical_standardizations, sqrt_type, analytical_fim)
+
+    if classifier == 'dual':
+        clf_outfile = "%s.clfs_%s" % (recipe_file, recipe_hash(
+            CFG[src_cfg]['eval_name'], sorted(CFG[src_cfg]['eval_params'].items())))
+        eval, clfs = train_classifiers(
+            src_cfg, tr_video_data, tr_video_labels, verbose=verbose,
+            outfile=clf_outfile)
+        label_binarizer = eval.lb
+    else:
+        label_binarizer = LabelBinarizer().fit(tr_video_labels)
+        if train_level == 'slice':
+            tr_data, tr_labels = store_normalized_tr_slices(
+                dataset, src_cfg, dataset.get_data('train')[0],
+                nr_slices_to_aggregate, l2_norm_type, sqrt_type, tr_scalers,
+                analytical_fim, tr_outfile, outfile=recipe_file + '.slices',
+                verbose=verbose)
+        else:
+            tr_data, tr_labels = tr_video_data, tr_video_labels
+        C = primal_C(src_cfg)
+        clfs = primal_clfs(*train_primal_classifiers(
+            tr_data, label_binarizer.transform(tr_labels) * 2 - 1,
+            classifier=classifier, C=C, verbose=verbose,
+            outfile="%s.clfs%s_C%g" % (
+                recipe_file, classifier_suffix(classifier, train_level), C)))
 
     if verbose:
         print "Loading test data."
@@ -564,9 +962,16 @@ def predict_main(
         print "\tEvaluating on %d threads." % nr_threads
 
     te_outfile_ii = te_outfile % part
-    fisher_vectors, counts, nr_descs, nr_slices, _, te_labels = load_slices(
-        dataset, te_samples[low: high], analytical_fim, outfile=te_outfile_ii,
-        verbose=verbose)
+    if quantize:
+        codes, scales, counts, nr_descs, nr_slices, _, te_labels = load_quantized_slices(
+            dataset, te_samples[low: high], analytical_fim,
+            raw_outfile=te_outfile_ii,
+            outfile=te_outfile_ii.replace('.dat', '_int8.dat'), verbose=verbose)
+        fisher_vectors = QuantizedFisherVectors(codes, scales)
+    else:
+        fisher_vectors, counts, nr_descs, nr_slices, _, te_labels = load_slices(
+            dataset, te_samples[low: high], analytical_fim,
+            outfile=te_outfile_ii, verbose=verbose)
     slice_data = SliceData(fisher_vectors, counts, nr_descs)
 
     agg_slice_data = slice_aggregator(slice_data, nr_slices, nr_slices_to_aggregate)
@@ -574,6 +979,12 @@ def predict_main(
         fisher_vectors=(agg_slice_data.fisher_vectors *
                         agg_slice_data.nr_descriptors[:, np.newaxis]))
 
+    # Keep only the Fisher vector blocks of the active visual words.
+    if block_sparse:
+        agg_slice_data = agg_slice_data._replace(
+            fisher_vectors=BlockSparseFisherVectors.from_dense(
+                agg_slice_data.fisher_vectors, agg_slice_data.counts))
+
     video_mask = build_aggregation_mask(
         sum([[ii] * int(np.ceil(float(nn) / nr_slices_to_aggregate))
              for ii, nn in enumerate(nr_slices)],
@@ -582,21 +993,13 @@ def predict_main(
     if verbose:
         print "\tTest data: %dx%d." % agg_slice_data.fisher_vectors.shape
 
-    # Scale the FVs in the main program, to avoid blowing up the memory
-    # when doing multi-threading, since each thread will make a copy of the
-    # data when transforming the data.
-    if prediction_type == 'approx':
-        for tr_scaler in tr_scalers:
-            if tr_scaler is None:
-                continue
-            agg_slice_data = agg_slice_data._replace(
-                fisher_vectors=tr_scaler.transform(
-                    agg_slice_data.fisher_vectors))
+    # For the approximate predictions the scalers are folded into the
+    # weights by each worker, so the FVs are not scaled (and not copied).
 
     eval_args = [
         (ii, clfs[ii][0], clfs[ii][1], tr_scalers, agg_slice_data, video_mask,
          visual_word_mask, prediction_type, verbose)
-        for ii in xrange(eval.nr_classes)]
+        for ii in xrange(len(clfs))]
     evaluator = threads.ParallelIter(nr_threads, eval_args, evaluate_worker)
 
     if verbose > 1:
@@ -606,7 +1009,7 @@ def predict_main(
     predictions = {}
 
     for ii, pd in evaluator:
-        tl = eval.lb.transform(te_labels)[:, ii]
+        tl = label_binarizer.transform(te_labels)[:, ii]
         true_labels[ii] = tl
         predictions[ii] = pd
 
@@ -614,23 +1017,35 @@ def predict_main(
         print
 
     preds_path = os.path.join(
-        CACHE_PATH, "%s_predictions_afim_%s_pi_%s_sqrt_nr_descs_%s_nagg_%d_part_%d.dat" % (
-            src_cfg, analytical_fim, False, False, nr_slices_to_aggregate, part))
+        CACHE_PATH, "%s_predictions_afim_%s_pi_%s_sqrt_nr_descs_%s_nagg_%d%s%s_part_%d.dat" % (
+            src_cfg, analytical_fim, False, False, nr_slices_to_aggregate,
+            classifier_suffix(classifier, train_level),
+            '_int8' if quantize else '', part))
 
     with open(preds_path, 'w') as ff:
         cPickle.dump(true_labels, ff)
         cPickle.dump(predictions, ff)
 
 
-def evaluate_main(src_cfg, analytical_fim, nr_slices_to_aggregate, verbose):
+def classifier_suffix(classifier, train_level='video'):
+    if classifier == 'dual':
+        return ''
+    return '_' + classifier + ('_slices' if train_level == 'slice' else '')
+
+
+def evaluate_main(
+    src_cfg, analytical_fim, nr_slices_to_aggregate, verbose,
+    classifier='dual', train_level='video', quantize=False):
 
     dataset = Dataset(CFG[src_cfg]['dataset_name'], **CFG[src_cfg]['dataset_params'])
     te_samples, _ = dataset.get_data('test')
     nr_parts = int(np.ceil(float(len(te_samples)) / CFG[src_cfg]['samples_chunk']))
 
     preds_path = os.path.join(
-        CACHE_PATH, "%s_predictions_afim_%s_pi_%s_sqrt_nr_descs_%s_nagg_%d_part_%s.dat" % (
-            src_cfg, analytical_fim, False, False, nr_slices_to_aggregate, "%d"))
+        CACHE_PATH, "%s_predictions_afim_%s_pi_%s_sqrt_nr_descs_%s_nagg_%d%s%s_part_%s.dat" % (
+            src_cfg, analytical_fim, False, False, nr_slices_to_aggregate,
+            classifier_suffix(classifier, train_level),
+            '_int8' if quantize else '', "%d"))
 
     true_labels = None
 
@@ -676,8 +1091,9 @@ def main():
         '-d', '--dataset', required=True, choices=CFG.keys(),
         help="which dataset (use `dummy` for debugging purposes).")
     parser.add_argument(
-        '-t', '--task', choices=('predict', 'evaluate'), required=True,
-        help="what to do.")
+        '-t', '--task', choices=('predict', 'evaluate', 'compare'), required=True,
+        help=("what to do; `compare` evaluates both the kernel SVM and the "
+              "classifier given by `--classifier`."))
     parser.add_argument(
         '--exact', action='store_true', default=False,
         help="uses exact normalizations at both train and test time.")
@@ -696,6 +1112,22 @@ def main():
     parser.add_argument(
         '--train_l2_norm', choices={'exact', 'approx'}, required=True,
         help="how to apply L2 normalization at train time.")
+    parser.add_argument(
+        '--classifier', choices=('dual', ) + PRIMAL_CLASSIFIERS, default='dual',
+        help=("trains the kernel SVM (`dual`) or a linear classifier in the "
+              "primal, which does not need the Gram matrix."))
+    parser.add_argument(
+        '--train_level', choices=('video', 'slice'), default='video',
+        help=("trains the primal classifier on the video FVs or streams the "
+              "aggregated slice FVs from a memory-mapped file."))
+    parser.add_argument(
+        '--quantize', action='store_true', default=False,
+        help=("caches the test slices quantized to int8 per visual word and "
+              "scores them without decompressing them."))
+    parser.add_argument(
+        '--block_sparse', action='store_true', default=False,
+        help=("stores only the Fisher vector blocks of the visual words that "
+              "are active in each test slice."))
     parser.add_argument(
         '-nt', '--nr_threads', type=int, default=1, help="number of threads.")
     parser.add_argument(
@@ -711,6 +1143,11 @@ def main():
         '-v', '--verbose', action='count', help="verbosity level.")
     args = parser.parse_args()
 
+    if args.train_level == 'slice' and args.classifier == 'dual':
+        parser.error("--train_level slice requires a primal --classifier.")
+    if args.quantize and args.block_sparse:
+        parser.error("--quantize and --block_sparse are exclusive.")
+
     tr_sqrt = 'approx'
     pred_type = 'approx'
     tr_l2_norm = args.train_l2_norm
@@ -728,9 +1165,23 @@ def main():
             args.dataset, tr_sqrt, empirical_standardizations, tr_l2_norm,
             pred_type, analytical_fim, part=args.part,
             nr_slices_to_aggregate=args.nr_slices_to_aggregate,
+            classifier=args.classifier, train_level=args.train_level,
+            quantize=args.quantize, block_sparse=args.block_sparse,
             nr_threads=args.nr_threads, verbose=args.verbose)
     elif args.task == 'evaluate':
-        evaluate_main(args.dataset, analytical_fim, args.nr_slices_to_aggregate, verbose=args.verbose)
+        evaluate_main(
+            args.dataset, analytical_fim, args.nr_slices_to_aggregate,
+            verbose=args.verbose, classifier=args.classifier,
+            train_level=args.train_level, quantize=args.quantize)
+    elif args.task == 'compare':
+        # Both sets of predictions have to be computed beforehand (`-t predict`).
+        for classifier in ('dual', args.classifier):
+            print "Classifier %s%s:" % (
+                classifier, classifier_suffix(classifier, args.train_level))
+            evaluate_main(
+                args.dataset, analytical_fim, args.nr_slices_to_aggregate,
+                verbose=args.verbose, classifier=classifier,
+                train_level=args.train_level, quantize=args.quantize)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,13 @@
 import heapq
+import time
 
 import numpy as np
 cimport numpy as np
 
+cimport cython
+from cython.parallel import prange
+from libc.math cimport INFINITY
+
 
 # TODO
 # [ ] Use with `for` loops in _eval_integral and maybe `inline`.
@@ -10,7 +15,7 @@ cimport numpy as np
 
 
 cdef extern from "math.h":
-    double sqrt(double)
+    double sqrt(double) nogil
 
 
 # Data structures.
@@ -44,6 +49,16 @@ cdef class Function:
     cpdef double evaluate(self, Bounds bounds) except *:
         return 0
 
+    cpdef np.ndarray evaluate_batch(self, long[:, :] boxes):
+        """Evaluates a batch of boxes, given as rows of `(low.elem0,
+        low.elem1, high.elem0, high.elem1)`."""
+        cdef Py_ssize_t nn
+        cdef np.ndarray[np.float64_t, ndim=1] scores = np.zeros(boxes.shape[0])
+        for nn in xrange(boxes.shape[0]):
+            scores[nn] = self.evaluate(b_init_bounds(
+                (boxes[nn, 0], boxes[nn, 1]), (boxes[nn, 2], boxes[nn, 3])))
+        return scores
+
 
 # General functions.
 cdef inline bint intersects(int x0, int x1, int y0, int y1):
@@ -51,7 +66,7 @@ cdef inline bint intersects(int x0, int x1, int y0, int y1):
 
 
 cdef inline bint contains(int x0, int x1, int y0, int y1):
-    return y0 < x0 and x0 < y1
+    return y0 <= x0 and x1 <= y1
 
 
 cdef inline tuple get_union(int x0, int x1, int y0, int y1):
@@ -107,13 +122,10 @@ cpdef bint b_in_blacklist(Bounds bounds, list blacklist):
         u1 = bounds.low.elem0
         u0 = bounds.high.elem1
 
-    # Get intersection interval.
-    if bounds.low.elem1 < bounds.high.elem0:
-        i0 = bounds.low.elem1
-        i1 = bounds.high.elem0
-    else:
-        i1 = bounds.low.elem1
-        i0 = bounds.high.elem0
+    # Get intersection interval; it is not sorted, as an empty intersection
+    # (its begin after its end) overlaps no banned window.
+    i0 = bounds.high.elem0
+    i1 = bounds.low.elem1
 
     for w in blacklist:
         if contains(u0, u1, w.elem0, w.elem1) or intersects(i0, i1, w.elem0, w.elem1):
@@ -122,58 +134,413 @@ cpdef bint b_in_blacklist(Bounds bounds, list blacklist):
     return False
 
 
+cdef tuple branch_and_bound(
+    Function bounding_function,
+    heap,
+    Bounds bounds,
+    int split_index):
+    """Pushes the legal children of `bounds` on the heap and returns the heap
+    entry of the best child that is a single window or None."""
+
+    cdef Bounds bounds_i
+    cdef Bounds bounds_j
+    cdef int middle
+    cdef double score
+    cdef tuple best_child = None
+
+    bounds_i.low.elem0 = bounds.low.elem0
+    bounds_i.low.elem1 = bounds.low.elem1
+    bounds_i.high.elem0 = bounds.high.elem0
+    bounds_i.high.elem1 = bounds.high.elem1
+
+    bounds_j.low.elem0 = bounds.low.elem0
+    bounds_j.low.elem1 = bounds.low.elem1
+    bounds_j.high.elem0 = bounds.high.elem0
+    bounds_j.high.elem1 = bounds.high.elem1
+
+    if split_index == 0:
+        middle = (bounds.low.elem0 + bounds.high.elem0) / 2
+        bounds_i.high.elem0 = middle
+        bounds_j.low.elem0 = middle + 1
+    elif split_index == 1:
+        middle = (bounds.low.elem1 + bounds.high.elem1) / 2
+        bounds_i.high.elem1 = middle
+        bounds_j.low.elem1 = middle + 1
+
+    if b_is_legal(bounds_i):
+        score = bounding_function.evaluate(bounds_i)
+        heapq.heappush(heap, (-score, bounds_i))
+        if b_get_maximum_index(bounds_i) == -1 and score != - np.inf:
+            best_child = (-score, bounds_i)
+
+    if b_is_legal(bounds_j):
+        score = bounding_function.evaluate(bounds_j)
+        heapq.heappush(heap, (-score, bounds_j))
+        if (b_get_maximum_index(bounds_j) == -1 and score != - np.inf and
+            (best_child is None or -score < best_child[0])):
+            best_child = (-score, bounds_j)
+
+    return best_child
+
+
+cdef tuple cap_heap(list heap, max_heap_size):
+    """Cuts the heap down, in place, to its best half if it holds more than
+    `max_heap_size` boxes. Returns the number of dropped boxes and the best
+    bound among them."""
+
+    cdef list kept
+    cdef int nr_dropped
+
+    if max_heap_size is None or len(heap) <= max_heap_size:
+        return 0, - np.inf
+
+    kept = heapq.nsmallest(max_heap_size / 2 + 1, heap)
+    max_dropped_bound = - kept.pop()[0]
+    nr_dropped = len(heap) - len(kept)
+    heap[:] = kept
+    return nr_dropped, max_dropped_bound
+
+
 cpdef efficient_subwindow_search(
     Function bounding_function,
     heap,
     list blacklist=[],
-    int verbose=0):
+    int verbose=0,
+    dict stats=None,
+    int max_nr_iter=100000,
+    time_budget=None,
+    max_heap_size=None):
+    """Best-first branch-and-bound search. If it is interrupted, after
+    `max_nr_iter` popped nodes or `time_budget` seconds, it returns the best
+    fully resolved window found so far or, if there is none, the middle of
+    the top box with its own score (`-inf` and no window if it is empty or
+    banned), and `stats['upper_bound']` gives the bound on the optimal
+    score. The heap is cut down to its best half whenever it grows larger
+    than `max_heap_size`, and the bound accounts for the dropped boxes.
+
+    """
 
     cdef Bounds bounds
-    cdef Bounds bounds_i
-    cdef Bounds bounds_j
-    cdef int ii, split_index, middle
+    cdef int ii, split_index
+    cdef int nr_wasted_pops = 0
+    cdef int nr_nodes = 0
+    cdef int nr_dropped = 0
+    cdef int dropped
+    cdef int max_size = len(heap)
     cdef double score
+    cdef double upper_bound
+    cdef double max_dropped_bound = - np.inf
+    cdef bint resolved = False
+    cdef bint found = True
+    cdef tuple best_child
+    cdef tuple incumbent = None
 
-    for ii in xrange(100000):
+    deadline = time.time() + time_budget if time_budget is not None else None
+
+    for ii in xrange(max_nr_iter):
+
+        if deadline is not None and time.time() > deadline:
+            break
+
+        if len(heap) == 0:
+            break
 
         score, bounds = heapq.heappop(heap)
+        nr_nodes += 1
 
         if len(blacklist) > 0 and b_in_blacklist(bounds, blacklist):
+            nr_wasted_pops += 1
             continue
 
         # Branch...
         split_index = b_get_maximum_index(bounds)
 
         if split_index == -1:
+            resolved = True
             break
 
-        bounds_i.low.elem0 = bounds.low.elem0
-        bounds_i.low.elem1 = bounds.low.elem1
-        bounds_i.high.elem0 = bounds.high.elem0
-        bounds_i.high.elem1 = bounds.high.elem1
-
-        bounds_j.low.elem0 = bounds.low.elem0
-        bounds_j.low.elem1 = bounds.low.elem1
-        bounds_j.high.elem0 = bounds.high.elem0
-        bounds_j.high.elem1 = bounds.high.elem1
-
-        if split_index == 0:
-            middle = (bounds.low.elem0 + bounds.high.elem0) / 2
-            bounds_i.high.elem0 = middle
-            bounds_j.low.elem0 = middle + 1
-        elif split_index == 1:
-            middle = (bounds.low.elem1 + bounds.high.elem1) / 2
-            bounds_i.high.elem1 = middle
-            bounds_j.low.elem1 = middle + 1
-
         # ... and bound.
-        if b_is_legal(bounds_i):
-            score = bounding_function.evaluate(bounds_i)
-            heapq.heappush(heap, (-score, bounds_i))
+        best_child = branch_and_bound(
+            bounding_function, heap, bounds, split_index)
+
+        if (best_child is not None and
+            (incumbent is None or best_child[0] < incumbent[0]) and
+            not (len(blacklist) > 0 and b_in_blacklist(best_child[1], blacklist))):
+            incumbent = best_child
+
+        max_size = max(max_size, len(heap))
+        dropped, dropped_bound = cap_heap(heap, max_heap_size)
+        nr_dropped += dropped
+        max_dropped_bound = max(max_dropped_bound, dropped_bound)
+
+    if resolved:
+        upper_bound = max(- score, max_dropped_bound)
+    else:
+        # Search interrupted: the best candidate is either the best fully
+        # resolved window seen so far or the middle of the top box.
+        upper_bound = max(- heap[0][0] if heap else - np.inf, max_dropped_bound)
+        if incumbent is not None:
+            score, bounds = incumbent
+        elif heap:
+            bounds = heap[0][1]
+            elem0 = (bounds.low.elem0 + bounds.high.elem0) / 2
+            elem1 = (bounds.low.elem1 + bounds.high.elem1) / 2
+            bounds = b_init_bounds((elem0, elem1), (elem0, elem1))
+            if elem0 >= elem1 or (
+                len(blacklist) > 0 and b_in_blacklist(bounds, blacklist)):
+                score = np.inf
+            else:
+                score = - bounding_function.evaluate(bounds)
+        else:
+            score = np.inf
+
+    if stats is not None:
+        stats['nr_wasted_pops'] = nr_wasted_pops
+        stats['nr_nodes'] = nr_nodes
+        stats['heap_size'] = len(heap)
+        stats['max_heap_size'] = max_size
+        stats['nr_dropped_boxes'] = nr_dropped
+        stats['resolved'] = resolved
+        stats['upper_bound'] = upper_bound
+        stats['gap'] = upper_bound + score
+
+    if score == np.inf:
+        return - np.inf, None, heap
+
+    elem0 = (bounds.low.elem0 + bounds.high.elem0) / 2
+    elem1 = (bounds.low.elem1 + bounds.high.elem1) / 2
+
+    return - score,  (elem0, elem1), heap
+
+
+cpdef list efficient_subwindow_search_top_k(
+    Function bounding_function,
+    heap,
+    int k,
+    list blacklist=[],
+    dict stats=None,
+    int max_nr_iter=100000,
+    time_budget=None,
+    max_heap_size=None):
+    """Continues the branch-and-bound search until `k` fully resolved windows
+    are popped. Each window found is appended to `blacklist`, hence the
+    following ones do not overlap it; the bounding function should share the
+    same list of banned intervals. The search gives up after `max_nr_iter`
+    nodes without a new window or after `time_budget` seconds, returning the
+    windows found so far; the heap is capped by `max_heap_size`. Returns
+    `(score, (begin, end))` pairs in decreasing order of the score.
+
+    """
+
+    cdef Bounds bounds
+    cdef int split_index
+    cdef int nr_iter = 0
+    cdef int nr_nodes = 0
+    cdef int nr_wasted_pops = 0
+    cdef int nr_dropped = 0
+    cdef int dropped
+    cdef int max_size = len(heap)
+    cdef double score
+    cdef double max_dropped_bound = - np.inf
+    cdef tuple idxs
+    cdef list detections = []
+
+    deadline = time.time() + time_budget if time_budget is not None else None
+
+    while len(detections) < k and len(heap) > 0 and nr_iter < max_nr_iter:
+
+        if deadline is not None and time.time() > deadline:
+            break
+
+        nr_iter += 1
+        nr_nodes += 1
+        score, bounds = heapq.heappop(heap)
+
+        if len(blacklist) > 0 and b_in_blacklist(bounds, blacklist):
+            nr_wasted_pops += 1
+            continue
+
+        split_index = b_get_maximum_index(bounds)
+
+        if split_index == -1:
+
+            # The remaining windows are all illegal.
+            if score == np.inf:
+                break
 
-        if b_is_legal(bounds_j):
-            score = bounding_function.evaluate(bounds_j)
-            heapq.heappush(heap, (-score, bounds_j))
+            idxs = (
+                (bounds.low.elem0 + bounds.high.elem0) / 2,
+                (bounds.low.elem1 + bounds.high.elem1) / 2)
+            detections.append((- score, idxs))
+            blacklist.append(b_init_interval(idxs))
+
+            nr_iter = 0
+            continue
+
+        branch_and_bound(bounding_function, heap, bounds, split_index)
+
+        max_size = max(max_size, len(heap))
+        dropped, dropped_bound = cap_heap(heap, max_heap_size)
+        nr_dropped += dropped
+        max_dropped_bound = max(max_dropped_bound, dropped_bound)
+
+    if stats is not None:
+        stats['nr_wasted_pops'] = nr_wasted_pops
+        stats['nr_nodes'] = nr_nodes
+        stats['max_heap_size'] = max_size
+        stats['nr_dropped_boxes'] = nr_dropped
+        stats['max_dropped_bound'] = max_dropped_bound
+
+    return detections
+
+
+cpdef batch_efficient_subwindow_search(
+    Function bounding_function,
+    heap,
+    int batch_size,
+    list blacklist=[],
+    dict stats=None,
+    int max_nr_iter=100000,
+    max_heap_size=None):
+    """Branch-and-bound search that pops the best `batch_size` boxes at each
+    step, splits all of them and bounds the children with a single call of
+    `bounding_function.evaluate_batch`. The search stops when the top box is
+    a single window, which is then optimal (unless boxes were dropped to cap
+    the heap to `max_heap_size`). If `max_nr_iter` batches are used up
+    first, returns the best window found so far, as
+    `efficient_subwindow_search` does; `stats['nr_nodes']` counts the
+    popped boxes.
+
+    """
+
+    cdef Bounds bounds
+    cdef Bounds parent
+    cdef Bounds child
+    cdef int ii, jj, nn, split_index, middle
+    cdef int nr_nodes = 0
+    cdef int nr_wasted_pops = 0
+    cdef bint resolved = False
+    cdef int nr_dropped = 0
+    cdef int dropped
+    cdef int max_size = len(heap)
+    cdef double score
+    cdef double upper_bound
+    cdef double max_dropped_bound = - np.inf
+    cdef tuple incumbent = None
+    cdef list popped
+    cdef list children
+    cdef np.ndarray[np.int_t, ndim=2] boxes
+    cdef np.ndarray[np.float64_t, ndim=1] scores
+
+    for ii in xrange(max_nr_iter):
+
+        popped = []
+        while len(popped) < batch_size and len(heap) > 0:
+            score, bounds = heapq.heappop(heap)
+            nr_nodes += 1
+            if len(blacklist) > 0 and b_in_blacklist(bounds, blacklist):
+                nr_wasted_pops += 1
+                continue
+            popped.append((score, bounds))
+
+        # The heap ran out without a single window.
+        if len(popped) == 0:
+            break
+
+        score, bounds = popped[0]
+
+        if b_get_maximum_index(bounds) == -1:
+            for entry in popped[1:]:
+                heapq.heappush(heap, entry)
+            resolved = True
+            break
+
+        children = []
+        for entry in popped:
+            parent = entry[1]
+            split_index = b_get_maximum_index(parent)
+
+            if split_index == -1:
+                heapq.heappush(heap, entry)
+                continue
+
+            for jj in xrange(2):
+                child = parent
+                if split_index == 0:
+                    middle = (parent.low.elem0 + parent.high.elem0) / 2
+                    if jj == 0:
+                        child.high.elem0 = middle
+                    else:
+                        child.low.elem0 = middle + 1
+                else:
+                    middle = (parent.low.elem1 + parent.high.elem1) / 2
+                    if jj == 0:
+                        child.high.elem1 = middle
+                    else:
+                        child.low.elem1 = middle + 1
+                if b_is_legal(child):
+                    children.append(child)
+
+        if len(children) == 0:
+            continue
+
+        boxes = np.zeros((len(children), 4), dtype=np.int_)
+        for nn in xrange(len(children)):
+            child = children[nn]
+            boxes[nn, 0] = child.low.elem0
+            boxes[nn, 1] = child.low.elem1
+            boxes[nn, 2] = child.high.elem0
+            boxes[nn, 3] = child.high.elem1
+
+        scores = bounding_function.evaluate_batch(boxes)
+
+        for nn in xrange(len(children)):
+            heapq.heappush(heap, (- scores[nn], children[nn]))
+            # The banned windows are bounded by `-inf`.
+            child = children[nn]
+            if (b_get_maximum_index(child) == -1 and scores[nn] != - np.inf and
+                (incumbent is None or - scores[nn] < incumbent[0])):
+                incumbent = (- scores[nn], child)
+
+        max_size = max(max_size, len(heap))
+        dropped, dropped_bound = cap_heap(heap, max_heap_size)
+        nr_dropped += dropped
+        max_dropped_bound = max(max_dropped_bound, dropped_bound)
+
+    if resolved:
+        upper_bound = max(- score, max_dropped_bound)
+    else:
+        # Search interrupted: the best candidate is either the best fully
+        # resolved window seen so far or the middle of the top box.
+        upper_bound = max(- heap[0][0] if heap else - np.inf, max_dropped_bound)
+        if incumbent is not None:
+            score, bounds = incumbent
+        elif heap:
+            bounds = heap[0][1]
+            elem0 = (bounds.low.elem0 + bounds.high.elem0) / 2
+            elem1 = (bounds.low.elem1 + bounds.high.elem1) / 2
+            bounds = b_init_bounds((elem0, elem1), (elem0, elem1))
+            if elem0 >= elem1 or (
+                len(blacklist) > 0 and b_in_blacklist(bounds, blacklist)):
+                score = np.inf
+            else:
+                score = - bounding_function.evaluate(bounds)
+        else:
+            score = np.inf
+
+    if stats is not None:
+        stats['nr_wasted_pops'] = nr_wasted_pops
+        stats['nr_nodes'] = nr_nodes
+        stats['heap_size'] = len(heap)
+        stats['max_heap_size'] = max_size
+        stats['nr_dropped_boxes'] = nr_dropped
+        stats['max_dropped_bound'] = max_dropped_bound
+        stats['resolved'] = resolved
+        stats['upper_bound'] = upper_bound
+        stats['gap'] = upper_bound + score
+
+    if score == np.inf:
+        return - np.inf, None, heap
 
     elem0 = (bounds.low.elem0 + bounds.high.elem0) / 2
     elem1 = (bounds.low.elem1 + bounds.high.elem1) / 2
@@ -181,6 +548,38 @@ cpdef efficient_subwindow_search(
     return - score,  (elem0, elem1), heap
 
 
+cpdef list prune_heap(
+    Function bounding_function,
+    list heap,
+    list intervals,
+    dict stats=None):
+    """Removes from the heap the boxes that are banned by the newly detected
+    `intervals` and returns the compacted heap; the bounds of the other
+    boxes do not depend on the banned intervals.
+
+    """
+
+    cdef Bounds bounds
+    cdef double score
+    cdef int nr_dropped = 0
+    cdef list pruned_heap = []
+
+    for score, bounds in heap:
+
+        if b_in_blacklist(bounds, intervals):
+            nr_dropped += 1
+            continue
+
+        pruned_heap.append((score, bounds))
+
+    heapq.heapify(pruned_heap)
+
+    if stats is not None:
+        stats['nr_dropped'] = nr_dropped
+
+    return pruned_heap
+
+
 cdef class LinearBoundingFunction(Function):
     cdef np.ndarray pos_integral_scores
     cdef np.ndarray neg_integral_scores
@@ -287,13 +686,18 @@ cdef class ApproxNormsBoundingFunction(Function):
 
             return bound_sqrt_scores / np.sqrt(bound_approx_l2_norm) if bound_approx_l2_norm != 0 else + np.inf
 
-        l2_norms_inter = self._eval_integral(self.slice_vw_l2_norms, ii)
-        if np.all(l2_norms_inter == 0):
-            return - np.inf
-
         if len(self.banned_intervals) > 0 and b_in_blacklist(bounds, self.banned_intervals):
             return - np.inf
 
+        # An intersection without descriptors leaves the longer windows of
+        # the box unbounded; only a single window is empty.
+        l2_norms_inter = self._eval_integral(self.slice_vw_l2_norms, ii)
+        if np.all(l2_norms_inter == 0):
+            if (bounds.low.elem0 == bounds.high.elem0 and
+                bounds.low.elem1 == bounds.high.elem1):
+                return - np.inf
+            return np.inf
+
         score_union = self._eval_integral(self.pos_slice_vw_scores, uu)
         score_inter = self._eval_integral(self.neg_slice_vw_scores, ii)
 
@@ -306,9 +710,41 @@ cdef class ApproxNormsBoundingFunction(Function):
             bound_sqrt_scores += (score_union[kk] + score_inter[kk]) / sqrt(counts_inter[kk])
             bound_approx_l2_norm += l2_norms_inter[kk] / counts_union[kk]
 
+        if bound_approx_l2_norm == 0:
+            return - np.inf
+
         max_slice_length = uu[1] - uu[0] if self.weight_by_slice_length else 1.
         return bound_sqrt_scores / sqrt(bound_approx_l2_norm) * max_slice_length
 
+    cpdef np.ndarray evaluate_batch(self, long[:, :] boxes):
+        """Evaluates the bounds of a batch of boxes in parallel."""
+
+        cdef Py_ssize_t nn
+        cdef Py_ssize_t N = boxes.shape[0]
+        cdef int min_window = self.min_window
+        cdef int max_window = self.max_window
+        cdef bint weight_by_slice_length = self.weight_by_slice_length
+        cdef double[:] scores = np.zeros(N)
+        cdef long[:, :] banned = np.array(
+            [(ww['elem0'], ww['elem1']) for ww in self.banned_intervals]
+            if self.banned_intervals else np.zeros((0, 2)), dtype=np.int_)
+
+        cdef double[:, :] scores_no_integral = self.slice_vw_scores_no_integral
+        cdef double[:, :] l2_norms_no_integral = self.slice_vw_l2_norms_no_integral
+        cdef double[:, :] pos_scores = self.pos_slice_vw_scores
+        cdef double[:, :] neg_scores = self.neg_slice_vw_scores
+        cdef double[:, :] counts = self.slice_vw_counts
+        cdef double[:, :] l2_norms = self.slice_vw_l2_norms
+
+        for nn in prange(N, nogil=True):
+            scores[nn] = approx_norms_bound(
+                boxes[nn, 0], boxes[nn, 1], boxes[nn, 2], boxes[nn, 3],
+                scores_no_integral, l2_norms_no_integral, pos_scores,
+                neg_scores, counts, l2_norms, banned, min_window, max_window,
+                weight_by_slice_length)
+
+        return np.asarray(scores)
+
     cpdef np.ndarray _eval_integral(
         self,
         np.ndarray[np.float64_t, ndim=2] X,
@@ -318,6 +754,101 @@ cdef class ApproxNormsBoundingFunction(Function):
         return X[high, :] - X[low, :] if high > low else np.zeros(X.shape[1]) 
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef double approx_norms_bound(
+    long low0, long low1, long high0, long high1,
+    double[:, :] scores_no_integral,
+    double[:, :] l2_norms_no_integral,
+    double[:, :] pos_scores,
+    double[:, :] neg_scores,
+    double[:, :] counts,
+    double[:, :] l2_norms,
+    long[:, :] banned,
+    int min_window,
+    int max_window,
+    bint weight_by_slice_length) nogil:
+    """Same bound as `ApproxNormsBoundingFunction.evaluate`, but working only
+    on memory views, so it can be run without the GIL."""
+
+    cdef long u0 = low0, u1 = high1, i0 = high0, i1 = low1
+    cdef long su0, su1, ww, nn
+    cdef Py_ssize_t kk, K = counts.shape[1]
+    cdef double bound_sqrt_scores = 0, bound_approx_l2_norm = 0
+    cdef double count_union, count_inter, l2_norm_inter, score_union, l2_norm_union
+    cdef bint all_zero = True
+    cdef double inf = INFINITY
+
+    if (i0 == i1 and i1 == u0 and u0 == u1) or u0 >= u1:
+        return - inf
+
+    if i1 - i0 > max_window:
+        return - inf
+
+    if u1 - u0 < min_window:
+        return - inf
+
+    # Empty intersection.
+    if i1 <= i0:
+        for kk in range(K):
+            count_union = counts[u1, kk] - counts[u0, kk]
+            if count_union == 0:
+                continue
+            score_union = scores_no_integral[u0, kk]
+            l2_norm_union = l2_norms_no_integral[u0, kk]
+            for nn in range(u0 + 1, u1):
+                score_union = max(score_union, scores_no_integral[nn, kk])
+                l2_norm_union = min(l2_norm_union, l2_norms_no_integral[nn, kk])
+            bound_sqrt_scores += score_union / sqrt(count_union)
+            bound_approx_l2_norm += l2_norm_union / count_union
+        if bound_approx_l2_norm == 0:
+            return inf
+        return bound_sqrt_scores / sqrt(bound_approx_l2_norm)
+
+    # Sorted union and unsorted intersection, as in `b_in_blacklist`.
+    if u0 < u1:
+        su0 = u0
+        su1 = u1
+    else:
+        su0 = u1
+        su1 = u0
+
+    for ww in range(banned.shape[0]):
+        if ((banned[ww, 0] <= su0 and su1 <= banned[ww, 1]) or
+            min(i1, banned[ww, 1]) > max(i0, banned[ww, 0])):
+            return - inf
+
+    for kk in range(K):
+        if l2_norms[i1, kk] - l2_norms[i0, kk] != 0:
+            all_zero = False
+            break
+
+    # As in `evaluate`, only a single window without descriptors is empty.
+    if all_zero:
+        if low0 == high0 and low1 == high1:
+            return - inf
+        return inf
+
+    for kk in range(K):
+        count_union = counts[u1, kk] - counts[u0, kk]
+        count_inter = counts[i1, kk] - counts[i0, kk]
+        if count_inter == 0 or count_union == 0:
+            continue
+        l2_norm_inter = l2_norms[i1, kk] - l2_norms[i0, kk]
+        bound_sqrt_scores += (
+            (pos_scores[u1, kk] - pos_scores[u0, kk]) +
+            (neg_scores[i1, kk] - neg_scores[i0, kk])) / sqrt(count_inter)
+        bound_approx_l2_norm += l2_norm_inter / count_union
+
+    if bound_approx_l2_norm == 0:
+        return - inf
+
+    if weight_by_slice_length:
+        return bound_sqrt_scores / sqrt(bound_approx_l2_norm) * (u1 - u0)
+    return bound_sqrt_scores / sqrt(bound_approx_l2_norm)
+
+
 def test():
     cdef Bounds bounds
     scores = [-2, 1, -3, 4, -1, 2, 1, -5, 4]